@@ -40,7 +40,7 @@ int main(int argc, char* argv[]){
 
     int server_fd = create_socket_server(port, BACKLOG);
 
-    struct handler_set handlers;
+    struct handler_set handlers = { 0 };
     handlers.on_new_client = &new_client;
     handlers.on_can_read = &handle_data;
 
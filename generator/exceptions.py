@@ -28,4 +28,27 @@ class InvalidFieldTypeException(GeneratorException):
 			message = 'Invalid type {element_type} at {element}'.format(
 				element_type=element_type, element=element_to_xml_string(element))
 		self.message = message	
-		super(InvalidFieldTypeException, self).__init__(message)
\ No newline at end of file
+		super(InvalidFieldTypeException, self).__init__(message)
+
+class InvalidAttributeValueException(GeneratorException):
+
+	def __init__(self, attribute, value, element, message=None):
+		self.attribute = attribute
+		self.value = value
+		self.element = element
+		if message is None:
+			message = 'Invalid value {value} for {attr} attribute at {element}'.format(
+				value=value, attr=attribute,
+				element=element_to_xml_string(element))
+		self.message = message
+		super(InvalidAttributeValueException, self).__init__(message)
+
+class OutputFileException(GeneratorException):
+
+	def __init__(self, file_path, message=None):
+		self.file_path = file_path
+		if message is None:
+			message = 'Could not open or create file {path}'.format(
+				path=file_path)
+		self.message = message
+		super(OutputFileException, self).__init__(message)
@@ -1,6 +1,13 @@
 import argparse
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
 import xml.etree.ElementTree as ET
-from sys import stderr
+from concurrent.futures import ProcessPoolExecutor
+from sys import stderr, exit
 from os import path, remove
 
 import templates, exceptions
@@ -11,43 +18,312 @@ types = ['int8_t', 'uint8_t',
 		'int64_t', 'uint64_t',
 		'char']
 
-def generate(xml_source, provided_path):
+encodings = ['fixed', 'varint']
+
+layouts = ['default', 'compact']
+
+# Las secciones que se escriben después de todos los mensajes se guardan
+# en memoria hasta este tamaño y luego en un archivo temporal.
+SPOOL_MAX_SIZE = 1 << 20
+
+def generate(xml_source, provided_path, wide_frames=False, sized_strings=False,
+		compact_structs=False, inline_codecs=False, dispatch=False,
+		correlation_ids=False, shared_memory=False, frame_relay=False,
+		capture=False, python_module=False, force=False, generator_hash=None):
 
 	"""Genera los archivos
 	   Parametros:
 	   	-xml_source: dirección del archivo xml fuente dada
 	   		por el usuario.
 	   	-provided_path: dirección dada por el usuario con 
-			el flag '-o'."""
-
-	tree = ET.parse(xml_source)
-	root = tree.getroot()
+			el flag '-o'.
+		-wide_frames: si es verdadero, la longitud de los paquetes y
+			los prefijos de longitud de los campos ocupan 4 bytes
+			en lugar de 2 (flag '--wide-frames').
+		-sized_strings: si es verdadero, todos los campos char* se
+			generan como si tuvieran el atributo sized="true"
+			(flag '--sized-strings').
+		-compact_structs: si es verdadero, todos los mensajes usan el
+			layout compacto (flag '--compact-structs').
+		-inline_codecs: si es verdadero, las funciones de codificación
+			de los mensajes se generan en el header como static
+			inline (flag '--inline').
+		-dispatch: si es verdadero, se genera un dispatcher de mensajes
+			para el servidor de sockets.h (flag '--dispatch').
+		-correlation_ids: si es verdadero, los paquetes llevan un id
+			de correlación y se genera el multiplexor de pedidos
+			(flag '--correlation-ids').
+		-shared_memory: si es verdadero, se genera el canal de memoria
+			compartida (flag '--shared-memory').
+		-frame_relay: si es verdadero, se generan las funciones que
+			reenvían paquetes sin decodificarlos (flag
+			'--frame-relay').
+		-capture: si es verdadero, el tráfico enviado y recibido puede
+			capturarse en un archivo (flag '--capture').
+		-python_module: si es verdadero, se genera además un módulo
+			de Python que codifica y decodifica los mensajes con las
+			funciones generadas (flag '--python').
+		-force: si es verdadero, se generan los archivos aunque ya
+			estén generados a partir del mismo xml con las mismas
+			opciones (flag '--force').
+		-generator_hash: el hash del código del generador, si ya se
+			calculó (ver generator_fingerprint()).
+	   Retorna falso si no se generaron los archivos por estar al día.
+	   Si el xml no es válido o la generación falla tira la excepción
+	   correspondiente, sin modificar los archivos ya generados."""
+
+	options = {
+		'wide_frames': wide_frames,
+		'sized_strings': sized_strings,
+		'compact_structs': compact_structs,
+		'inline_codecs': inline_codecs,
+		'dispatch': dispatch,
+		'correlation_ids': correlation_ids,
+		'shared_memory': shared_memory,
+		'frame_relay': frame_relay,
+		'capture': capture,
+		'python_module': python_module
+	}
+	# El xml se recorre a medida que se parsea: solo se necesita el
+	# elemento root para saber el nombre de los archivos a generar
+	events = ET.iterparse(xml_source, events=('start', 'end'))
+	_, root = next(events)
 	header_path, source_path = get_file_paths(root, provided_path)
 	header_name = header_path.split('/')[-1]
-	header = source = None
+	python_path = get_python_module_path(header_path) if python_module else None
+	fingerprint = input_fingerprint(xml_source, options,
+		generator_hash or generator_fingerprint())
+	if not force and is_up_to_date(header_path, source_path, fingerprint,
+			python_path):
+		return False
+	# Los archivos se generan en temporales que reemplazan a los
+	# originales solo si la generación termina bien. El header, que
+	# lleva la huella, se reemplaza último.
+	output_paths = [header_path, source_path]
+	if python_path:
+		output_paths.append(python_path)
+	outputs = []
 	try:
-		header = open(header_path, 'w')
-		source = open(source_path, 'w')
-	except OSError as error:
-		err = "Could not open or create file {path}".format(
-			path=error.filename)
-		stderr.write(err)
-		if header and not header.closed:
-			# If the header was succesfully opened and what failed
-			# was the source, we close and delete the header
-			header.close()
-			remove_file(header_path)
-		return
+		for output_path in output_paths:
+			outputs.append((open(temporary_path(output_path), 'w'),
+				output_path))
+	except OSError:
+		discard_outputs(outputs)
+		raise exceptions.OutputFileException(output_path)
+	header, source = outputs[0][0], outputs[1][0]
+	python = outputs[2][0] if python_path else None
 	try:
-		generate_header(root, header)
-		generate_source(root, source, header_name)
-	except exceptions.GeneratorException as error:
-		stderr.write(error.message + '\n')
-		remove_file(header_path)
-		remove_file(source_path)
-	finally:
-		header.close()
-		source.close()
+		header.write(templates.header_fingerprint.format(
+			fingerprint=fingerprint))
+		generate_protocol(root, events, header, source, header_name, options,
+			python)
+		for file, output_path in outputs:
+			file.close()
+		for file, output_path in reversed(outputs):
+			try:
+				os.replace(file.name, output_path)
+			except OSError:
+				raise exceptions.OutputFileException(output_path)
+	except BaseException:
+		discard_outputs(outputs)
+		raise
+	return True
+
+def generator_fingerprint():
+
+	"""Retorna un hash del código del generador y sus templates, para
+	regenerar los protocolos cuando este cambia."""
+
+	digest = hashlib.sha256()
+	for module_path in (__file__, templates.__file__, exceptions.__file__):
+		with open(module_path, 'rb') as module:
+			digest.update(module.read())
+	return digest.hexdigest()
+
+def input_fingerprint(xml_source, options, generator_hash):
+
+	"""Retorna un hash de todo lo que determina los archivos generados:
+	el xml, las opciones y el código del generador.
+	   Parametros:
+	   	-xml_source: dirección del archivo xml fuente
+	   	-options: diccionario con las opciones del generador
+	   	-generator_hash: el hash del código del generador"""
+
+	digest = hashlib.sha256(generator_hash.encode())
+	digest.update(json.dumps(options, sort_keys=True).encode())
+	with open(xml_source, 'rb') as xml_file:
+		digest.update(xml_file.read())
+	return digest.hexdigest()
+
+def is_up_to_date(header_path, source_path, fingerprint, python_path=None):
+
+	"""Retorna verdadero si los archivos ya fueron generados con la
+	huella dada, que figura en la primera línea del header.
+	   Parametros:
+	   	-header_path: dirección del header
+	   	-source_path: dirección del source
+	   	-fingerprint: la huella de la generación actual
+	   	-python_path: dirección del módulo de Python, si se genera"""
+
+	if not path.isfile(source_path):
+		return False
+	if python_path and not path.isfile(python_path):
+		return False
+	try:
+		with open(header_path) as header:
+			first_line = header.readline()
+	except OSError:
+		return False
+	return first_line == templates.header_fingerprint.format(
+		fingerprint=fingerprint)
+
+def generate_protocol(root, events, header, source, header_name, options,
+		python=None):
+
+	"""Genera el header y el source recorriendo el xml a medida que se
+	parsea. Cada enumeración y cada mensaje se escribe apenas se termina
+	de leer y luego se descarta, por lo que la memoria usada depende del
+	mensaje más grande y no del tamaño del protocolo. De cada mensaje
+	solo se guarda un resumen para generar los switch que los recorren
+	a todos.
+	   Parametros:
+		-root: el elemento root del archivo xml, sin sus hijos
+		-events: el iterador de iterparse, ya consumido el inicio
+			de root
+		-header: el archivo header al que escribir
+		-source: el archivo source al que escribir
+		-header_name: el nombre del archivo header
+		-options: diccionario con las opciones del generador
+		-python: el archivo del módulo de Python al que escribir,
+			None si no se genera"""
+
+	validate_protocol_encoding(root)
+	generate_header_start(header, options)
+	generate_source_start(source, header_name, options)
+	if python:
+		module_name = python_module_name(header_name)
+		python.write(templates.python_module_start.format(
+			header_name=header_name))
+	# Las funciones inline del header y las del canal de memoria
+	# compartida del source van después de todos los mensajes
+	inline_codecs = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE, 'w+')
+	shm_functions = tempfile.SpooledTemporaryFile(SPOOL_MAX_SIZE, 'w+')
+	summaries = []
+	open_elements = [root]
+	with inline_codecs, shm_functions:
+		for event, element in events:
+			if event == 'start':
+				open_elements.append(element)
+				continue
+			open_elements.pop()
+			if element.tag == 'enum':
+				generate_enum_definition(header, element)
+			elif element.tag == 'message':
+				prepare_message(root, element, options)
+				generate_message(header, source, element, options,
+					inline_codecs, shm_functions)
+				if python:
+					generate_python_message(python, element, module_name)
+				summaries.append(message_summary(element))
+			else:
+				continue
+			if open_elements:
+				open_elements[-1].remove(element)
+		generate_header_end(header, summaries, inline_codecs, options)
+		generate_source_end(source, summaries, shm_functions, options)
+		if python:
+			generate_python_end(python, summaries, module_name)
+
+def prepare_message(root, message, options):
+
+	"""Aplica a un mensaje las opciones del generador y los atributos
+	del protocolo que afectan a todos sus mensajes.
+	   Parametros:
+	   	-root: el elemento root del archivo xml
+	   	-message: el elemento xml del mensaje
+	   	-options: diccionario con las opciones del generador"""
+
+	for field in message.iter('field'):
+		if not field.text:
+			raise exceptions.MissingAttributeException('name', field,
+				'Missing field name at {element}'.format(
+					element=exceptions.element_to_xml_string(field)))
+	if options['sized_strings']:
+		mark_sized_strings(message)
+	mark_protocol_encoding(root, message)
+	mark_protocol_layout(root, message, options['compact_structs'])
+
+def mark_sized_strings(message):
+
+	"""Agrega el atributo sized="true" a todos los campos char*
+	del mensaje.
+	   Parametros:
+	   	-message: el elemento xml del mensaje"""
+
+	for field in message.iter('field'):
+		if 'type' in field.attrib and is_string_type(field):
+			field.set('sized', 'true')
+
+def validate_protocol_encoding(root):
+
+	"""Si el elemento root tiene el atributo encoding, verifica que
+	sea válido.
+	   Parametros:
+	   	-root: el elemento root del archivo xml"""
+
+	encoding = root.attrib.get('encoding', encodings[0])
+	if not encoding in encodings:
+		raise exceptions.InvalidAttributeValueException(
+			'encoding', encoding, root)
+
+def mark_protocol_encoding(root, message):
+
+	"""Si el elemento root tiene el atributo encoding, lo agrega a
+	todos los campos del mensaje que no definan el suyo y admitan
+	dicho encoding (todos salvo los stream y los blob).
+	   Parametros:
+	   	-root: el elemento root del archivo xml
+	   	-message: el elemento xml del mensaje"""
+
+	if not 'encoding' in root.attrib:
+		return
+	encoding = root.attrib['encoding']
+	for field in message.iter('field'):
+		if 'encoding' in field.attrib or not 'type' in field.attrib:
+			continue
+		if is_blob_type(field) or is_stream_field(field):
+			continue
+		field.set('encoding', encoding)
+
+def mark_protocol_layout(root, message, compact_structs):
+
+	"""Si se usa la opción --compact-structs o el elemento root tiene
+	el atributo layout, agrega el layout correspondiente al mensaje si
+	este no define el suyo.
+	   Parametros:
+	   	-root: el elemento root del archivo xml
+	   	-message: el elemento xml del mensaje
+	   	-compact_structs: si todos los mensajes usan el layout
+	   		compacto"""
+
+	layout = 'compact' if compact_structs else root.attrib.get('layout')
+	if layout is None:
+		return
+	if not 'layout' in message.attrib:
+		message.set('layout', layout)
+
+def temporary_path(file_path):
+	return '{path}.{pid}.tmp'.format(path=file_path, pid=os.getpid())
+
+def discard_outputs(outputs):
+
+	"""Cierra y borra los archivos temporales de una generación fallida.
+	   Parametros:
+	   	-outputs: lista de tuplas (archivo temporal, dirección final)"""
+
+	for file, _ in outputs:
+		file.close()
+		remove_file(file.name)
 
 def remove_file(file_path):
 	if path.isfile(file_path):
@@ -70,6 +346,22 @@ def get_file_paths(root, provided_path):
 		base_path = provided_path
 	return base_path + '.h', base_path + '.c'
 
+def get_python_module_path(header_path):
+	return header_path[0:-2] + '_py.c'
+
+def python_module_name(header_name):
+
+	"""Retorna el nombre del módulo de Python: el del header sin su
+	extensión, reemplazando los caracteres que no pueden formar parte
+	de un identificador.
+	   Parametros:
+	   	-header_name: el nombre del archivo header"""
+
+	module_name = re.sub(r'\W', '_', header_name[0:-2])
+	if module_name == '' or module_name[0].isdigit():
+		module_name = '_' + module_name
+	return module_name
+
 def _get_element_attribute(element, attribute):
 
 	"""Retorna un atributo de un elemento xml. Si el elemento
@@ -92,6 +384,8 @@ def get_id(element):
 	return _get_element_attribute(element, 'id')
 
 def _is_valid_type(element_type):
+	if element_type == 'blob':
+		return True
 	return element_type in types or element_type[0:-2] in types or element_type[0:-1] in types
 
 def get_type(element):
@@ -106,42 +400,149 @@ def get_type(element):
 		raise exceptions.InvalidFieldTypeException(element_type, element)
 	return element_type
 
-def generate_header(root, header):
+def generate_header_start(header, options):
 
-	"""Genera el header file.
+	"""Escribe el comienzo del header file, anterior a las
+	enumeraciones y los mensajes.
 	   Parametros:
-		-root: el elemento root del archivo xml
-		-header: el objeto archivo al que escribir"""
+		-header: el objeto archivo al que escribir
+		-options: diccionario con las opciones del generador
+			(wide_frames, inline_codecs, dispatch, correlation_ids,
+			shared_memory, frame_relay y capture)"""
 
-	max_msg_size = 0
 	header.write(templates.header_defines)
 	header.write(templates.header_includes)
+	if options['dispatch']:
+		header.write(templates.dispatch_includes)
+	elif options['frame_relay']:
+		header.write(templates.relay_includes)
+	if options['correlation_ids']:
+		header.write(templates.correlation_includes)
+	if options['wide_frames']:
+		header.write(templates.wide_frame_types)
+	else:
+		header.write(templates.frame_types)
 	header.write(templates.errors_enum)
-	generate_enum_definitions(header, root)
-	for message in root.iter('message'):
-		generate_msg_defines(header, message)
-		generate_struct(header, message)
-		generate_signatures(header, message)
+	header.write(templates.arena_definition)
+	header.write(templates.file_blob_definition)
+	header.write(templates.send_buffer_definition)
+	if options['shared_memory']:
+		header.write(templates.shm_definitions)
+	if options['frame_relay']:
+		header.write(templates.relay_definitions)
+	if options['capture']:
+		header.write(templates.capture_definitions)
+
+def generate_header_end(header, summaries, inline_codecs, options):
+
+	"""Escribe el final del header file, posterior a todos los
+	mensajes.
+	   Parametros:
+		-header: el objeto archivo al que escribir
+		-summaries: los resúmenes de los mensajes del protocolo
+		-inline_codecs: archivo temporal con las funciones de
+			codificación de los mensajes, si se definen en el header
+		-options: diccionario con las opciones del generador"""
+
+	if options['dispatch']:
+		header.write(templates.dispatch_definitions.format(
+			handler_members=dispatch_handler_members(summaries)))
+	if options['correlation_ids']:
+		header.write(templates.multiplexer_definitions)
 	header.write(templates.msg_handling_functions_declarations)
+	if options['python_module']:
+		header.write(templates.frame_decoding_definitions)
+	if options['inline_codecs']:
+		header.write(templates.inline_includes)
+		write_codec_runtime(header, options)
+		copy_spooled_file(inline_codecs, header)
 	header.write(templates.header_close)
 
-def generate_enum_definitions(file, root):
+def generate_message(header, source, message, options, inline_codecs, shm_functions):
+
+	"""Genera todo el código de un mensaje: sus defines, su struct y
+	sus declaraciones en el header, y sus funciones en el source (o en
+	inline_codecs si las de codificación se definen en el header).
+	   Parametros:
+		-header: el archivo header al que escribir
+		-source: el archivo source al que escribir
+		-message: el elemento xml del mensaje
+		-options: diccionario con las opciones del generador
+		-inline_codecs: archivo temporal para las funciones de
+			codificación inline
+		-shm_functions: archivo temporal para las funciones que
+			envían el mensaje por el canal de memoria compartida"""
+
+	generate_msg_defines(header, message)
+	generate_struct(header, message, options['wide_frames'])
+	generate_signatures(header, message, options['inline_codecs'],
+		options['shared_memory'])
+	# Los argumentos de los templates se calculan una única vez por mensaje
+	arguments = message_template_arguments(message)
+	if options['inline_codecs']:
+		generate_codec_functions(inline_codecs, arguments, True)
+	else:
+		generate_codec_functions(source, arguments, False)
+	generate_send_functions(source, message, arguments)
+	if options['shared_memory'] and len(trailing_data_fields(message)) == 0:
+		shm_functions.write(templates.shm_send_function_template.format(
+			**arguments))
+
+def message_summary(message):
+
+	"""Retorna lo que se guarda de un mensaje una vez generado: los
+	datos con los que se completan los switch y tablas que recorren
+	todos los mensajes.
+	   Parametros:
+	   	-message: el elemento xml del mensaje"""
+
+	msg_name = get_name(message)
+	return dict(
+		msg_name=msg_name,
+		msg_name_upper=msg_name.upper(),
+		trailing_data=len(trailing_data_fields(message)) != 0)
+
+def copy_spooled_file(spooled_file, file):
 
-	"""Genera el código que define las enumeraciones del protocolo.
+	"""Copia al final de file el contenido de un archivo temporal.
+	   Parametros:
+	   	-spooled_file: el archivo temporal
+	   	-file: el archivo al que escribir"""
+
+	spooled_file.seek(0)
+	shutil.copyfileobj(spooled_file, file)
+
+def write_codec_runtime(file, options):
+
+	"""Escribe las definiciones que usan las funciones de codificación
+	de los mensajes: el formato de los paquetes, la conversión de
+	byte order y la reserva de memoria al decodificar.
+	   Parametros:
+	   	-file: el archivo al que escribir
+	   	-options: diccionario con las opciones del generador"""
+
+	if options['wide_frames']:
+		file.write(templates.wide_frame_defines)
+	else:
+		file.write(templates.frame_defines)
+	file.write(templates.byte_order_functions)
+	if options['correlation_ids']:
+		file.write(templates.correlation_frame_header_functions)
+	else:
+		file.write(templates.frame_header_functions)
+	file.write(templates.decode_alloc_functions)
+
+def generate_enum_definition(file, enum):
+
+	"""Genera el código que define una enumeración del protocolo.
 	   Parametros:
 	   	-file: el archivo al que escribir
-	   	-root: el elemento root xml"""
-
-	template = templates.enum_definition
-	for enum in root.iter('enum'):
-		enum_name = get_name(enum)
-		values = list(map(
-			lambda x: x.text, 
-			enum.iter('entry')))
-		values = ', '.join(values)
-		file.write(template.format(
-			enum_name=enum_name,
-			values=values))
+	   	-enum: el elemento xml de la enumeración"""
+
+	values = ', '.join(entry.text for entry in enum.iter('entry'))
+	file.write(templates.enum_definition.format(
+		enum_name=get_name(enum),
+		values=values))
 
 def generate_msg_defines(file, message):
 
@@ -158,35 +559,99 @@ def generate_msg_defines(file, message):
 		msg_id=get_id(message))
 	file.write(s)
 
-def generate_struct(file, message):
+def generate_struct(file, message, wide_frames):
 
-	"""Genera el struct correspondiente al mensaje.
+	"""Genera el struct correspondiente al mensaje. Si el mensaje usa
+	el layout compacto, ordena los miembros del struct (salvo el id,
+	que siempre va primero) de menor a mayor alineación para minimizar
+	el padding, y agrega asserts estáticos con su tamaño. El orden de
+	los campos en la red no cambia.
 	   Parametros:
 	   	-file: el archivo al que escribir
-	   	-message: el elemento xml del mensaje"""
+	   	-message: el elemento xml del mensaje
+	   	-wide_frames: si se usan longitudes de 4 bytes"""
 
 	msg_name = get_name(message)
-	field_declarations = list(map(field_declaration, message.iter('field')))
-	field_declarations = "\n\t".join(field_declarations)
+	members = []
+	for field in message.iter('field'):
+		members += field_members(field, wide_frames)
+	compact = is_compact_layout(message)
+	if compact:
+		members = sorted(members, key=lambda member: member[2])
+	field_declarations = "\n\t".join(list(map(lambda member: member[0], members)))
 	s = templates.struct_declaration_template.format(
 		msg_name=msg_name, field_declarations=field_declarations)
 	file.write(s)
+	if compact:
+		file.write(templates.struct_size_assertions.format(
+			msg_name=msg_name,
+			size=struct_size([('uint8_t id;', 1, 1)] + members)))
 
-def field_declaration(field):
+def field_members(field, wide_frames):
 
-	"""Retorna la declaración de un campo, el cual es su definición
-	seguida de un ';'.
+	"""Retorna los miembros del struct que corresponden a un campo,
+	como tuplas (declaración, tamaño, alineación). Los tamaños son
+	los de una plataforma de 64 bits.
+	   Parametros:
+	   	-field: el elemento xml del campo
+	   	-wide_frames: si se usan longitudes de 4 bytes"""
+
+	# Valida el encoding del campo antes de generar cualquier código
+	get_encoding(field)
+	members = []
+	if is_sized_string(field):
+		members.append(('uint32_t ' + field.text + '_len;', 4, 4))
+	elif is_stream_field(field):
+		members.append(('stream_len_t ' + field.text + '_len;', 4, 4))
+	elif is_pointer_type(field) and not is_string_type(field):
+		len_size = 4 if wide_frames else 1
+		members.append(('field_len_t ' + field.text + '_len;', len_size, len_size))
+	size, alignment = member_size(field)
+	members.append((field_description(field) + ';', size, alignment))
+	return members
+
+def member_size(field):
+
+	"""Retorna el tamaño y la alineación del miembro principal de un
+	campo en una plataforma de 64 bits.
 	   Parametros:
 	   	-field: el elemento xml del campo"""
 
-	if is_pointer_type(field) and not is_string_type(field):
-		ret = templates.field_description_template.format(
-			field_type='\tuint8_t',
-			field_name=field.text + '_len;',
-			array_def='')
-		ret += '\t' + field_description(field) + ';'
-		return ret
-	return field_description(field) + ';'
+	if is_blob_type(field):
+		return 16, 8
+	if is_pointer_type(field):
+		return 8, 8
+	width = get_type_width(field) // 8
+	if is_array_type(field):
+		return width * int(get_len(field)), width
+	return width, width
+
+def struct_size(members):
+
+	"""Calcula el tamaño de un struct con los miembros dados, en orden,
+	siguiendo las reglas de alineación de C.
+	   Parametros:
+	   	-members: lista de tuplas (declaración, tamaño, alineación)"""
+
+	offset = 0
+	max_alignment = 1
+	for declaration, size, alignment in members:
+		offset = (offset + alignment - 1) // alignment * alignment + size
+		max_alignment = max(max_alignment, alignment)
+	return (offset + max_alignment - 1) // max_alignment * max_alignment
+
+def is_compact_layout(message):
+
+	"""Retorna verdadero si el mensaje tiene el atributo
+	layout="compact".
+	   Parametros:
+	   	-message: el elemento xml del mensaje"""
+
+	layout = message.attrib.get('layout', 'default')
+	if not layout in layouts:
+		raise exceptions.InvalidAttributeValueException(
+			'layout', layout, message)
+	return layout == 'compact'
 
 def field_description(field):
 
@@ -198,25 +663,41 @@ def field_description(field):
 	field_type = get_type(field)
 	field_name = field.text
 	array_def = ''
-	if is_array_type(field):
+	if is_blob_type(field):
+		field_type = 'struct file_blob'
+	elif is_array_type(field):
 		field_type = field_type[0:-2]
 		array_def = '[' + get_len(field) + ']'
 	return templates.field_description_template.format(
 		field_type=field_type, field_name=field_name,
 		array_def=array_def).strip('\n ').strip(' ')
 
-def generate_signatures(file, message):
+def generate_signatures(file, message, inline_codecs, shared_memory):
 
-	"""Genera las declaraciones de las funciones de un mensaje.
+	"""Genera las declaraciones de las funciones de un mensaje. Si las
+	funciones de codificación se definen en el header, solo declara
+	las de envío.
 	   Parametros:
 	   	-file: el archivo al que escribir.
-	   	-message: el elemento xml del mensaje"""
+	   	-message: el elemento xml del mensaje
+	   	-inline_codecs: si las funciones de codificación se definen
+	   		en el header
+	   	-shared_memory: si se genera el canal de memoria compartida"""
 
 	msg_name = get_name(message)
 	create_params = create_parameters(message)
-	s = templates.header_signatures.format(
-		msg_name=msg_name, create_parameters=create_params)
-	file.write(s)
+	if not inline_codecs:
+		file.write(templates.header_signatures.format(
+			msg_name=msg_name, create_parameters=create_params))
+	file.write(templates.send_signatures.format(
+		msg_name=msg_name, create_parameters=create_params))
+	if shared_memory and len(trailing_data_fields(message)) == 0:
+		file.write(templates.shm_send_signature.format(
+			msg_name=msg_name, create_parameters=create_params))
+	for field in stream_fields(message):
+		file.write(templates.stream_field_signatures.format(
+			msg_name=msg_name, field_name=field.text,
+			type=get_type(field)[0:-1]))
 
 def create_parameters(message):
 
@@ -232,6 +713,14 @@ def create_parameters(message):
 	return params
 
 def single_create_parameter(field):
+	if is_sized_string(field):
+		return templates.sized_string_create_parameter.format(
+			field_name=field.text,
+			field_description=field_description(field))
+	if is_stream_field(field):
+		return templates.stream_create_parameter.format(
+			field_name=field.text,
+			field_description=field_description(field))
 	if is_pointer_type(field) and not is_string_type(field):
 		return templates.pointer_create_parameter.format(
 			field_name=field.text,
@@ -256,8 +745,24 @@ def create_parameters_passing(message):
 		params += ','
 	return params
 
+def size_parameters(message):
+
+	"""Retorna la lista de parametros de la función que calcula el
+	tamaño codificado de un mensaje a partir de sus campos. Es igual
+	a la de create_parameters() pero sin la coma final.
+	   Parametros:
+	   	-message: el elemento xml del mensaje"""
+
+	params = create_parameters(message).rstrip(',')
+	if params == '':
+		return 'void'
+	return params
+
+def size_parameters_passing(message):
+	return create_parameters_passing(message).rstrip(',')
+
 def single_create_parameter_pass(field):
-	if is_pointer_type(field) and not is_string_type(field):
+	if is_sized_string(field) or (is_pointer_type(field) and not is_string_type(field)):
 		return templates.pointer_create_parameter_pass.format(
 			field_name=field.text)
 	return field.text
@@ -286,102 +791,641 @@ def is_string_type(field):
 def is_pointer_type(field):
 	return type_contains(field, '*')
 
-def generate_source(root, source, header_name):
+def is_sized_string(field):
+
+	"""Retorna verdadero si el campo es un char* con el atributo
+	sized="true". Estos campos guardan su longitud en el struct junto
+	al puntero, por lo que no se recorren con strlen() al codificarse.
+	   Parametros:
+	   	-field: el elemento xml del campo"""
+
+	if field.attrib.get('sized', 'false') != 'true':
+		return False
+	if not is_string_type(field):
+		raise exceptions.InvalidFieldTypeException(get_type(field), field,
+			'Only char* fields can be sized at {element}'.format(
+				element=exceptions.element_to_xml_string(field)))
+	return True
+
+def is_blob_type(field):
+
+	"""Retorna verdadero si el campo es de tipo blob: datos de un
+	archivo que se envían con sendfile() a continuación del paquete.
+	   Parametros:
+	   	-field: el elemento xml del campo"""
+
+	return field.attrib['type'] == 'blob'
+
+def is_stream_field(field):
 
-	"""Genera el source file.
+	"""Retorna verdadero si el campo tiene el atributo stream="true".
+	Sus datos no forman parte del paquete sino que se envían a
+	continuación de este. Solo pueden ser stream los campos puntero
+	que no sean strings.
 	   Parametros:
-		-root: el elemento root del archivo xml
-		-header: el objeto archivo al que escribir"""
+	   	-field: el elemento xml del campo"""
+
+	if field.attrib.get('stream', 'false') != 'true':
+		return False
+	if not is_pointer_type(field) or is_string_type(field):
+		raise exceptions.InvalidFieldTypeException(get_type(field), field,
+			'Only non-string pointer fields can be streamed at {element}'.format(
+				element=exceptions.element_to_xml_string(field)))
+	return True
+
+def get_encoding(field):
+
+	"""Retorna el encoding de un campo: 'fixed' (por defecto) o
+	'varint'. Con 'varint', los enteros de más de 8 bits y los
+	prefijos de longitud de los campos de largo variable se codifican
+	con la cantidad de bytes justa para su valor.
+	   Parametros:
+	   	-field: el elemento xml del campo"""
+
+	encoding = field.attrib.get('encoding', 'fixed')
+	if not encoding in encodings:
+		raise exceptions.InvalidAttributeValueException(
+			'encoding', encoding, field)
+	if encoding == 'varint' and (is_blob_type(field) or is_stream_field(field)):
+		raise exceptions.InvalidAttributeValueException(
+			'encoding', encoding, field,
+			'Stream and blob fields can\'t be varint encoded at {element}'.format(
+				element=exceptions.element_to_xml_string(field)))
+	return encoding
+
+def get_len_encoding(field):
+
+	"""Retorna cómo se codifica el prefijo de longitud de un campo
+	de largo variable: 'fixed' o 'varint'.
+	   Parametros:
+	   	-field: el elemento xml del campo"""
+
+	return get_encoding(field)
+
+def is_varint_field(field):
+
+	"""Retorna verdadero si los elementos del campo son enteros que
+	se codifican como varint. Los tipos de 8 bits y los strings
+	se mantienen sin codificar.
+	   Parametros:
+	   	-field: el elemento xml del campo"""
+
+	return get_encoding(field) == 'varint' and \
+		not is_string_type(field) and get_type_width(field) > 8
+
+def get_varint_codec(field):
+
+	"""Retorna 'zigzag' para los enteros signados y 'varint' para
+	los no signados.
+	   Parametros:
+	   	-field: el elemento xml del campo"""
+
+	if field.attrib['type'].startswith('int'):
+		return 'zigzag'
+	return 'varint'
+
+def stream_fields(message):
+	return list(filter(is_stream_field, message.iter('field')))
+
+def trailing_data_fields(message):
+
+	"""Retorna los campos cuyos datos se envían a continuación del
+	paquete: los campos stream y los blob.
+	   Parametros:
+	   	-message: el elemento xml del mensaje"""
+
+	return list(filter(
+		lambda field: is_blob_type(field) or is_stream_field(field),
+		message.iter('field')))
+
+def generate_source_start(source, header_name, options):
+
+	"""Escribe el comienzo del source file, anterior a las funciones
+	de los mensajes.
+	   Parametros:
+		-source: el objeto archivo al que escribir
+		-header_name: el nombre del archivo header
+		-options: diccionario con las opciones del generador"""
 
 	source.write(templates.source_includes.format(
 		header_name=header_name))
-	for message in root.iter('message'):
-		generate_functions(source, message)
-	generate_handling_functions(source, root)
+	if not options['inline_codecs']:
+		write_codec_runtime(source, options)
+	if options['capture']:
+		source.write(templates.capture_includes)
+		source.write(templates.capture_functions)
+	else:
+		source.write(templates.no_capture_functions)
+	source.write(templates.arena_functions)
+	source.write(templates.send_buffer_functions)
+	source.write(templates.stream_functions)
+	source.write(templates.blob_functions)
 
-def generate_functions(file, message):
+def generate_source_end(source, summaries, shm_functions, options):
 
-	"""Genera las funciones particulares de un mensaje.
+	"""Escribe el final del source file, posterior a las funciones
+	de los mensajes.
+	   Parametros:
+		-source: el objeto archivo al que escribir
+		-summaries: los resúmenes de los mensajes del protocolo
+		-shm_functions: archivo temporal con las funciones que envían
+			cada mensaje por el canal de memoria compartida
+		-options: diccionario con las opciones del generador"""
+
+	generate_handling_functions(source, summaries)
+	if options['correlation_ids']:
+		source.write(templates.correlation_functions)
+	if options['dispatch']:
+		source.write(templates.dispatch_functions.format(
+			dispatch_switch_cases=dispatch_switch_cases(summaries)))
+	if options['shared_memory']:
+		generate_shm_functions(source, summaries, shm_functions)
+	if options['frame_relay']:
+		source.write(templates.relay_functions.format(
+			trailing_data_cases=relay_trailing_data_cases(summaries)))
+	if options['python_module']:
+		source.write(templates.frame_decoding_functions)
+
+def generate_shm_functions(source, summaries, shm_functions):
+
+	"""Genera el canal de memoria compartida y la función que envía
+	cualquier mensaje por él. Los mensajes con campos stream o blob no
+	pueden enviarse por el canal.
+	   Parametros:
+	   	-source: archivo al que escribir
+	   	-summaries: los resúmenes de los mensajes del protocolo
+	   	-shm_functions: archivo temporal con las funciones que envían
+	   		cada mensaje por el canal"""
+
+	source.write(templates.shm_includes)
+	source.write(templates.shm_functions)
+	copy_spooled_file(shm_functions, source)
+	switch_cases = ''.join(
+		(templates.trailing_data_shm_send_switch_case if summary['trailing_data']
+			else templates.shm_send_switch_case).format(**summary)
+		for summary in summaries)
+	source.write(templates.shm_send_msg_function.format(
+		shm_send_switch_cases=switch_cases))
+
+def relay_trailing_data_cases(summaries):
+
+	"""Retorna los casos del switch que identifica a los mensajes con
+	campos stream o blob, que no pueden reenviarse.
+	   Parametros:
+	   	-summaries: los resúmenes de los mensajes del protocolo"""
+
+	ret = ''.join(
+		templates.relay_trailing_data_case.format(**summary)
+		for summary in summaries if summary['trailing_data'])
+	if ret:
+		ret += templates.relay_trailing_data_return
+	return ret
+
+def dispatch_handler_members(summaries):
+
+	"""Retorna los miembros de la tabla de handlers del dispatcher, uno
+	por cada mensaje que pueda despacharse.
+	   Parametros:
+	   	-summaries: los resúmenes de los mensajes del protocolo"""
+
+	return ''.join(
+		templates.dispatch_handler_member.format(**summary)
+		for summary in summaries if not summary['trailing_data'])
+
+def dispatch_switch_cases(summaries):
+
+	"""Retorna los casos del switch que llama al handler de cada mensaje.
+	Los mensajes con campos stream o blob no pueden despacharse.
+	   Parametros:
+	   	-summaries: los resúmenes de los mensajes del protocolo"""
+
+	return ''.join(
+		(templates.trailing_data_dispatch_switch_case if summary['trailing_data']
+			else templates.dispatch_switch_case).format(**summary)
+		for summary in summaries)
+
+def generate_python_message(file, message, module_name):
+
+	"""Genera el código del módulo de Python de un mensaje: su tipo, la
+	función que lo convierte en un objeto de Python y pack_<mensaje>().
+	Los mensajes con campos stream o blob no se incluyen en el módulo.
+	   Parametros:
+	   	-file: el archivo del módulo al que escribir
+	   	-message: el elemento xml del mensaje
+	   	-module_name: el nombre del módulo"""
+
+	if len(trailing_data_fields(message)) != 0:
+		return
+	msg_name = get_name(message)
+	fields = list(message.iter('field'))
+	# Los argumentos de pack_<mensaje>() son los campos, en orden, y
+	# cada uno puede guardar un objeto a liberar al terminar
+	owned_count = max(len(fields), 1)
+	file.write(templates.python_message_functions.format(
+		msg_name=msg_name,
+		msg_name_upper=msg_name.upper(),
+		module_name=module_name,
+		value_count=len(fields) + 1,
+		arg_count=len(fields),
+		owned_count=owned_count,
+		field_entries=''.join(
+			templates.python_field_entry.format(field_name=field.text)
+			for field in fields),
+		field_values=''.join(
+			templates.python_field_value.format(
+				index=index + 1, value=python_field_value(field))
+			for index, field in enumerate(fields)),
+		parse_fields=''.join(
+			python_parse_field(field, index, owned_count)
+			for index, field in enumerate(fields)),
+		pack_arguments=python_pack_arguments(message),
+		arguments=', '.join(field.text for field in fields)))
+
+def python_pack_arguments(message):
+
+	"""Retorna los argumentos con los que se llama a pack_<mensaje>()
+	desde el módulo de Python, tomados del struct msg.
+	   Parametros:
+	   	-message: el elemento xml del mensaje"""
+
+	return ''.join(
+		'msg.' + parameter.strip() + ', '
+		for parameter in create_parameters_passing(message).split(',')
+		if parameter.strip() != '')
+
+def is_signed_type(field):
+	return field.attrib['type'].startswith('int') or \
+		field.attrib['type'].startswith('char')
+
+def is_bytes_type(field):
+
+	"""Retorna verdadero si el campo es un array o puntero de uint8_t,
+	que el módulo de Python representa como bytes.
+	   Parametros:
+	   	-field: el elemento xml del campo"""
+
+	return field.attrib['type'].startswith('uint8_t')
+
+def python_field_value(field):
+
+	"""Retorna la expresión de C que convierte un campo del struct msg
+	en un objeto de Python: los enteros en int, los strings en str,
+	los arrays y punteros de uint8_t en bytes y el resto de los arrays
+	y punteros en tuplas de int.
+	   Parametros:
+	   	-field: el elemento xml del campo"""
+
+	arguments = dict(field_name=field.text, bits=get_type_width(field),
+		is_signed=int(is_signed_type(field)))
+	if is_array_type(field):
+		arguments['length'] = get_len(field)
+		if field.attrib['type'] == 'char[]':
+			template = templates.python_char_array_value
+		elif is_bytes_type(field):
+			template = templates.python_bytes_array_value
+		else:
+			template = templates.python_int_array_value
+	elif is_sized_string(field):
+		template = templates.python_sized_string_value
+	elif is_string_type(field):
+		template = templates.python_string_value
+	elif is_pointer_type(field):
+		if is_bytes_type(field):
+			template = templates.python_bytes_pointer_value
+		else:
+			template = templates.python_int_pointer_value
+	else:
+		template = templates.python_int_value
+	return template.format(**arguments)
+
+def python_parse_field(field, index, owned_count):
+
+	"""Retorna el código de C que guarda en el struct msg el argumento
+	de pack_<mensaje>() que corresponde a un campo.
+	   Parametros:
+	   	-field: el elemento xml del campo
+	   	-index: la posición del campo en el mensaje
+	   	-owned_count: el tamaño del array de objetos a liberar"""
+
+	arguments = dict(field_name=field.text, index=index,
+		owned_count=owned_count, bits=get_type_width(field),
+		is_signed=int(is_signed_type(field)))
+	if is_array_type(field):
+		arguments['length'] = get_len(field)
+		if field.attrib['type'] == 'char[]':
+			template = templates.python_parse_char_array_field
+		else:
+			template = templates.python_parse_int_array_field
+	elif is_sized_string(field):
+		template = templates.python_parse_sized_string_field
+	elif is_string_type(field):
+		template = templates.python_parse_string_field
+	elif is_pointer_type(field):
+		template = templates.python_parse_pointer_field
+	else:
+		template = templates.python_parse_int_field
+	return template.format(**arguments)
+
+def generate_python_end(file, summaries, module_name):
+
+	"""Escribe el final del módulo de Python, posterior a todos los
+	mensajes: la decodificación de paquetes, la tabla de funciones y
+	la inicialización del módulo.
+	   Parametros:
+	   	-file: el archivo del módulo al que escribir
+	   	-summaries: los resúmenes de los mensajes del protocolo
+	   	-module_name: el nombre del módulo"""
+
+	decodable = [summary for summary in summaries
+		if not summary['trailing_data']]
+	trailing_data_cases = ''.join(
+		templates.python_trailing_data_case.format(**summary)
+		for summary in summaries if summary['trailing_data'])
+	if trailing_data_cases:
+		trailing_data_cases += templates.python_trailing_data_return
+	file.write(templates.python_module_end.format(
+		module_name=module_name,
+		trailing_data_cases=trailing_data_cases,
+		to_python_cases=''.join(
+			templates.python_to_python_case.format(**summary)
+			for summary in decodable),
+		message_types=''.join(
+			templates.python_message_type.format(**summary)
+			for summary in decodable),
+		pack_methods=''.join(
+			templates.python_pack_method.format(**summary)
+			for summary in decodable),
+		add_message_ids=''.join(
+			templates.python_add_message_id.format(**summary)
+			for summary in summaries)))
+
+def generate_codec_functions(file, arguments, inline_codecs):
+
+	"""Genera las funciones de un mensaje que calculan su tamaño, lo
+	codifican, decodifican, inicializan y destruyen.
+	   Parametros:
+	   	-file: archivo al que escribir
+	   	-arguments: los argumentos de los templates del mensaje
+	   		(ver message_template_arguments())
+	   	-inline_codecs: si se generan como static inline"""
+
+	file.write(templates.message_functions_template.format(
+		storage='static inline ' if inline_codecs else '',
+		inline='inline ' if inline_codecs else '',
+		**arguments))
+
+def generate_send_functions(file, message, arguments):
+
+	"""Genera las funciones de un mensaje que lo envían por un socket.
 	   Parametros:
 	   	-file: archivo al que escribir
+	   	-message: el elemento xml del mensaje
+	   	-arguments: los argumentos de los templates del mensaje
+	   		(ver message_template_arguments())"""
+
+	msg_name = get_name(message)
+	file.write(templates.message_send_functions_template.format(
+		**arguments))
+	for field in stream_fields(message):
+		file.write(templates.stream_field_functions.format(
+			msg_name=msg_name, field_name=field.text,
+			type=get_type(field)[0:-1],
+			bits=get_type_width(field)))
+
+def message_template_arguments(message):
+
+	"""Retorna los argumentos con los que se completan los templates
+	de las funciones de un mensaje.
+	   Parametros:
 	   	-message: el elemento xml del mensaje"""
 
 	msg_name = get_name(message)
 	create_params = create_parameters(message)
-	ntoh = net_to_host_handling(message)
-	hton = host_to_net_handling(message)
 	params_passing = create_parameters_passing(message)
+	# destroy_<mensaje>() solo accede al mensaje si tiene campos que liberar
 	optional_struct_casting = ""
 	fields = list(message.iter('field'))
-	pointer_fields = list(filter(lambda field: is_pointer_type(field), fields))
-	if len(pointer_fields) != 0:
+	destroyed_fields = destroy_fields(message)
+	if destroyed_fields != '':
 		optional_struct_casting = templates.optional_struct_casting.format(
 			msg_name=msg_name)
-	s = templates.message_functions_template.format(
+	size_struct_casting = ""
+	size_fields = list(filter(
+		lambda field: is_pointer_type(field) or is_blob_type(field) or is_varint_field(field),
+		fields))
+	if len(size_fields) != 0:
+		size_struct_casting = templates.optional_struct_casting.format(
+			msg_name=msg_name)
+	stream_struct_casting = ""
+	if len(trailing_data_fields(message)) != 0:
+		stream_struct_casting = templates.optional_struct_casting.format(
+			msg_name=msg_name)
+	return dict(
 		msg_name=msg_name, msg_name_upper=msg_name.upper(),
 		optional_struct_casting=optional_struct_casting,
+		size_struct_casting=size_struct_casting,
 		create_parameters=create_params,
-		network_to_host=ntoh,
-		host_to_network=hton,
 		parameter_pass=params_passing,
-		add_field_sizes=add_field_sizes(message),
+		size_parameters=size_parameters(message),
+		size_parameter_pass=size_parameters_passing(message),
+		add_field_sizes=add_field_sizes(message, 'msg->'),
+		add_arg_sizes=add_field_sizes(message, ''),
 		decode_fields=decode_fields(message),
-		encode_fields=encode_fields(message),
-		destroy_fields=destroy_fields(message),
+		encode_fields=encode_fields(message, 'msg->'),
+		encode_arg_fields=encode_fields(message, ''),
+		stream_struct_casting=stream_struct_casting,
+		send_msg_streams=send_streams(message, 'msg->'),
+		send_arg_streams=send_streams(message, ''),
+		destroy_fields=destroyed_fields,
 		init_fields=init_fields(message))
-	file.write(s)
 
-def add_field_sizes(message):
-	return '\n'.join(list(map(add_field_size, message.iter('field'))))
+def add_field_sizes(message, source):
 
-def add_field_size(field):
-	if is_array_type(field):
+	"""Retorna el código que suma al tamaño codificado el de cada campo.
+	   Parametros:
+	   	-message: el elemento xml del mensaje
+	   	-source: prefijo con el que se accede a los campos. Es 'msg->'
+	   		para leerlos del struct del mensaje o '' para leerlos
+	   		de los parametros de la función."""
+
+	field_sizes = list(map(
+		lambda field: add_field_size(field, source),
+		message.iter('field')))
+	trailing_sizes = list(map(
+		lambda field: trailing_data_size(field, source),
+		trailing_data_fields(message)))
+	if trailing_sizes:
+		field_sizes.append(templates.add_trailing_data_size.format(
+			trailing_data_sizes=' + '.join(trailing_sizes)))
+	return '\n'.join(field_sizes)
+
+def trailing_data_size(field, source):
+
+	"""Retorna la expresión con la cantidad de bytes que ocupan los
+	datos de un campo stream o blob a continuación del paquete.
+	   Parametros:
+	   	-field: el elemento xml del campo
+	   	-source: prefijo con el que se accede a los campos"""
+
+	if is_blob_type(field):
+		return templates.blob_data_size.format(
+			field_name=field.text, source=source)
+	return templates.stream_data_size.format(
+		field_name=field.text, source=source,
+		type=get_type(field)[0:-1])
+
+def add_field_size(field, source):
+	if is_blob_type(field):
+		return templates.add_blob_field_size.format(
+			field_name=field.text,
+			source=source)
+	elif is_varint_field(field):
+		return varint_field_code(field, source,
+			templates.add_varint_field_size,
+			templates.add_varint_array_field_size,
+			templates.add_varint_pointer_field_size)
+	elif is_array_type(field):
 		return templates.add_array_field_size.format(
 			type=get_type(field)[0:-2], length=get_len(field))
+	elif is_sized_string(field):
+		return templates.add_sized_string_field_size.format(
+			field_name=field.text,
+			source=source,
+			len_encoding=get_len_encoding(field))
 	elif is_string_type(field):
 		return templates.add_string_field_size.format(
-			field_name=field.text)
+			field_name=field.text,
+			source=source,
+			len_encoding=get_len_encoding(field))
+	elif is_stream_field(field):
+		return templates.add_stream_field_size.format(
+			field_name=field.text,
+			source=source,
+			type=get_type(field)[0:-1])
 	elif is_pointer_type(field):
 		return templates.add_pointer_field_size.format(
 			field_name=field.text,
+			source=source,
+			len_encoding=get_len_encoding(field),
 			type=get_type(field)[0:-1])
 	else:
 		return templates.add_simple_field_size.format(
 			type=get_type(field))
 
 def decode_fields(message):
+
+	"""Retorna el código que decodifica todos los campos de un mensaje
+	sin leer más allá de los data_size bytes del paquete. Los campos de
+	tamaño fijo consecutivos se verifican juntos antes de leerlos y los
+	varint luego de leerlos, ya que su tamaño depende de su valor. El
+	resto de los campos verifica sus prefijos de longitud y sus datos.
+	   Parametros:
+	   	-message: el elemento xml del mensaje"""
+
 	pointers_to_free_on_error = []
 	field_decodes = []
+	fixed_decodes = []
+	fixed_size = 0
+	unchecked_varints = False
 	for field in message.iter('field'):
-		field_decodes.append(decode_field(field, pointers_to_free_on_error))
+		size = fixed_decoded_size(field)
+		varint = size is None and is_varint_field(field) and not is_pointer_type(field)
+		free_resources = free_decode_pointers(pointers_to_free_on_error)
+		if size is None and fixed_decodes:
+			field_decodes.append(templates.decode_size_check.format(
+				size=fixed_size, free_resources=free_resources))
+			field_decodes += fixed_decodes
+			fixed_decodes, fixed_size = [], 0
+		if not varint and unchecked_varints:
+			field_decodes.append(templates.decode_varint_check.format(
+				free_resources=free_resources))
+			unchecked_varints = False
+		code = decode_field(field, pointers_to_free_on_error)
+		if size is None:
+			field_decodes.append(code)
+			unchecked_varints = unchecked_varints or varint
+		else:
+			fixed_decodes.append(code)
+			fixed_size += size
+	free_resources = free_decode_pointers(pointers_to_free_on_error)
+	if fixed_decodes:
+		field_decodes.append(templates.decode_size_check.format(
+			size=fixed_size, free_resources=free_resources))
+		field_decodes += fixed_decodes
+	if unchecked_varints:
+		field_decodes.append(templates.decode_varint_check.format(
+			free_resources=free_resources))
 	return ''.join(field_decodes)
 
-def decode_field(field, pointers_to_free_on_error):
+def fixed_decoded_size(field):
+
+	"""Retorna la cantidad de bytes que ocupa un campo en el paquete si
+	no depende de su valor, o None si es de largo variable.
+	   Parametros:
+	   	-field: el elemento xml del campo"""
+
+	if is_blob_type(field) or is_stream_field(field):
+		return 4
+	if is_pointer_type(field) or is_varint_field(field):
+		return None
+	width = get_type_width(field) // 8
 	if is_array_type(field):
+		return width * int(get_len(field))
+	return width
+
+def decode_field(field, pointers_to_free_on_error):
+	if is_blob_type(field):
+		return templates.decode_blob_field.format(
+			field_name=field.text)
+	elif is_varint_field(field):
+		ret = varint_field_code(field, '',
+			templates.decode_varint_field,
+			templates.decode_varint_array_field,
+			templates.decode_varint_pointer_field,
+			free_resources=free_decode_pointers(pointers_to_free_on_error))
+		if is_pointer_type(field):
+			pointers_to_free_on_error.append(field.text)
+		return ret
+	elif is_array_type(field):
 		return templates.decode_array_field.format(
 			field_name=field.text,
 			type=get_type(field)[0:-2],
+			bits=get_type_width(field),
 			length=get_len(field))
+	elif is_sized_string(field):
+		ret = templates.decode_sized_string_field.format(
+			field_name=field.text,
+			len_encoding=get_len_encoding(field),
+			free_resources=free_decode_pointers(pointers_to_free_on_error))
+		pointers_to_free_on_error.append(field.text)
+		return ret
 	elif is_string_type(field):
 		ret = templates.decode_string_field.format(
 			field_name=field.text,
+			len_encoding=get_len_encoding(field),
 			free_resources=free_decode_pointers(pointers_to_free_on_error))
 		pointers_to_free_on_error.append(field.text)
 		return ret
+	elif is_stream_field(field):
+		return templates.decode_stream_field.format(
+			field_name=field.text)
 	elif is_pointer_type(field):
 		ret = templates.decode_pointer_field.format(
 			field_name=field.text,
+			len_encoding=get_len_encoding(field),
 			type=get_type(field)[0:-1],
+			bits=get_type_width(field),
 			free_resources=free_decode_pointers(pointers_to_free_on_error))
 		pointers_to_free_on_error.append(field.text)
 		return ret
 	else:
 		return templates.decode_simple_field.format(
 			field_name=field.text,
-			type=get_type(field))
+			type=get_type(field),
+			bits=get_type_width(field))
 
 def free_decode_pointers(pointers_to_free_on_error):
-	return '\n'.join(
+	return '\n\t\t'.join(
 		list(
 			map(
 				lambda x: templates.free_decode_pointer.format(field_name=x),
@@ -390,28 +1434,119 @@ def free_decode_pointers(pointers_to_free_on_error):
 		)
 	)
 
-def encode_fields(message):
-	return '\n'.join(list(map(encode_field, message.iter('field'))))
+def encode_fields(message, source):
 
-def encode_field(field):
-	if is_array_type(field):
+	"""Retorna el código que codifica todos los campos de un mensaje.
+	   Parametros:
+	   	-message: el elemento xml del mensaje
+	   	-source: prefijo con el que se accede a los campos, igual que
+	   		en add_field_sizes()."""
+
+	return '\n'.join(list(map(
+		lambda field: encode_field(field, source),
+		message.iter('field'))))
+
+def encode_field(field, source):
+	if is_blob_type(field):
+		return templates.encode_blob_field.format(
+			field_name=field.text,
+			source=source)
+	elif is_varint_field(field):
+		return varint_field_code(field, source,
+			templates.encode_varint_field,
+			templates.encode_varint_array_field,
+			templates.encode_varint_pointer_field)
+	elif is_array_type(field):
 		return templates.encode_array_field.format(
 			field_name=field.text,
+			source=source,
 			type=get_type(field)[0:-2],
-			length=get_len(field),
-			host_to_network='')
+			bits=get_type_width(field),
+			length=get_len(field))
+	elif is_sized_string(field):
+		return templates.encode_sized_string_field.format(
+			field_name=field.text,
+			source=source,
+			len_encoding=get_len_encoding(field))
 	elif is_string_type(field):
 		return templates.encode_string_field.format(
-			field_name=field.text)
+			field_name=field.text,
+			source=source,
+			len_encoding=get_len_encoding(field))
+	elif is_stream_field(field):
+		return templates.encode_stream_field.format(
+			field_name=field.text,
+			source=source)
 	elif is_pointer_type(field):
 		return templates.encode_pointer_field.format(
 			field_name=field.text,
-			type=get_type(field)[0:-1])
+			source=source,
+			len_encoding=get_len_encoding(field),
+			type=get_type(field)[0:-1],
+			bits=get_type_width(field))
 	else:
 		return templates.encode_simple_field.format(
 			field_name=field.text,
+			source=source,
 			type=get_type(field),
-			host_to_network='')
+			bits=get_type_width(field))
+
+def varint_field_code(field, source, simple_template,
+		array_template, pointer_template, free_resources=''):
+
+	"""Retorna el código de un campo varint usando el template que
+	corresponda a su tipo (elemento único, array o puntero).
+	   Parametros:
+	   	-field: el elemento xml del campo
+	   	-source: prefijo con el que se accede a los campos, igual que
+	   		en add_field_sizes()
+	   	-simple_template, array_template, pointer_template: los
+	   		templates para cada tipo de campo
+	   	-free_resources: código que libera los punteros ya alocados,
+	   		usado al decodificar"""
+
+	if is_array_type(field):
+		template = array_template
+		field_type = get_type(field)[0:-2]
+		length = get_len(field)
+	elif is_pointer_type(field):
+		template = pointer_template
+		field_type = get_type(field)[0:-1]
+		length = None
+	else:
+		template = simple_template
+		field_type = get_type(field)
+		length = None
+	return template.format(
+		field_name=field.text,
+		source=source,
+		type=field_type,
+		length=length,
+		codec=get_varint_codec(field),
+		free_resources=free_resources)
+
+def send_streams(message, source):
+
+	"""Retorna el código que envía los datos de los campos stream y
+	blob de un mensaje luego de enviado el paquete.
+	   Parametros:
+	   	-message: el elemento xml del mensaje
+	   	-source: prefijo con el que se accede a los campos, igual que
+	   		en add_field_sizes()."""
+
+	return '\n'.join(list(map(
+		lambda field: send_trailing_data(field, source),
+		trailing_data_fields(message))))
+
+def send_trailing_data(field, source):
+	if is_blob_type(field):
+		return templates.send_blob_field.format(
+			field_name=field.text,
+			source=source)
+	return templates.send_stream_field.format(
+		field_name=field.text,
+		source=source,
+		bits=get_type_width(field))
 
 def init_fields(message):
 	pointers_to_free_on_error = []
@@ -426,12 +1561,21 @@ def init_field(field, pointers_to_free_on_error):
 			field_name=field.text,
 			type=get_type(field)[0:-2],
 			length=get_len(field))
+	elif is_sized_string(field):
+		ret = templates.init_sized_string_field.format(
+			field_name=field.text,
+			free_resources=free_init_pointers(pointers_to_free_on_error))
+		pointers_to_free_on_error.append(field.text)
+		return ret
 	elif is_string_type(field):
 		ret = templates.init_string_field.format(
 			field_name=field.text,
 			free_resources=free_init_pointers(pointers_to_free_on_error))
 		pointers_to_free_on_error.append(field.text)
 		return ret
+	elif is_stream_field(field):
+		return templates.init_stream_field.format(
+			field_name=field.text)
 	elif is_pointer_type(field):
 		ret = templates.init_pointer_field.format(
 			field_name=field.text,
@@ -443,137 +1587,36 @@ def init_field(field, pointers_to_free_on_error):
 		return templates.init_simple_field.format(field_name=field.text)
 
 def free_init_pointers(pointers_to_free_on_error):
-	return '\n'.join(list(map(
-				lambda x: templates.destroy_field.format(field_name=x),
+	return '\n\t\t'.join(list(map(
+				lambda x: templates.free_init_pointer.format(field_name=x),
 				pointers_to_free_on_error
 			)))	
 
 def destroy_fields(message):
 	l = []
 	for field in message.iter('field'):
-		if is_pointer_type(field):
+		if is_pointer_type(field) and not is_stream_field(field):
 			l.append(destroy_field(field))
 	return '\n\t'.join(l)
 
 def destroy_field(field):
 	return templates.destroy_field.format(field_name=field.text)
 
-def get_ntoh_converter(field):
+def get_type_width(field):
 
-	"""Retorna la función de conversión a usar en el o los elementos
-	de un campo para ir de network byte order a host byte order.
+	"""Retorna el tamaño en bits del tipo base de un campo (8, 16,
+	32 o 64), utilizado para elegir las funciones que lo escriben
+	y leen en network byte order.
 	   Parametros:
 	   	-field: el elemento xml del campo"""
 
 	if is_uint16(field):
-		return templates.uint16_ntoh
+		return 16
 	elif is_uint32(field):
-		return templates.uint32_ntoh
+		return 32
 	elif is_uint64(field):
-		return templates.uint64_ntoh
-
-def get_hton_converter(field):
-
-	"""Retorna la función de conversión a usar en el o los elementos
-	de un campo para ir de host byte order a network byte order.
-	   Parametros:
-	   	-field: el elemento xml del campo"""
-
-	if is_uint16(field):
-		return templates.uint16_hton
-	elif is_uint32(field):
-		return templates.uint32_hton
-	elif is_uint64(field):
-		return templates.uint64_hton
-
-def net_to_host_handling(message):
-
-	"""Retorna el string que convierte los campos de un mensaje
-	de network byte order a host byte order.
-	   Parametros:
-	   	-message: el elemento xml del mensaje"""
-
-	return convert(message, get_ntoh_converter)
-
-def host_to_net_handling(message):
-
-	"""Retorna el string que convierte los campos de un mensaje
-	de host byte order a network byte order.
-	   Parametros:
-	   	-message: el elemento xml del mensaje"""
-
-	return convert(message, get_hton_converter)
-
-def convert(message, convert_getter):
-
-	"""Construye y retorna el string que convierte los campos de un 
-	mensaje de una representación a otra (host a network o network 
-	a host). Hacia qué representación se realiza la conversión 
-	depende del parametro 'convert_getter', que debe ser 
-	'get_ntoh_converter' o 'get_hton_converter'.
-	   Parametros:
-	   	-message: el elemento xml del mensaje
-	   	-convert_getter: función que toma el campo de un mensaje y
-	   		devuelve 'htons', 'htonl', 'ntohs' o 'ntohl', según
-	   		sea pertinente. Debe ser 'get_ntoh_converter' o 
-	   		'get_hton_converter'."""
-
-	ret = ''
-	for field in message.iter('field'):
-		if should_be_converted(field):
-			convertion = convert_getter(field)
-			field_name = field.text
-			if is_array_type(field):
-				s = array_convertion(field_name, convertion, field)
-			elif is_pointer_type(field):
-				s = pointer_convertion(field_name, convertion)
-			else:
-				s = simple_field_convertion(field_name, convertion)
-			ret += '\n\t' + s
-	return ret
-
-def array_convertion(field_name, convertion, field):
-
-	"""Retorna el bloque de código que aplica la función
-	'convertion' a todos los elementos de un campo de tipo
-	array.
-	   Parametros:
-	   	-field_name: nombre del campo
-	   	-convertion: función a aplicar a cada elemento. Debe ser
-	   	'htons', 'htonl', 'ntohs' o 'ntohl'
-	   	-field: el elemento xml del campo"""
-
-	lng = get_len(field)
-	return templates.array_field_converter.format(
-					field_name=field_name, len=lng,
-					convertion=convertion)
-
-def pointer_convertion(field_name, convertion):
-	return templates.pointer_field_converter.format(
-		field_name=field_name,
-		convertion=convertion)
-
-def simple_field_convertion(field_name, convertion):
-
-	"""Retorna la linea de código que aplica la función
-	'convertion' a un campo que no sea de tipo array.
-	   Parametros:
-	   	-field_name: nombre del campo
-	   	-convertion: función a aplicar al elemento. Debe ser
-	   	'htons', 'htonl', 'ntohs' o 'ntohl'"""
-
-	return templates.simple_field_converter.format(
-				field_name=field_name, convertion=convertion
-			)
-
-def should_be_converted(field):
-
-	"""Retorna si un campo necesita ser convertido antes de ser
-	transmitido por la red o al ser recibido de la misma.
-	   Parametros:
-	   	-field: el elemento xml del campo"""
-
-	return is_uint16(field) or is_uint32(field) or is_uint64(field)
+		return 64
+	return 8
 
 def is_uint16(field):
 
@@ -596,51 +1639,113 @@ def is_uint32(field):
 def is_uint64(field):
 	return type_contains(field, '64')
 
-def generate_handling_functions(file, root):
+def generate_handling_functions(file, summaries):
 
 	"""Genera las funciones utilizadas para manipular mensajes,
 	por ejemplo, decode.
 	   Parametros:
 	   	-file: archivo al que escribir
-	   	-root: elemento root del archivo xml"""
+	   	-summaries: los resúmenes de los mensajes del protocolo"""
 
 	s = templates.msg_handling_functions.format(
-		decode_switch_cases=decode_switch_cases(root),
-		destroy_switch_cases=destroy_switch_cases(root),
-		bytes_needed_switch_cases=bytes_needed_switch_cases(root),
-		send_switch_cases=send_switch_cases(root),
-		struct_size_switch_cases=struct_size_switch_cases(root),
-		number_of_messages=len(list(root.iter('message'))),
-		struct_sizes=(',\n' + '\t'*5).join(list(map(get_struct_sizeof, root.iter('message')))))
+		decode_switch_cases=switch_cases(summaries, templates.decode_switch_case),
+		destroy_switch_cases=switch_cases(summaries, templates.destroy_switch_case),
+		bytes_needed_switch_cases=switch_cases(summaries, templates.bytes_needed_switch_case),
+		send_switch_cases=switch_cases(summaries, templates.send_switch_cases),
+		struct_size_switch_cases=switch_cases(summaries, templates.struct_size_switch_case),
+		number_of_messages=len(summaries),
+		struct_sizes=(',\n' + '\t'*5).join(map(get_struct_sizeof, summaries)))
 	file.write(s)
 
-def decode_switch_cases(root):
-	return switch_cases(root, templates.decode_switch_case)	
+def switch_cases(summaries, template):
+	return ''.join('\n\t' + template.format(**summary) for summary in summaries)
 
-def destroy_switch_cases(root):
-	return switch_cases(root, templates.destroy_switch_case)
+def get_struct_sizeof(summary):
+	return templates.struct_size.format(**summary)
 
-def bytes_needed_switch_cases(root):
-	return switch_cases(root, templates.bytes_needed_switch_case)
+def generate_job(xml_source, arguments, generator_hash):
 
-def send_switch_cases(root):
-	return switch_cases(root, templates.send_switch_cases)
+	"""Genera un protocolo a partir de los argumentos de consola. Se
+	ejecuta en los procesos del pool, por lo que retorna los errores
+	en lugar de escribirlos.
+	   Parametros:
+	   	-xml_source: dirección del archivo xml fuente
+	   	-arguments: los argumentos de consola parseados
+	   	-generator_hash: el hash del código del generador
+	   Retorna una tupla (generado, error): si se generaron los
+	   archivos y el mensaje de error, None si no hubo."""
 
-def struct_size_switch_cases(root):
-	return switch_cases(root, templates.struct_size_switch_case)
+	try:
+		generated = generate(xml_source, arguments.output,
+			arguments.wide_frames, arguments.sized_strings,
+			arguments.compact_structs, arguments.inline_codecs,
+			arguments.dispatch, arguments.correlation_ids,
+			arguments.shared_memory, arguments.frame_relay,
+			arguments.capture, arguments.python_module, arguments.force,
+			generator_hash)
+		return generated, None
+	except exceptions.GeneratorException as error:
+		return False, error.message
+	except (ET.ParseError, OSError) as error:
+		return False, str(error)
+	except Exception as error:
+		# Un error inesperado en un xml no debe interrumpir al resto
+		return False, '{error_type}: {error}'.format(
+			error_type=type(error).__name__, error=error)
+
+def read_manifest(manifest_path):
+
+	"""Retorna los archivos xml listados en un manifiesto: uno por
+	línea, relativos al directorio del manifiesto. Se ignoran las
+	líneas vacías y las que empiezan con '#'.
+	   Parametros:
+	   	-manifest_path: dirección del manifiesto"""
 
-def switch_cases(root, template):
+	base_path = path.dirname(manifest_path)
+	with open(manifest_path) as manifest:
+		lines = [line.strip() for line in manifest]
+	return [path.join(base_path, line) for line in lines
+		if line and not line.startswith('#')]
 
-	ret = ''
-	for message in root.iter('message'):
-		msg_name = get_name(message)
-		ret += '\n\t' + template.format(
-			msg_name=msg_name,
-			msg_name_upper=msg_name.upper())
-	return ret
+def find_duplicate_outputs(xml_sources, provided_path):
 
-def get_struct_sizeof(message):
-	return templates.struct_size.format(msg_name=get_name(message))
+	"""Retorna una lista de tuplas (xml, error) con los xml que
+	generarían los mismos archivos que otro, ya que sus nombres se
+	toman del elemento root. Los xml que no pueden leerse se omiten:
+	su error se reporta al generarlos.
+	   Parametros:
+	   	-xml_sources: direcciones de los archivos xml fuente
+	   	-provided_path: dirección dada por el usuario con 
+			el flag '-o'."""
+
+	sources_by_path = {}
+	for xml_source in xml_sources:
+		try:
+			with open(xml_source, 'rb') as xml_file:
+				_, root = next(ET.iterparse(xml_file, events=('start',)))
+		except (ET.ParseError, OSError):
+			continue
+		header_path, _ = get_file_paths(root, provided_path)
+		sources_by_path.setdefault(header_path, []).append(xml_source)
+
+	errors = []
+	for header_path, sources in sources_by_path.items():
+		if len(sources) > 1:
+			errors += [(xml_source, '{path} is also generated from {others}'.format(
+				path=header_path, others=', '.join(other for other in sources if other is not xml_source)))
+				for xml_source in sources]
+	return errors
+
+def positive_int(value):
+
+	"""Convierte un parametro de consola a un entero mayor a 0.
+	   Parametros:
+	   	-value: el texto del parametro"""
+
+	number = int(value)
+	if number < 1:
+		raise argparse.ArgumentTypeError('must be at least 1')
+	return number
 
 def parse_cli_arguments():
 
@@ -648,16 +1753,92 @@ def parse_cli_arguments():
 
 	parser = argparse.ArgumentParser(
 		description='C protocol generator.')
-	parser.add_argument('xml_source',
-		help='XML definition of the protocol')
+	parser.add_argument('xml_sources', nargs='*', metavar='xml_source',
+		help='XML definitions of the protocols')
+	parser.add_argument('--manifest', action='append', default=[],
+		help='File listing one XML definition per line, relative to the file.')
+	parser.add_argument('-j', '--jobs', type=positive_int, default=os.cpu_count() or 1,
+		help='Number of protocols generated concurrently.')
+	parser.add_argument('--force',
+		help='Regenerate the protocols even if their XML and options did not change.',
+		action='store_true')
 	parser.add_argument('-o', '--output',
 		help='Path for the generated .c and .h files.',
 		default='')
+	parser.add_argument('-w', '--wide-frames',
+		help='Use 4 byte frame and field lengths instead of 2 byte ones.',
+		action='store_true')
+	parser.add_argument('-s', '--sized-strings',
+		help='Store the length of every char* field next to its pointer.',
+		action='store_true')
+	parser.add_argument('-c', '--compact-structs',
+		help='Reorder struct members to minimize padding.',
+		action='store_true')
+	parser.add_argument('-i', '--inline',
+		help='Define the message encoding functions in the header as static inline.',
+		action='store_true', dest='inline_codecs')
+	parser.add_argument('-d', '--dispatch',
+		help='Generate a typed message dispatcher for the sockets.h server.',
+		action='store_true')
+	parser.add_argument('-r', '--correlation-ids',
+		help='Add a correlation id to every frame and generate a request multiplexer.',
+		action='store_true')
+	parser.add_argument('-m', '--shared-memory',
+		help='Generate a shared memory ring buffer channel.',
+		action='store_true')
+	parser.add_argument('-f', '--frame-relay',
+		help='Generate functions that route and relay frames without decoding them.',
+		action='store_true')
+	parser.add_argument('-t', '--capture',
+		help='Allow capturing the sent and received traffic to a file.',
+		action='store_true')
+	parser.add_argument('-p', '--python',
+		help='Generate a CPython extension module wrapping the message codecs.',
+		action='store_true', dest='python_module')
 	return parser.parse_args()
 
 def main():
 	arguments = parse_cli_arguments()
-	generate(arguments.xml_source, arguments.output)
+	xml_sources = list(arguments.xml_sources)
+	try:
+		for manifest_path in arguments.manifest:
+			xml_sources += read_manifest(manifest_path)
+	except OSError as error:
+		stderr.write(str(error) + '\n')
+		exit(1)
+	if len(xml_sources) == 0:
+		stderr.write('No XML definitions given\n')
+		exit(1)
+	if len(xml_sources) > 1 and not (arguments.output == '' or arguments.output.endswith('/')):
+		stderr.write('The output must be a directory when generating several protocols\n')
+		exit(1)
+
+	duplicates = find_duplicate_outputs(xml_sources, arguments.output)
+	for xml_source, error in duplicates:
+		stderr.write('{source}: {error}\n'.format(source=xml_source, error=error))
+	if duplicates:
+		exit(1)
+
+	generator_hash = generator_fingerprint()
+	if len(xml_sources) == 1 or arguments.jobs <= 1:
+		results = [generate_job(xml_source, arguments, generator_hash)
+			for xml_source in xml_sources]
+	else:
+		with ProcessPoolExecutor(max_workers=arguments.jobs) as pool:
+			results = list(pool.map(generate_job, xml_sources,
+				[arguments] * len(xml_sources),
+				[generator_hash] * len(xml_sources)))
+
+	errors = [(xml_source, error)
+		for xml_source, (generated, error) in zip(xml_sources, results)
+		if error is not None]
+	if len(xml_sources) == 1 and errors:
+		stderr.write(errors[0][1] + '\n')
+	else:
+		for xml_source, error in errors:
+			stderr.write('{source}: {error}\n'.format(source=xml_source, error=error))
+	if errors:
+		exit(1)
 
 if __name__ == '__main__':
 	main()
\ No newline at end of file
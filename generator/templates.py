@@ -1,24 +1,827 @@
 
 header_includes = """#include <stdint.h> 
+#include <stddef.h>
 
 """
 
-source_includes = """#include <stdint.h>
+# Con la opción --inline del generador, las funciones de codificación
+# se definen en el header como static inline y este necesita además:
+
+inline_includes = """
 #include <string.h>
 #include <stdlib.h>
 #include <endian.h>
-#include <netinet/in.h>
-#include <sys/socket.h>
-#include "{header_name}"
+"""
+
+# Con la opción --dispatch, el protocolo se integra con el servidor de
+# sockets.h y el header necesita sus definiciones.
+
+dispatch_includes = """#include "sockets.h"
+"""
+
+# Con la opción --frame-relay, el reenvío de paquetes usa relay_bytes()
+# de sockets.h. Si también se usa --dispatch, el include ya está.
+
+relay_includes = dispatch_includes
+
+# Con la opción --correlation-ids, el header declara el multiplexor de
+# pedidos, que usa pthreads.
+
+correlation_includes = """#include <pthread.h>
+"""
+
+# Formato de los paquetes. Por defecto la longitud del paquete y el prefijo
+# de longitud de los campos de largo variable ocupan 2 bytes. Con la opción
+# --wide-frames del generador ocupan 4, permitiendo mensajes más grandes.
+# La cantidad de elementos de los campos stream, cuyos datos no forman
+# parte del paquete, ocupa siempre 4 bytes.
+
+frame_types = """
+typedef uint16_t frame_len_t;
+typedef uint8_t field_len_t;
+typedef uint32_t stream_len_t;
+"""
 
+wide_frame_types = """
+typedef uint32_t frame_len_t;
+typedef uint32_t field_len_t;
+typedef uint32_t stream_len_t;
+"""
+
+frame_defines = """
+#define FRAME_LEN_SIZE 2
+#define FIELD_LEN_SIZE 2
 #define MAX_STRING_SIZE 2048
 #define MAX_PTR_COUNT 1024
 #define MAX_ENCODED_SIZE 65535
+#define _put_frame_len _put_16
+#define _get_frame_len _get_16
+#define _put_field_len _put_16
+#define _get_field_len _get_16
+
+// frame_len_t y field_len_t no pueden superar los límites
+#define _frame_too_big(len) 0
+#define _ptr_count_too_big(len) 0
+"""
+
+wide_frame_defines = """
+#define FRAME_LEN_SIZE 4
+#define FIELD_LEN_SIZE 4
+#define MAX_ENCODED_SIZE (INT32_MAX - FRAME_HEADER_SIZE)
+#define MAX_STRING_SIZE MAX_ENCODED_SIZE
+#define MAX_PTR_COUNT MAX_ENCODED_SIZE
+#define _put_frame_len _put_32
+#define _get_frame_len _get_32
+#define _put_field_len _put_32
+#define _get_field_len _get_32
+#define _frame_too_big(len) ((len) > MAX_ENCODED_SIZE)
+#define _ptr_count_too_big(len) ((len) > MAX_PTR_COUNT)
+"""
+
+source_includes = """#ifndef _GNU_SOURCE
+#define _GNU_SOURCE
+#endif
+
+#include <stdint.h>
+#include <string.h>
+#include <stdlib.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <endian.h>
+#include <netinet/in.h>
+#include <sys/socket.h>
+#include <sys/sendfile.h>
+#include <sys/mman.h>
+#include "{header_name}"
+
+#define MAX_STACK_FRAME_SIZE 65535
 
 int _send_full_msg(int, uint8_t*, int);
+int recv_n_bytes(int, void*, int);
 int get_max_msg_size();
 """
 
+byte_order_functions = """
+// Escritura y lectura de enteros en network byte order directamente
+// sobre el buffer de red. Se usa memcpy para no depender de la
+// alineación del buffer.
+
+static inline void _put_8(uint8_t* dst, uint8_t value) {
+	*dst = value;
+}
+
+static inline void _put_16(uint8_t* dst, uint16_t value) {
+	value = htobe16(value);
+	memcpy(dst, &value, sizeof(value));
+}
+
+static inline void _put_32(uint8_t* dst, uint32_t value) {
+	value = htobe32(value);
+	memcpy(dst, &value, sizeof(value));
+}
+
+static inline void _put_64(uint8_t* dst, uint64_t value) {
+	value = htobe64(value);
+	memcpy(dst, &value, sizeof(value));
+}
+
+static inline uint8_t _get_8(const uint8_t* src) {
+	return *src;
+}
+
+static inline uint16_t _get_16(const uint8_t* src) {
+	uint16_t value;
+	memcpy(&value, src, sizeof(value));
+	return be16toh(value);
+}
+
+static inline uint32_t _get_32(const uint8_t* src) {
+	uint32_t value;
+	memcpy(&value, src, sizeof(value));
+	return be32toh(value);
+}
+
+static inline uint64_t _get_64(const uint8_t* src) {
+	uint64_t value;
+	memcpy(&value, src, sizeof(value));
+	return be64toh(value);
+}
+
+// Conversión en bloque de arrays. Los loops no tienen dependencias
+// entre iteraciones, por lo que el compilador puede vectorizarlos.
+
+static inline void _put_8_array(uint8_t* dst, const uint8_t* src, int count) {
+	memcpy(dst, src, count);
+}
+
+static inline void _put_16_array(uint8_t* restrict dst, const uint16_t* restrict src, int count) {
+	for(int i = 0; i < count; i++) {
+		_put_16(dst + i * sizeof(uint16_t), src[i]);
+	}
+}
+
+static inline void _put_32_array(uint8_t* restrict dst, const uint32_t* restrict src, int count) {
+	for(int i = 0; i < count; i++) {
+		_put_32(dst + i * sizeof(uint32_t), src[i]);
+	}
+}
+
+static inline void _put_64_array(uint8_t* restrict dst, const uint64_t* restrict src, int count) {
+	for(int i = 0; i < count; i++) {
+		_put_64(dst + i * sizeof(uint64_t), src[i]);
+	}
+}
+
+static inline void _get_8_array(uint8_t* dst, const uint8_t* src, int count) {
+	memcpy(dst, src, count);
+}
+
+static inline void _get_16_array(uint16_t* restrict dst, const uint8_t* restrict src, int count) {
+	for(int i = 0; i < count; i++) {
+		dst[i] = _get_16(src + i * sizeof(uint16_t));
+	}
+}
+
+static inline void _get_32_array(uint32_t* restrict dst, const uint8_t* restrict src, int count) {
+	for(int i = 0; i < count; i++) {
+		dst[i] = _get_32(src + i * sizeof(uint32_t));
+	}
+}
+
+static inline void _get_64_array(uint64_t* restrict dst, const uint8_t* restrict src, int count) {
+	for(int i = 0; i < count; i++) {
+		dst[i] = _get_64(src + i * sizeof(uint64_t));
+	}
+}
+
+// Enteros de largo variable (encoding="varint"): 7 bits por byte, el
+// bit más alto indica si sigue otro byte. Los enteros signados se
+// codifican en zigzag para que los valores negativos chicos también
+// ocupen pocos bytes.
+
+static inline int _varint_size(uint64_t value) {
+	int size = 1;
+	while(value >= 0x80) {
+		value >>= 7;
+		size++;
+	}
+	return size;
+}
+
+static inline void _write_varint(uint8_t* buff, int* current, uint64_t value) {
+	while(value >= 0x80) {
+		buff[(*current)++] = (uint8_t) (value | 0x80);
+		value >>= 7;
+	}
+	buff[(*current)++] = (uint8_t) value;
+}
+
+static inline uint64_t _read_varint(const uint8_t* buff, int* current, int size) {
+
+	// Lee un varint sin pasar de los size bytes del paquete. Si el
+	// varint no termina antes, deja current en size + 1 para que el
+	// llamador detecte el error.
+
+	uint64_t value = 0;
+	for(int shift = 0; shift < 64; shift += 7) {
+		if(*current >= size) {
+			*current = size + 1;
+			return 0;
+		}
+		uint8_t byte = buff[(*current)++];
+		value |= (uint64_t) (byte & 0x7F) << shift;
+		if(!(byte & 0x80)) {
+			break;
+		}
+	}
+	return value;
+}
+
+static inline uint64_t _zigzag_encode(int64_t value) {
+	return ((uint64_t) value << 1) ^ (uint64_t) (value >> 63);
+}
+
+static inline int64_t _zigzag_decode(uint64_t value) {
+	return (int64_t) (value >> 1) ^ -(int64_t) (value & 1);
+}
+
+static inline int _zigzag_size(int64_t value) {
+	return _varint_size(_zigzag_encode(value));
+}
+
+static inline void _write_zigzag(uint8_t* buff, int* current, int64_t value) {
+	_write_varint(buff, current, _zigzag_encode(value));
+}
+
+static inline int64_t _read_zigzag(const uint8_t* buff, int* current, int size) {
+	return _zigzag_decode(_read_varint(buff, current, size));
+}
+
+// Prefijos de longitud de los campos de largo variable, de ancho
+// fijo (FIELD_LEN_SIZE bytes) o varint. Al igual que _read_varint(),
+// las funciones que los leen dejan current en size + 1 si el prefijo
+// no entra en el paquete.
+
+static inline int _fixed_len_size(uint32_t len) {
+	return FIELD_LEN_SIZE;
+}
+
+static inline void _write_fixed_len(uint8_t* buff, int* current, uint32_t len) {
+	_put_field_len(buff + *current, len);
+	*current += FIELD_LEN_SIZE;
+}
+
+static inline uint32_t _read_fixed_len(const uint8_t* buff, int* current, int size) {
+	if(size - *current < FIELD_LEN_SIZE) {
+		*current = size + 1;
+		return 0;
+	}
+	uint32_t len = _get_field_len(buff + *current);
+	*current += FIELD_LEN_SIZE;
+	return len;
+}
+
+static inline int64_t _fixed_string_size(const char* string) {
+	return FIELD_LEN_SIZE + strlen(string);
+}
+
+static inline int _varint_len_size(uint32_t len) {
+	return _varint_size(len);
+}
+
+static inline void _write_varint_len(uint8_t* buff, int* current, uint32_t len) {
+	_write_varint(buff, current, len);
+}
+
+static inline uint32_t _read_varint_len(const uint8_t* buff, int* current, int size) {
+	return (uint32_t) _read_varint(buff, current, size);
+}
+
+static inline int64_t _varint_string_size(const char* string) {
+	size_t len = strlen(string);
+	return _varint_size(len) + len;
+}
+
+static inline int _has_bytes(int current, int size, uint64_t bytes) {
+
+	// Retorna verdadero si a partir de current quedan al menos bytes
+	// bytes de los size del paquete que se decodifica.
+
+	return bytes <= (uint64_t) (size - current);
+}
+"""
+
+# Cabecera de los paquetes. Por defecto contiene solo su longitud. Con la
+# opción --correlation-ids, a continuación de esta va el id de correlación.
+
+frame_header_functions = """
+#define FRAME_HEADER_SIZE FRAME_LEN_SIZE
+
+static inline void _put_frame_header(uint8_t* buff, uint32_t len) {
+	_put_frame_len(buff, len);
+}
+
+static inline uint32_t _read_frame_header(const uint8_t* buff) {
+	return _get_frame_len(buff);
+}
+"""
+
+correlation_frame_header_functions = """
+#define CORRELATION_ID_SIZE 4
+#define FRAME_HEADER_SIZE (FRAME_LEN_SIZE + CORRELATION_ID_SIZE)
+
+// Al enviar un paquete se usa el id de correlación del thread y al
+// recibirlo se actualiza el del thread con el del paquete. Así las
+// respuestas enviadas después de recibir un pedido llevan su id.
+
+static inline void _put_frame_header(uint8_t* buff, uint32_t len) {
+	_put_frame_len(buff, len);
+	_put_32(buff + FRAME_LEN_SIZE, get_correlation_id());
+}
+
+static inline uint32_t _read_frame_header(const uint8_t* buff) {
+	set_correlation_id(_get_32(buff + FRAME_LEN_SIZE));
+	return _get_frame_len(buff);
+}
+"""
+
+# Captura del tráfico. Las funciones de envío y recepción llaman
+# siempre a las funciones _capture_*; sin la opción --capture del
+# generador no hacen nada y el compilador las elimina.
+
+no_capture_functions = """
+static inline int _capture_enabled() {
+	return 0;
+}
+
+static inline void _capture_sent(int socket_fd, const uint8_t* data, uint32_t len) {
+}
+
+static inline void _capture_received(int socket_fd, const uint8_t* data, uint32_t len) {
+}
+
+static inline void _capture_received_frame(int socket_fd, const uint8_t* body, uint32_t len) {
+}
+"""
+
+capture_includes = """
+#include <time.h>
+#include <pthread.h>
+#include <sys/uio.h>
+"""
+
+capture_functions = """
+// El archivo de captura empieza con CAPTURE_MAGIC y sigue con un
+// registro por cada paquete o dato de un campo stream o blob enviado
+// o recibido: un encabezado de CAPTURE_RECORD_HEADER_SIZE bytes en
+// little endian (timestamp en nanosegundos, longitud de los datos,
+// file descriptor del socket y dirección) seguido de los datos tal
+// como viajaron por el socket.
+
+#define CAPTURE_MAGIC "PRTCAP01"
+#define CAPTURE_MAGIC_SIZE 8
+#define CAPTURE_RECORD_HEADER_SIZE 17
+
+// Los registros se escriben con el lock tomado para lectura, por lo
+// que start_capture() y stop_capture(), que lo toman para escritura,
+// no cierran el archivo mientras otro thread escribe en él.
+static int _capture_fd = -1;
+static pthread_rwlock_t _capture_lock = PTHREAD_RWLOCK_INITIALIZER;
+
+static void _set_capture_fd(int capture_fd) {
+
+	// Reemplaza el archivo de captura y cierra el anterior, si había.
+
+	pthread_rwlock_wrlock(&_capture_lock);
+	int previous_fd = _capture_fd;
+	__atomic_store_n(&_capture_fd, capture_fd, __ATOMIC_RELAXED);
+	pthread_rwlock_unlock(&_capture_lock);
+	if(previous_fd != -1) {
+		close(previous_fd);
+	}
+}
+
+int start_capture(const char* path) {
+
+	// Empieza a agregar al archivo de captura path, que se crea si no
+	// existe, el tráfico enviado y recibido por todos los threads.
+	// Retorna -1 si no pudo abrirse el archivo.
+
+	int capture_fd = open(path, O_WRONLY | O_CREAT | O_APPEND | O_CLOEXEC, 0644);
+	if(capture_fd == -1) {
+		return -1;
+	}
+	if(lseek(capture_fd, 0, SEEK_END) == 0 &&
+			write(capture_fd, CAPTURE_MAGIC, CAPTURE_MAGIC_SIZE) != CAPTURE_MAGIC_SIZE) {
+		close(capture_fd);
+		return -1;
+	}
+	_set_capture_fd(capture_fd);
+	return 0;
+}
+
+void stop_capture() {
+
+	// Deja de capturar el tráfico y cierra el archivo de captura.
+
+	_set_capture_fd(-1);
+}
+
+static inline int _capture_enabled() {
+
+	// Consulta rápida sin tomar el lock, para no armar registros
+	// cuando no se captura. _capture_record() vuelve a verificarlo.
+
+	return __atomic_load_n(&_capture_fd, __ATOMIC_RELAXED) != -1;
+}
+
+static void _capture_record(int socket_fd, uint8_t direction,
+		const uint8_t* header, uint32_t header_len, const uint8_t* data, uint32_t len) {
+
+	if(!_capture_enabled()) {
+		return;
+	}
+	struct timespec now;
+	clock_gettime(CLOCK_REALTIME, &now);
+	uint64_t timestamp = htole64((uint64_t) now.tv_sec * 1000000000 + now.tv_nsec);
+	uint32_t record_len = htole32(header_len + len);
+	uint32_t connection = htole32(socket_fd);
+	uint8_t record[CAPTURE_RECORD_HEADER_SIZE];
+	memcpy(record, &timestamp, sizeof(timestamp));
+	memcpy(record + 8, &record_len, sizeof(record_len));
+	memcpy(record + 12, &connection, sizeof(connection));
+	record[16] = direction;
+
+	// Cada registro se escribe con una única llamada: con O_APPEND los
+	// registros de distintos threads no se intercalan
+	struct iovec parts[3] = {
+		{ record, CAPTURE_RECORD_HEADER_SIZE },
+		{ (void*) header, header_len },
+		{ (void*) data, len }
+	};
+	pthread_rwlock_rdlock(&_capture_lock);
+	if(_capture_fd != -1) {
+		// Un error al escribir no afecta al tráfico capturado
+		writev(_capture_fd, parts, 3);
+	}
+	pthread_rwlock_unlock(&_capture_lock);
+}
+
+static inline void _capture_sent(int socket_fd, const uint8_t* data, uint32_t len) {
+	_capture_record(socket_fd, CAPTURE_SENT, NULL, 0, data, len);
+}
+
+static inline void _capture_received(int socket_fd, const uint8_t* data, uint32_t len) {
+	_capture_record(socket_fd, CAPTURE_RECEIVED, NULL, 0, data, len);
+}
+
+static inline void _capture_received_frame(int socket_fd, const uint8_t* body, uint32_t len) {
+
+	// Captura un paquete recibido cuyo encabezado ya se consumió,
+	// reconstruyéndolo (incluido el id de correlación del thread, que
+	// es el del paquete).
+
+	if(!_capture_enabled()) {
+		return;
+	}
+	uint8_t header[FRAME_HEADER_SIZE];
+	_put_frame_header(header, len);
+	_capture_record(socket_fd, CAPTURE_RECEIVED, header, FRAME_HEADER_SIZE, body, len);
+}
+"""
+
+arena_functions = """
+int init_arena(struct arena* arena, void* buffer, int size) {
+	arena->owns_buffer = buffer == NULL;
+	if(arena->owns_buffer) {
+		buffer = malloc(size);
+		if(buffer == NULL) {
+			return ALLOC_ERROR;
+		}
+	}
+	arena->buffer = (uint8_t*) buffer;
+	arena->size = size;
+	arena->used = 0;
+	return 0;
+}
+
+void reset_arena(struct arena* arena) {
+	arena->used = 0;
+}
+
+void destroy_arena(struct arena* arena) {
+	if(arena->owns_buffer) {
+		free(arena->buffer);
+	}
+	arena->buffer = NULL;
+	arena->size = arena->used = 0;
+}
+"""
+
+decode_alloc_functions = """
+#define ARENA_ALIGNMENT sizeof(uint64_t)
+
+static inline void* _decode_alloc(struct arena* arena, int size) {
+
+	// Sin arena se usa malloc. Con arena, se toma la memoria de
+	// la misma alineada a ARENA_ALIGNMENT.
+
+	if(arena == NULL) {
+		return malloc(size);
+	}
+	uintptr_t start = (uintptr_t) (arena->buffer + arena->used);
+	int padding = (ARENA_ALIGNMENT - start % ARENA_ALIGNMENT) % ARENA_ALIGNMENT;
+	if(arena->used + padding + size > arena->size) {
+		return NULL;
+	}
+	void* ptr = arena->buffer + arena->used + padding;
+	arena->used += padding + size;
+	return ptr;
+}
+
+static inline void _decode_free(struct arena* arena, void* ptr) {
+	if(arena == NULL) {
+		free(ptr);
+	}
+}
+"""
+
+send_buffer_functions = """
+// Buffer utilizado por send_msg() y las funciones send_<mensaje>()
+// que no reciben uno. Cada thread tiene el suyo.
+static __thread struct send_buffer _thread_send_buffer;
+
+void init_send_buffer(struct send_buffer* send_buffer) {
+	send_buffer->data = NULL;
+	send_buffer->size = 0;
+}
+
+void destroy_send_buffer(struct send_buffer* send_buffer) {
+	free(send_buffer->data);
+	init_send_buffer(send_buffer);
+}
+
+void release_thread_send_buffer() {
+	destroy_send_buffer(&_thread_send_buffer);
+}
+
+static int _reserve_send_buffer(struct send_buffer* send_buffer, int size) {
+
+	// Se asegura de que el buffer tenga al menos size bytes. De no
+	// tenerlos, duplica su tamaño hasta alcanzarlos.
+
+	if(send_buffer->size >= size) {
+		return 0;
+	}
+	int new_size = send_buffer->size > 0 ? send_buffer->size : 64;
+	while(new_size < size) {
+		new_size *= 2;
+	}
+	uint8_t* new_data = realloc(send_buffer->data, new_size);
+	if(new_data == NULL) {
+		return ALLOC_ERROR;
+	}
+	send_buffer->data = new_data;
+	send_buffer->size = new_size;
+	return 0;
+}
+"""
+
+stream_functions = """
+#define STREAM_CHUNK_SIZE 16384
+
+static inline int _send_stream_data(int socket_fd, const void* data, int count, int bits) {
+
+	// Envía count elementos de bits bits en network byte order. Los
+	// elementos de un byte se envían directamente desde data, el resto
+	// se convierte por partes de STREAM_CHUNK_SIZE bytes.
+
+	int element_size = bits / 8;
+	if(count < 0) {
+		return BAD_DATA;
+	}
+	if((int64_t) count * element_size > INT32_MAX) {
+		return PTR_FIELD_TOO_LONG;
+	}
+	if(element_size == 1) {
+		return count > 0 ? _send_full_msg(socket_fd, (uint8_t*) data, count) : 0;
+	}
+
+	const uint8_t* elements = (const uint8_t*) data;
+	uint8_t chunk[STREAM_CHUNK_SIZE];
+	int elements_per_chunk = STREAM_CHUNK_SIZE / element_size;
+	int ret, bytes_sent = 0;
+	for(int i = 0; i < count; i += elements_per_chunk) {
+		int n = count - i < elements_per_chunk ? count - i : elements_per_chunk;
+		const uint8_t* next = elements + (int64_t) i * element_size;
+		switch(bits) {
+			case 16:
+				_put_16_array(chunk, (const uint16_t*) next, n);
+				break;
+			case 32:
+				_put_32_array(chunk, (const uint32_t*) next, n);
+				break;
+			case 64:
+				_put_64_array(chunk, (const uint64_t*) next, n);
+				break;
+		}
+		if((ret = _send_full_msg(socket_fd, chunk, n * element_size)) < 0) {
+			return ret;
+		}
+		bytes_sent += ret;
+	}
+	return bytes_sent;
+}
+
+static inline int _recv_stream_data(int socket_fd, void* data, int count, int bits) {
+
+	// Recibe count elementos de bits bits y los convierte a host byte
+	// order en el mismo buffer. Retorna la cantidad de elementos recibidos.
+
+	int error;
+	uint8_t* bytes = (uint8_t*) data;
+	if(count < 0) {
+		return BAD_DATA;
+	}
+	if((int64_t) count * (bits / 8) > INT32_MAX) {
+		return PTR_FIELD_TOO_LONG;
+	}
+	int size = count * (bits / 8);
+	if((error = recv_n_bytes(socket_fd, data, size)) < 0) {
+		return error;
+	}
+	_capture_received(socket_fd, bytes, size);
+	switch(bits) {
+		case 16:
+			for(int i = 0; i < count; i++) {
+				((uint16_t*) data)[i] = _get_16(bytes + i * sizeof(uint16_t));
+			}
+			break;
+		case 32:
+			for(int i = 0; i < count; i++) {
+				((uint32_t*) data)[i] = _get_32(bytes + i * sizeof(uint32_t));
+			}
+			break;
+		case 64:
+			for(int i = 0; i < count; i++) {
+				((uint64_t*) data)[i] = _get_64(bytes + i * sizeof(uint64_t));
+			}
+			break;
+	}
+	return count;
+}
+"""
+
+blob_functions = """
+#define BLOB_CHUNK_SIZE 65536
+
+static int _copy_bytes(int from_fd, int to_fd, uint32_t bytes_to_copy) {
+
+	// Copia bytes_to_copy bytes de un file descriptor a otro pasando
+	// por un buffer. Se usa cuando no puede usarse splice() y siempre
+	// que se captura el tráfico, por lo que from_fd es el socket.
+
+	uint8_t buffer[BLOB_CHUNK_SIZE];
+	while(bytes_to_copy > 0) {
+		int chunk = bytes_to_copy < BLOB_CHUNK_SIZE ? bytes_to_copy : BLOB_CHUNK_SIZE;
+		ssize_t num_bytes = read(from_fd, buffer, chunk);
+		if(num_bytes == 0) {
+			return CONN_CLOSED;
+		} else if(num_bytes == -1) {
+			return SOCKET_ERROR;
+		}
+		_capture_received(from_fd, buffer, num_bytes);
+		for(ssize_t written = 0; written < num_bytes;) {
+			ssize_t ret = write(to_fd, buffer + written, num_bytes - written);
+			if(ret == -1) {
+				return SOCKET_ERROR;
+			}
+			written += ret;
+		}
+		bytes_to_copy -= num_bytes;
+	}
+	return 0;
+}
+
+static inline int _send_file_blob(int socket_fd, const struct file_blob* blob) {
+
+	// Envía los datos del blob con sendfile(). Si el archivo no lo
+	// soporta, o si se está capturando el tráfico, los lee con pread()
+	// y los envía por partes.
+
+	off_t offset = blob->offset;
+	uint32_t remaining = blob->len;
+	while(remaining > 0 && !_capture_enabled()) {
+		ssize_t num_bytes = sendfile(socket_fd, blob->fd, &offset, remaining);
+		if(num_bytes == -1 && (errno == EINVAL || errno == ENOSYS)) {
+			break;
+		} else if(num_bytes == -1) {
+			return SOCKET_ERROR;
+		} else if(num_bytes == 0) {
+			// El archivo terminó antes de blob->len
+			return BAD_DATA;
+		}
+		remaining -= num_bytes;
+	}
+
+	uint8_t buffer[BLOB_CHUNK_SIZE];
+	while(remaining > 0) {
+		int chunk = remaining < BLOB_CHUNK_SIZE ? remaining : BLOB_CHUNK_SIZE;
+		ssize_t num_bytes = pread(blob->fd, buffer, chunk, offset);
+		if(num_bytes == -1) {
+			return SOCKET_ERROR;
+		} else if(num_bytes == 0) {
+			return BAD_DATA;
+		}
+		if(_send_full_msg(socket_fd, buffer, num_bytes) < 0) {
+			return SOCKET_ERROR;
+		}
+		offset += num_bytes;
+		remaining -= num_bytes;
+	}
+	return blob->len;
+}
+
+int recv_blob_to_file(int socket_fd, int file_fd, uint32_t len) {
+
+	// Recibe len bytes de un campo blob y los escribe en file_fd, en su
+	// posición actual. Mueve los datos con splice() a través de un pipe
+	// y, si no es posible, los copia por un buffer.
+
+	int pipe_fds[2];
+	if(len == 0) {
+		return 0;
+	}
+	if(_capture_enabled() || pipe(pipe_fds) == -1) {
+		return _copy_bytes(socket_fd, file_fd, len);
+	}
+	int error = 0;
+	while(len > 0 && error == 0) {
+		ssize_t in_pipe = splice(socket_fd, NULL, pipe_fds[1], NULL,
+			len < BLOB_CHUNK_SIZE ? len : BLOB_CHUNK_SIZE, SPLICE_F_MOVE);
+		if(in_pipe == 0) {
+			error = CONN_CLOSED;
+			break;
+		} else if(in_pipe == -1) {
+			error = _copy_bytes(socket_fd, file_fd, len);
+			break;
+		}
+		len -= in_pipe;
+		while(in_pipe > 0) {
+			ssize_t out_pipe = splice(pipe_fds[0], NULL, file_fd, NULL, in_pipe, SPLICE_F_MOVE);
+			if(out_pipe == -1) {
+				// Se vacía el pipe y se copia el resto sin splice
+				if((error = _copy_bytes(pipe_fds[0], file_fd, in_pipe)) == 0) {
+					error = _copy_bytes(socket_fd, file_fd, len);
+				}
+				len = 0;
+				break;
+			}
+			in_pipe -= out_pipe;
+		}
+	}
+	close(pipe_fds[0]);
+	close(pipe_fds[1]);
+	return error;
+}
+
+int recv_blob_mapped(int socket_fd, uint32_t len, void** data) {
+
+	// Recibe len bytes de un campo blob en una región de memoria
+	// mapeada con mmap(), que debe liberarse con unmap_blob().
+
+	*data = NULL;
+	if(len == 0) {
+		return 0;
+	}
+	void* region = mmap(NULL, len, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+	if(region == MAP_FAILED) {
+		return ALLOC_ERROR;
+	}
+	int error;
+	if((error = recv_n_bytes(socket_fd, region, len)) < 0) {
+		munmap(region, len);
+		return error;
+	}
+	_capture_received(socket_fd, region, len);
+	*data = region;
+	return 0;
+}
+
+void unmap_blob(void* data, uint32_t len) {
+	if(data != NULL) {
+		munmap(data, len);
+	}
+}
+"""
+
+# Primera línea del header. Identifica el xml, las opciones y la versión
+# del generador con los que se generó, para no regenerarlo si no cambiaron.
+
+header_fingerprint = """// Generado por generator.py. Huella: {fingerprint}
+"""
+
 header_defines = """#ifndef PROTOCOL_H_INCLUDED
 #define PROTOCOL_H_INCLUDED
 """
@@ -28,21 +831,179 @@ header_close = """
 
 errors_enum = """enum errors { UNKNOWN_ID = -20, BAD_DATA,
 	ALLOC_ERROR, BUFFER_TOO_SMALL, PTR_FIELD_TOO_LONG,
-	MESSAGE_TOO_BIG, CONN_CLOSED, SOCKET_ERROR = -1 };
+	MESSAGE_TOO_BIG, CONN_CLOSED, TIMED_OUT, RING_FULL,
+	SOCKET_ERROR = -1 };
+"""
+
+arena_definition = """
+// Región de memoria de la que se toman los campos de largo variable
+// al decodificar con decode_in_arena() o recv_msg_in_arena(). Los
+// mensajes decodificados en ella no deben destruirse con destroy(),
+// su memoria se libera toda junta con reset_arena() o destroy_arena().
+struct arena {
+	uint8_t* buffer;
+	int size;
+	int used;
+	int owns_buffer;
+};
+"""
+
+file_blob_definition = """
+// Campo de tipo blob: len bytes del archivo fd a partir de offset.
+// Al enviarse, los datos se transmiten con sendfile() a continuación
+// del paquete. Al recibirse, fd queda en -1 y los datos deben leerse
+// con recv_blob_to_file() o recv_blob_mapped().
+struct file_blob {
+	int64_t offset;
+	int fd;
+	uint32_t len;
+};
+"""
+
+send_buffer_definition = """
+// Buffer reutilizable en el que se empaquetan los mensajes a enviar.
+// Crece a medida que se necesita y conserva su memoria entre envíos.
+struct send_buffer {
+	uint8_t* data;
+	int size;
+};
 """
 
 enum_definition = """enum {enum_name} {{ {values} }};
 """
 
+dispatch_definitions = """
+// Handlers tipados de los mensajes. Reciben el file descriptor del
+// cliente, el mensaje recibido y los datos compartidos del dispatcher.
+// El mensaje solo es válido durante la ejecución del handler. Retornan
+// lo mismo que un handler_t de sockets.h.
+struct msg_handlers {{{handler_members}
+}};
+
+struct connection_state;
+
+// Recibe los paquetes de los clientes de un servidor de sockets.h y
+// llama al handler correspondiente a cada mensaje. Se usa como datos
+// compartidos del servidor, con dispatch_new_client() y
+// dispatch_can_read() como sus handlers.
+struct msg_dispatcher {{
+	struct msg_handlers handlers;
+	void* shared_data;
+	struct connection_state** connections;
+	int connections_size;
+}};
+
+void init_dispatcher(struct msg_dispatcher*, struct msg_handlers, void*);
+void destroy_dispatcher(struct msg_dispatcher*);
+int dispatch_new_client(int, void*);
+int dispatch_can_read(int, void*);
+int dispatch_close_client(int, void*);
+void dispatch_remove_client(struct msg_dispatcher*, int);
+"""
+
+dispatch_handler_member = """
+	int (*on_{msg_name})(int, const struct {msg_name}*, void*);"""
+
+multiplexer_definitions = """
+struct pending_request;
+
+// Permite tener varios pedidos en curso sobre una misma conexión desde
+// distintos threads. Cada pedido se envía con un id de correlación nuevo
+// y un thread receptor entrega cada respuesta a quien espera ese id.
+struct msg_multiplexer {
+	int socket_fd;
+	pthread_t receiver;
+	pthread_mutex_t send_lock;
+	pthread_mutex_t lock;
+	struct pending_request* pending;
+	uint32_t next_id;
+	int error;
+};
+
+void set_correlation_id(uint32_t);
+uint32_t get_correlation_id();
+
+int init_multiplexer(struct msg_multiplexer*, int);
+void destroy_multiplexer(struct msg_multiplexer*);
+int multiplexer_request(struct msg_multiplexer*, void*, void*, int, int);
+"""
+
+shm_definitions = """
+struct shm_ring;
+
+// Canal de memoria compartida en un único sentido, de un productor a
+// un consumidor. ring apunta a la región compartida, cuyos datos
+// (data) ocupan capacity bytes.
+struct shm_channel {
+	struct shm_ring* ring;
+	uint8_t* data;
+	uint32_t capacity;
+	uint64_t pending_head;
+	size_t map_size;
+	int memfd;
+	int eventfd;
+};
+
+int create_shm_channel(struct shm_channel*, uint32_t);
+int open_shm_channel(struct shm_channel*, int, int);
+void close_shm_channel(struct shm_channel*);
+int send_shm_channel(int, struct shm_channel*);
+int recv_shm_channel(int, struct shm_channel*);
+int shm_send_msg(struct shm_channel*, void*);
+int shm_recv_msg(struct shm_channel*, void*, int);
+int shm_recv_msg_in_arena(struct shm_channel*, void*, int, struct arena*);
+"""
+
+relay_definitions = """
+// Encabezado de un paquete recibido con recv_frame_route(). header
+// contiene los header_size bytes recibidos tal como llegaron (la
+// longitud, el id de correlación si lo hay y el id del mensaje),
+// frame_len la longitud del paquete y msg_id el id del mensaje.
+struct frame_route {
+	uint8_t header[16];
+	int header_size;
+	uint32_t frame_len;
+	uint8_t msg_id;
+};
+
+int recv_frame_route(int, struct frame_route*);
+int relay_frame(int, int, const struct frame_route*);
+int discard_frame(int, const struct frame_route*);
+"""
+
+capture_definitions = """
+// Dirección de los registros de un archivo de captura.
+enum capture_direction { CAPTURE_SENT, CAPTURE_RECEIVED };
+
+int start_capture(const char*);
+void stop_capture();
+"""
+
 msg_handling_functions_declarations = """
 int decode(void*, void*, int);
+int decode_in_arena(void*, void*, int, struct arena*);
+int decode_bounded(void*, int, void*, int);
+int decode_bounded_in_arena(void*, int, void*, int, struct arena*);
 int destroy(void*);
 int bytes_needed_to_pack(void*);
 int send_msg(int, void*);
 
-int pack_msg(uint16_t, void*, uint8_t*);
+int pack_msg(frame_len_t, void*, uint8_t*);
 
 int recv_msg(int, void*, int);
+int recv_msg_in_arena(int, void*, int, struct arena*);
+
+void init_send_buffer(struct send_buffer*);
+void destroy_send_buffer(struct send_buffer*);
+void release_thread_send_buffer();
+
+int recv_blob_to_file(int, int, uint32_t);
+int recv_blob_mapped(int, uint32_t, void**);
+void unmap_blob(void*, uint32_t);
+
+int init_arena(struct arena*, void*, int);
+void reset_arena(struct arena*);
+void destroy_arena(struct arena*);
 
 int get_max_msg_size();
 uint8_t get_msg_id(void*);
@@ -60,188 +1021,431 @@ struct {msg_name} {{
 }};
 """
 
+struct_size_assertions = """
+_Static_assert(offsetof(struct {msg_name}, id) == 0, "id must be the first member of struct {msg_name}");
+#if UINTPTR_MAX == UINT64_MAX
+_Static_assert(sizeof(struct {msg_name}) == {size}, "struct {msg_name} should take {size} bytes");
+#endif
+"""
+
 header_signatures = """
 int decode_{msg_name}(void*, void*, int);
+int decode_{msg_name}_in_arena(void*, void*, int, struct arena*);
 int encode_{msg_name}(void*, uint8_t*, int);
 int init_{msg_name}({create_parameters} struct {msg_name}*);
 void destroy_{msg_name}(void*);
 int pack_{msg_name}({create_parameters} uint8_t *, int);
-int send_{msg_name}({create_parameters} int);
+"""
+
+send_signatures = """int send_{msg_name}({create_parameters} int);
+int send_{msg_name}_with_buffer({create_parameters} int, struct send_buffer*);
+"""
+
+shm_send_signature = """int shm_send_{msg_name}({create_parameters} struct shm_channel*);
 """
 
 optional_struct_casting = "struct {msg_name}* msg = (struct {msg_name}*) buffer;"
 
 message_functions_template = """
-int encoded_{msg_name}_size(void* buffer) {{
-	{optional_struct_casting}
-	int encoded_size = 1;
-	{add_field_sizes}
+{storage}int encoded_{msg_name}_size(void* buffer) {{
+	{size_struct_casting}
+	int64_t encoded_size = 1;
+{add_field_sizes}
 	if(encoded_size > MAX_ENCODED_SIZE) {{
 		return MESSAGE_TOO_BIG;
 	}}
 	return encoded_size;
 }}
 
-int decode_{msg_name} (void *recv_data, void* decoded_data, int max_decoded_size) {{
-    
+static {inline}int _decode_{msg_name}(void *recv_data, int data_size, void* decoded_data, int max_decoded_size, struct arena* arena) {{
+
+	// Decodifica el mensaje sin leer más allá de los data_size bytes
+	// del paquete. Retorna BAD_DATA si sus campos no entran en ellos.
+
 	if(max_decoded_size < sizeof(struct {msg_name})) {{
 		return BUFFER_TOO_SMALL;
 	}}
+	if(data_size < 1) {{
+		return BAD_DATA;
+	}}
 
 	uint8_t* byte_data = (uint8_t*) recv_data;
 	int current = 0;
-	struct {msg_name} msg;
-	msg.id = byte_data[current++];
+	struct {msg_name}* msg = (struct {msg_name}*) decoded_data;
+	msg->id = byte_data[current++];
 	{decode_fields}
-	{network_to_host}
-	memcpy(decoded_data, &msg, sizeof(struct {msg_name}));
 	return 0;
 }}
 
-int encode_{msg_name}(void* msg_buffer, uint8_t* buff, int max_size) {{
+{storage}int decode_{msg_name}_in_arena(void *recv_data, void* decoded_data, int max_decoded_size, struct arena* arena) {{
+	return _decode_{msg_name}(recv_data, MAX_ENCODED_SIZE, decoded_data, max_decoded_size, arena);
+}}
+
+{storage}int decode_{msg_name} (void *recv_data, void* decoded_data, int max_decoded_size) {{
+	return decode_{msg_name}_in_arena(recv_data, decoded_data, max_decoded_size, NULL);
+}}
+
+{storage}int encode_{msg_name}(void* msg_buffer, uint8_t* buff, int max_size) {{
 	
 	int encoded_size = 0;
-	struct {msg_name} msg = *((struct {msg_name}*) msg_buffer);
+	const struct {msg_name}* msg = (const struct {msg_name}*) msg_buffer;
 
-	if((encoded_size = encoded_{msg_name}_size(&msg)) < 0) {{
+	if((encoded_size = encoded_{msg_name}_size(msg_buffer)) < 0) {{
 		return encoded_size;
 	}}
 	if(encoded_size > max_size) {{
 		return BUFFER_TOO_SMALL;
 	}}
 
-	{host_to_network}
-
 	int current = 0;
-	buff[current++] = msg.id;
+	buff[current++] = msg->id;
 	{encode_fields}
-	{network_to_host}
 	return encoded_size;
 }}
 
-int init_{msg_name}({create_parameters} struct {msg_name}* msg) {{
+{storage}int init_{msg_name}({create_parameters} struct {msg_name}* msg) {{
 	msg->id = {msg_name_upper}_ID;
-	{init_fields}
+{init_fields}
 	return 0;
 }}
 
-void destroy_{msg_name}(void* buffer) {{
+{storage}void destroy_{msg_name}(void* buffer) {{
 	{optional_struct_casting}
 	{destroy_fields}
 }}
 
-int pack_{msg_name}({create_parameters} uint8_t *buff, int max_size) {{
-	uint8_t local_buffer[max_size - 2];
-	struct {msg_name} msg;
-	int error, encoded_size;
-	if((error = init_{msg_name}({parameter_pass} &msg)) < 0) {{
-		return error;
+static {inline}int _encoded_{msg_name}_args_size({size_parameters}) {{
+	int64_t encoded_size = 1;
+{add_arg_sizes}
+	if(encoded_size > MAX_ENCODED_SIZE) {{
+		return MESSAGE_TOO_BIG;
+	}}
+	return encoded_size;
+}}
+
+static {inline}int _pack_{msg_name}_args({create_parameters} uint8_t* packed, int encoded_size) {{
+
+	// Empaqueta el mensaje directamente desde los parámetros recibidos.
+	// El buffer debe tener al menos encoded_size + FRAME_HEADER_SIZE bytes.
+
+	uint8_t* buff = packed + FRAME_HEADER_SIZE;
+	int current = 0;
+	_put_frame_header(packed, encoded_size);
+	buff[current++] = {msg_name_upper}_ID;
+	{encode_arg_fields}
+	return encoded_size + FRAME_HEADER_SIZE;
+}}
+
+{storage}int pack_{msg_name}({create_parameters} uint8_t *buff, int max_size) {{
+	int encoded_size;
+	if((encoded_size = _encoded_{msg_name}_args_size({size_parameter_pass})) < 0) {{
+		return encoded_size;
+	}}
+	if(encoded_size + FRAME_HEADER_SIZE > max_size) {{
+		return BUFFER_TOO_SMALL;
 	}}
-	if((encoded_size = encode_{msg_name}(&msg, local_buffer, max_size - 2)) < 0) {{
-		destroy_{msg_name}(&msg);
+	return _pack_{msg_name}_args({parameter_pass} buff, encoded_size);
+}}
+"""
+
+message_send_functions_template = """
+int send_{msg_name}_with_buffer({create_parameters} int socket_fd, struct send_buffer* send_buffer) {{
+	int encoded_size, bytes_to_send;
+	if((encoded_size = _encoded_{msg_name}_args_size({size_parameter_pass})) < 0) {{
 		return encoded_size;
 	}}
-	destroy_{msg_name}(&msg);
-	return pack_msg(encoded_size, local_buffer, buff);
+	if(_reserve_send_buffer(send_buffer, encoded_size + FRAME_HEADER_SIZE) < 0) {{
+		return ALLOC_ERROR;
+	}}
+	if((bytes_to_send = _pack_{msg_name}_args({parameter_pass} send_buffer->data, encoded_size)) < 0) {{
+		return bytes_to_send;
+	}}
+	int bytes_sent;
+	if((bytes_sent = _send_full_msg(socket_fd, send_buffer->data, bytes_to_send)) < 0) {{
+		return bytes_sent;
+	}}
+	{send_arg_streams}
+	return bytes_sent;
 }}
 
 int send_{msg_name}({create_parameters} int socket_fd) {{
+	return send_{msg_name}_with_buffer({parameter_pass} socket_fd, &_thread_send_buffer);
+}}
 
-	int bytes_to_send, ret;
-	int current_buffer_size = sizeof(struct {msg_name});
-	uint8_t* local_buffer = malloc(current_buffer_size);
-	if(local_buffer == NULL) {{
-		return ALLOC_ERROR;
-	}}
+static int _send_{msg_name}_streams(int socket_fd, void* buffer) {{
 
-	while((bytes_to_send = pack_{msg_name}({parameter_pass} local_buffer, current_buffer_size)) == BUFFER_TOO_SMALL) {{
-		current_buffer_size *= 2;
-		local_buffer = realloc(local_buffer, current_buffer_size);
-		if(local_buffer == NULL) {{
-			return ALLOC_ERROR;
-		}}
-	}}
+	// Envía los datos de los campos stream y blob del mensaje, que
+	// van a continuación del paquete.
 
-	if(bytes_to_send < 0) {{
-		return bytes_to_send;
+	{stream_struct_casting}
+	int bytes_sent = 0;
+	{send_msg_streams}
+	return bytes_sent;
+}}
+"""
+
+shm_send_function_template = """
+int shm_send_{msg_name}({create_parameters} struct shm_channel* channel) {{
+	int encoded_size, error;
+	uint8_t* frame;
+	if((encoded_size = _encoded_{msg_name}_args_size({size_parameter_pass})) < 0) {{
+		return encoded_size;
 	}}
+	if((error = _reserve_shm_frame(channel, encoded_size + FRAME_HEADER_SIZE, &frame)) < 0) {{
+		return error;
+	}}
+	int packed_bytes = _pack_{msg_name}_args({parameter_pass} frame, encoded_size);
+	_commit_shm_frame(channel);
+	return packed_bytes;
+}}
+"""
 
-	ret = _send_full_msg(socket_fd, local_buffer, bytes_to_send);
-	free(local_buffer);
-	return ret;
+stream_field_signatures = """int send_{msg_name}_{field_name}_chunk(int, const {type}*, int);
+int recv_{msg_name}_{field_name}_chunk(int, {type}*, int);
+"""
+
+stream_field_functions = """
+int send_{msg_name}_{field_name}_chunk(int socket_fd, const {type}* chunk, int count) {{
+	return _send_stream_data(socket_fd, chunk, count, {bits});
+}}
+
+int recv_{msg_name}_{field_name}_chunk(int socket_fd, {type}* chunk, int count) {{
+	return _recv_stream_data(socket_fd, chunk, count, {bits});
 }}
 """
 
 add_simple_field_size = "\tencoded_size += sizeof({type});"
 add_array_field_size = "\tencoded_size += sizeof({type}) * {length};"
 add_string_field_size = """
-	if(msg->{field_name} == NULL) {{
+	if({source}{field_name} == NULL) {{
+		return BAD_DATA;
+	}}
+	encoded_size += _{len_encoding}_string_size({source}{field_name});
+"""
+add_sized_string_field_size = """
+	if({source}{field_name} == NULL) {{
 		return BAD_DATA;
 	}}
-	encoded_size += 2;
-	encoded_size += strlen(msg->{field_name});
+	encoded_size += _{len_encoding}_len_size({source}{field_name}_len);
+	encoded_size += {source}{field_name}_len;
 """
 add_pointer_field_size = """
-	if(msg->{field_name} == NULL) {{
+	if({source}{field_name} == NULL) {{
+		return BAD_DATA;
+	}}
+	encoded_size += _{len_encoding}_len_size({source}{field_name}_len);
+	encoded_size += {source}{field_name}_len * sizeof({type});
+"""
+
+add_varint_field_size = "\tencoded_size += _{codec}_size({source}{field_name});"
+add_varint_array_field_size = """
+	for(int _i = 0; _i < {length}; _i++) {{
+		encoded_size += _{codec}_size({source}{field_name}[_i]);
+	}}"""
+add_varint_pointer_field_size = """
+	if({source}{field_name} == NULL) {{
 		return BAD_DATA;
 	}}
-	encoded_size += 2;
-	encoded_size += msg->{field_name}_len * sizeof({type});
+	encoded_size += _varint_len_size({source}{field_name}_len);
+	for(int _i = 0; _i < {source}{field_name}_len; _i++) {{
+		encoded_size += _{codec}_size({source}{field_name}[_i]);
+	}}
+"""
+
+add_stream_field_size = """
+	if({source}{field_name}_len * (int64_t) sizeof({type}) > INT32_MAX) {{
+		return PTR_FIELD_TOO_LONG;
+	}}
+	encoded_size += sizeof(stream_len_t);
 """
 
+# El paquete y los datos de sus campos stream y blob deben entrar en
+# el int que retornan las funciones de envío
+add_trailing_data_size = """	if(encoded_size + FRAME_HEADER_SIZE + {trailing_data_sizes} > INT32_MAX) {{
+		return MESSAGE_TOO_BIG;
+	}}"""
+stream_data_size = "{source}{field_name}_len * (int64_t) sizeof({type})"
+blob_data_size = "(int64_t) {source}{field_name}.len"
+
+add_blob_field_size = """
+	if({source}{field_name}.len > INT32_MAX) {{
+		return PTR_FIELD_TOO_LONG;
+	}}
+	encoded_size += sizeof(uint32_t);
+"""
+
+# Los campos de tamaño fijo se decodifican sin verificaciones propias: el
+# generador verifica antes que entren en el paquete (decode_size_check).
+# Los demás verifican sus prefijos de longitud y datos contra data_size.
+decode_size_check = """
+	if(!_has_bytes(current, data_size, {size})) {{
+		{free_resources}
+		return BAD_DATA;
+	}}"""
+decode_varint_check = """
+	if(current > data_size) {{
+		{free_resources}
+		return BAD_DATA;
+	}}"""
 decode_simple_field = """
-	msg.{field_name} = *(({type}*) (byte_data + current));
+	msg->{field_name} = ({type}) _get_{bits}(byte_data + current);
 	current += sizeof({type});"""
 decode_array_field = """
-	memcpy(msg.{field_name}, byte_data + current, {length} * sizeof({type}));
+	_get_{bits}_array((uint{bits}_t*) msg->{field_name}, byte_data + current, {length});
 	current += {length} * sizeof({type});"""
 decode_string_field = """
-	int {field_name}_len = ntohs(*((uint16_t*)(byte_data + current)));
-	current += 2;
-	msg.{field_name} = malloc({field_name}_len + 1);
-	if(msg.{field_name} == NULL){{
+	uint32_t {field_name}_len = _read_{len_encoding}_len(byte_data, &current, data_size);
+	if(current > data_size || !_has_bytes(current, data_size, {field_name}_len)) {{
+		{free_resources}
+		return BAD_DATA;
+	}}
+	msg->{field_name} = _decode_alloc(arena, {field_name}_len + 1);
+	if(msg->{field_name} == NULL){{
 		{free_resources}
 		return ALLOC_ERROR;
 	}}
-	memcpy(msg.{field_name}, byte_data + current, {field_name}_len);
-	msg.{field_name}[{field_name}_len] = '\\0';
+	memcpy(msg->{field_name}, byte_data + current, {field_name}_len);
+	msg->{field_name}[{field_name}_len] = '\\0';
 	current += {field_name}_len;"""
+decode_sized_string_field = """
+	msg->{field_name}_len = _read_{len_encoding}_len(byte_data, &current, data_size);
+	if(current > data_size || !_has_bytes(current, data_size, msg->{field_name}_len)) {{
+		{free_resources}
+		return BAD_DATA;
+	}}
+	msg->{field_name} = _decode_alloc(arena, msg->{field_name}_len + 1);
+	if(msg->{field_name} == NULL){{
+		{free_resources}
+		return ALLOC_ERROR;
+	}}
+	memcpy(msg->{field_name}, byte_data + current, msg->{field_name}_len);
+	msg->{field_name}[msg->{field_name}_len] = '\\0';
+	current += msg->{field_name}_len;"""
 decode_pointer_field = """
-	msg.{field_name}_len = ntohs(*((uint16_t*)(byte_data + current)));
-	current += 2;
-	msg.{field_name} = malloc(msg.{field_name}_len * sizeof({type}));
-	if(msg.{field_name} == NULL) {{
+	uint32_t {field_name}_len = _read_{len_encoding}_len(byte_data, &current, data_size);
+	if(current > data_size || (field_len_t) {field_name}_len != {field_name}_len
+			|| !_has_bytes(current, data_size, (uint64_t) {field_name}_len * sizeof({type}))) {{
+		{free_resources}
+		return BAD_DATA;
+	}}
+	msg->{field_name}_len = {field_name}_len;
+	msg->{field_name} = _decode_alloc(arena, msg->{field_name}_len * sizeof({type}));
+	if(msg->{field_name} == NULL) {{
+		{free_resources}
+		return ALLOC_ERROR;
+	}}
+	_get_{bits}_array((uint{bits}_t*) msg->{field_name}, byte_data + current, msg->{field_name}_len);
+	current += msg->{field_name}_len * sizeof({type});
+"""
+decode_varint_field = """
+	msg->{field_name} = ({type}) _read_{codec}(byte_data, &current, data_size);"""
+decode_varint_array_field = """
+	for(int _i = 0; _i < {length}; _i++) {{
+		msg->{field_name}[_i] = ({type}) _read_{codec}(byte_data, &current, data_size);
+	}}"""
+decode_varint_pointer_field = """
+	// Cada elemento ocupa al menos un byte
+	uint32_t {field_name}_len = _read_varint_len(byte_data, &current, data_size);
+	if(current > data_size || (field_len_t) {field_name}_len != {field_name}_len
+			|| !_has_bytes(current, data_size, {field_name}_len)) {{
+		{free_resources}
+		return BAD_DATA;
+	}}
+	msg->{field_name}_len = {field_name}_len;
+	msg->{field_name} = _decode_alloc(arena, msg->{field_name}_len * sizeof({type}));
+	if(msg->{field_name} == NULL) {{
 		{free_resources}
 		return ALLOC_ERROR;
 	}}
-	memcpy(msg.{field_name}, byte_data + current, msg.{field_name}_len * sizeof({type}));
-	current += msg.{field_name}_len * sizeof({type});
+	for(int _i = 0; _i < msg->{field_name}_len; _i++) {{
+		msg->{field_name}[_i] = ({type}) _read_{codec}(byte_data, &current, data_size);
+	}}
+	if(current > data_size) {{
+		_decode_free(arena, msg->{field_name});
+		{free_resources}
+		return BAD_DATA;
+	}}
 """
-free_decode_pointer = "free(msg.{field_name});"
+decode_stream_field = """
+	msg->{field_name}_len = _get_32(byte_data + current);
+	current += sizeof(stream_len_t);
+	msg->{field_name} = NULL;"""
+decode_blob_field = """
+	msg->{field_name}.len = _get_32(byte_data + current);
+	msg->{field_name}.fd = -1;
+	msg->{field_name}.offset = 0;
+	current += sizeof(uint32_t);"""
+free_decode_pointer = "_decode_free(arena, msg->{field_name});"
 
 encode_simple_field = """
-	*(({type}*)(buff + current)) = msg.{field_name};
+	_put_{bits}(buff + current, {source}{field_name});
 	current += sizeof({type});"""
 encode_array_field = """
-	memcpy(buff + current, msg.{field_name}, {length} * sizeof({type}));
+	_put_{bits}_array(buff + current, (const uint{bits}_t*) {source}{field_name}, {length});
 	current += {length} * sizeof({type});"""
 encode_string_field = """
-	int {field_name}_len = strlen(msg.{field_name});
+	int {field_name}_len = strlen({source}{field_name});
 	if({field_name}_len > MAX_STRING_SIZE) {{
 		return PTR_FIELD_TOO_LONG;
 	}}
-	*((uint16_t*)(buff + current)) = htons({field_name}_len);
-	current += 2;
-	memcpy(buff + current, msg.{field_name}, {field_name}_len);
+	_write_{len_encoding}_len(buff, &current, {field_name}_len);
+	memcpy(buff + current, {source}{field_name}, {field_name}_len);
 	current += {field_name}_len;"""
+encode_sized_string_field = """
+	if({source}{field_name}_len > MAX_STRING_SIZE) {{
+		return PTR_FIELD_TOO_LONG;
+	}}
+	_write_{len_encoding}_len(buff, &current, {source}{field_name}_len);
+	memcpy(buff + current, {source}{field_name}, {source}{field_name}_len);
+	current += {source}{field_name}_len;"""
 encode_pointer_field = """
-	if(msg.{field_name}_len > MAX_PTR_COUNT) {{
+	if(_ptr_count_too_big({source}{field_name}_len)) {{
 		return PTR_FIELD_TOO_LONG;
 	}}
-	*((uint16_t*)(buff + current)) = htons(msg.{field_name}_len);
-	current += 2;
-	memcpy(buff + current, msg.{field_name}, msg.{field_name}_len * sizeof({type}));
-	current += msg.{field_name}_len * sizeof({type});"""
+	_write_{len_encoding}_len(buff, &current, {source}{field_name}_len);
+	_put_{bits}_array(buff + current, (const uint{bits}_t*) {source}{field_name}, {source}{field_name}_len);
+	current += {source}{field_name}_len * sizeof({type});"""
+
+encode_varint_field = """
+	_write_{codec}(buff, &current, {source}{field_name});"""
+encode_varint_array_field = """
+	for(int _i = 0; _i < {length}; _i++) {{
+		_write_{codec}(buff, &current, {source}{field_name}[_i]);
+	}}"""
+encode_varint_pointer_field = """
+	if(_ptr_count_too_big({source}{field_name}_len)) {{
+		return PTR_FIELD_TOO_LONG;
+	}}
+	_write_varint_len(buff, &current, {source}{field_name}_len);
+	for(int _i = 0; _i < {source}{field_name}_len; _i++) {{
+		_write_{codec}(buff, &current, {source}{field_name}[_i]);
+	}}"""
+
+encode_stream_field = """
+	_put_32(buff + current, {source}{field_name}_len);
+	current += sizeof(stream_len_t);"""
+
+encode_blob_field = """
+	_put_32(buff + current, {source}{field_name}.len);
+	current += sizeof(uint32_t);"""
+
+send_blob_field = """
+	if({source}{field_name}.len > 0) {{
+		int blob_bytes = _send_file_blob(socket_fd, &{source}{field_name});
+		if(blob_bytes < 0) {{
+			return blob_bytes;
+		}}
+		bytes_sent += blob_bytes;
+	}}"""
+
+send_stream_field = """
+	if({source}{field_name} != NULL) {{
+		int stream_bytes = _send_stream_data(socket_fd, {source}{field_name}, {source}{field_name}_len, {bits});
+		if(stream_bytes < 0) {{
+			return stream_bytes;
+		}}
+		bytes_sent += stream_bytes;
+	}}"""
 
 init_simple_field = "\tmsg->{field_name} = {field_name};"
 init_array_field = "\tmemcpy(msg->{field_name}, {field_name}, {length} * sizeof({type}));"
@@ -257,6 +1461,20 @@ init_string_field = """
 	}}
 	strcpy(msg->{field_name}, {field_name});
 """
+init_sized_string_field = """
+	if({field_name} == NULL) {{
+		{free_resources}
+		return BAD_DATA;
+	}}
+	msg->{field_name}_len = {field_name}_len;
+	msg->{field_name} = malloc({field_name}_len + 1);
+	if(msg->{field_name} == NULL) {{
+		{free_resources}
+		return ALLOC_ERROR; 
+	}}
+	memcpy(msg->{field_name}, {field_name}, {field_name}_len);
+	msg->{field_name}[{field_name}_len] = '\\0';
+"""
 init_pointer_field = """
 	if({field_name} == NULL) {{
 		{free_resources}
@@ -270,50 +1488,54 @@ init_pointer_field = """
 	}}
 	memcpy(msg->{field_name}, {field_name}, {field_name}_len * sizeof({type}));"""
 
+init_stream_field = """
+	msg->{field_name}_len = {field_name}_len;
+	msg->{field_name} = {field_name};"""
+
 destroy_field = \
 """free(msg->{field_name});
 	msg->{field_name} = NULL;"""
-
-simple_field_assignment = "msg.{field_name} = {field_name};"
-
-array_field_assignment = "memcpy(msg.{field_name}, {field_name}, {len} * sizeof({field_type}));"
-
-array_field_converter = """for(int i = 0; i < {len}; i++) {{
-		msg.{field_name}[i] = {convertion}(msg.{field_name}[i]);
-	}}"""
-pointer_field_converter = """for(int i = 0; i < msg.{field_name}_len; i++) {{
-		msg.{field_name}[i] = {convertion}(msg.{field_name}[i]);
-	}}"""
-
-simple_field_converter = "msg.{field_name} = {convertion}(msg.{field_name});"
-
-uint16_ntoh = "ntohs"
-
-uint16_hton = "htons"
-
-uint32_ntoh = "ntohl"
-
-uint32_hton = "htonl"
-
-uint64_ntoh = "be64toh"
-
-uint64_hton = "htobe64"
+free_init_pointer = \
+"""free(msg->{field_name});
+		msg->{field_name} = NULL;"""
 
 field_description_template = """
 {field_type} {field_name} {array_def}
 """
 
-pointer_create_parameter = "uint8_t {field_name}_len, {field_description}"
+pointer_create_parameter = "field_len_t {field_name}_len, {field_description}"
+stream_create_parameter = "stream_len_t {field_name}_len, {field_description}"
+sized_string_create_parameter = "uint32_t {field_name}_len, {field_description}"
 pointer_create_parameter_pass = "{field_name}_len, {field_name}"
 
 msg_handling_functions = """
-typedef int (*decoder_t)(void*, void*, int);
+typedef int (*decoder_t)(void*, int, void*, int, struct arena*);
 typedef void (*destroyer_t)(void*);
 typedef int (*encoder_t)(void*, uint8_t*, int);
 typedef int (*encoded_size_getter_t)(void*);
+typedef int (*stream_sender_t)(int, void*);
 
 int decode(void *data, void *buff, int max_size) {{
+	return decode_in_arena(data, buff, max_size, NULL);
+}}
+
+int decode_in_arena(void *data, void *buff, int max_size, struct arena* arena) {{
+	return decode_bounded_in_arena(data, MAX_ENCODED_SIZE, buff, max_size, arena);
+}}
+
+int decode_bounded(void *data, int data_size, void *buff, int max_size) {{
+	return decode_bounded_in_arena(data, data_size, buff, max_size, NULL);
+}}
+
+int decode_bounded_in_arena(void *data, int data_size, void *buff, int max_size, struct arena* arena) {{
 
+	// Igual a decode_in_arena(), pero sin leer más allá de los
+	// data_size bytes de data. Retorna BAD_DATA si el mensaje no
+	// entra en ellos.
+
+	if(data_size < 1) {{
+		return BAD_DATA;
+	}}
 	uint8_t* byte_data = (uint8_t*) data;
 
 	int msg_id = byte_data[0];
@@ -331,7 +1553,10 @@ int decode(void *data, void *buff, int max_size) {{
 		return BUFFER_TOO_SMALL;
 	}}
 
-	decoder(data, buff, body_size);
+	int error;
+	if((error = decoder(data, data_size, buff, body_size, arena)) < 0) {{
+		return error;
+	}}
 
 	return msg_id;
 }}
@@ -362,7 +1587,11 @@ int bytes_needed_to_pack(void* buffer) {{
 			return UNKNOWN_ID;
 	}}
 
-	return size_getter(buffer) + 2;
+	int encoded_size;
+	if((encoded_size = size_getter(buffer)) < 0) {{
+		return encoded_size;
+	}}
+	return encoded_size + FRAME_HEADER_SIZE;
 }}
 
 int send_msg(int socket_fd, void* buffer) {{
@@ -370,22 +1599,33 @@ int send_msg(int socket_fd, void* buffer) {{
 	uint8_t* byte_data = (uint8_t*) buffer;
 	int msg_id = byte_data[0];
 	encoder_t encoder;
+	stream_sender_t stream_sender;
 
 	switch(msg_id) {{{send_switch_cases}
 		default:
 			return UNKNOWN_ID;
 	}}
 
-	int packed_bytes = bytes_needed_to_pack(buffer);
-	int encoded_bytes = packed_bytes - 2;
-	int error;
-	uint8_t encoded[encoded_bytes];
-	uint8_t packed[packed_bytes];
-	if((error = encoder(buffer, encoded, encoded_bytes)) < 0) {{
-		return error;
+	int packed_bytes, encoded_bytes;
+	if((packed_bytes = bytes_needed_to_pack(buffer)) < 0) {{
+		return packed_bytes;
+	}}
+	if(_reserve_send_buffer(&_thread_send_buffer, packed_bytes) < 0) {{
+		return ALLOC_ERROR;
 	}}
-	pack_msg(encoded_bytes, encoded, packed);
-	return _send_full_msg(socket_fd, packed, packed_bytes);
+	uint8_t* packed = _thread_send_buffer.data;
+	if((encoded_bytes = encoder(buffer, packed + FRAME_HEADER_SIZE, packed_bytes - FRAME_HEADER_SIZE)) < 0) {{
+		return encoded_bytes;
+	}}
+	_put_frame_header(packed, encoded_bytes);
+	int bytes_sent, stream_bytes;
+	if((bytes_sent = _send_full_msg(socket_fd, packed, encoded_bytes + FRAME_HEADER_SIZE)) < 0) {{
+		return bytes_sent;
+	}}
+	if((stream_bytes = stream_sender(socket_fd, buffer)) < 0) {{
+		return stream_bytes;
+	}}
+	return bytes_sent + stream_bytes;
 }}
 
 int struct_size_from_id(uint8_t msg_id) {{
@@ -397,10 +1637,10 @@ int struct_size_from_id(uint8_t msg_id) {{
 	return size;
 }}
 
-int pack_msg(uint16_t body_size, void *msg_body, uint8_t *buff) {{
-	*((uint16_t*)buff) = htons(body_size);
-	memcpy(buff + 2, msg_body, body_size);
-	return body_size + 2;
+int pack_msg(frame_len_t body_size, void *msg_body, uint8_t *buff) {{
+	_put_frame_header(buff, body_size);
+	memcpy(buff + FRAME_HEADER_SIZE, msg_body, body_size);
+	return body_size + FRAME_HEADER_SIZE;
 }}
 
 int recv_n_bytes(int socket_fd, void* buffer, int bytes_to_read) {{
@@ -419,35 +1659,51 @@ int recv_n_bytes(int socket_fd, void* buffer, int bytes_to_read) {{
 	return 0;
 }}
 
-uint16_t recv_header(int socket_fd) {{
-	uint16_t header = 0;
+int recv_header(int socket_fd) {{
+	uint8_t header[FRAME_HEADER_SIZE];
 	int error = 0;
-	if((error = recv_n_bytes(socket_fd, &header, 2)) < 0) {{
+	if((error = recv_n_bytes(socket_fd, header, FRAME_HEADER_SIZE)) < 0) {{
 		return error;
 	}}
-	return ntohs(header);
+	frame_len_t msg_size = _read_frame_header(header);
+	if(_frame_too_big(msg_size)) {{
+		return MESSAGE_TOO_BIG;
+	}}
+	return msg_size;
 }}
 
 int recv_msg(int socket_fd, void* buffer, int max_size) {{
+	return recv_msg_in_arena(socket_fd, buffer, max_size, NULL);
+}}
+
+int recv_msg_in_arena(int socket_fd, void* buffer, int max_size, struct arena* arena) {{
 
 	if(max_size < get_max_msg_size()) {{
 		return BUFFER_TOO_SMALL;
 	}}
 	
-	uint16_t msg_size = 0;
-	int error;
+	int msg_size, error;
 	
 	if((msg_size = recv_header(socket_fd)) < 0) {{
 		return msg_size;
 	}}
 
-	uint8_t local_buffer[msg_size];
-
-	if((error = recv_n_bytes(socket_fd, local_buffer, msg_size)) < 0) {{
-		return error;
+	// Los paquetes chicos se reciben en el stack, los más grandes
+	// (posibles con --wide-frames) en el heap.
+	uint8_t stack_buffer[msg_size > 0 && msg_size <= MAX_STACK_FRAME_SIZE ? msg_size : 1];
+	uint8_t* local_buffer = stack_buffer;
+	if(msg_size > MAX_STACK_FRAME_SIZE && (local_buffer = malloc(msg_size)) == NULL) {{
+		return ALLOC_ERROR;
 	}}
 
-	return decode(local_buffer, buffer, max_size);
+	if((error = recv_n_bytes(socket_fd, local_buffer, msg_size)) == 0) {{
+		_capture_received_frame(socket_fd, local_buffer, msg_size);
+		error = decode_bounded_in_arena(local_buffer, msg_size, buffer, max_size, arena);
+	}}
+	if(local_buffer != stack_buffer) {{
+		free(local_buffer);
+	}}
+	return error;
 }}
 
 int _send_full_msg(int socket_fd, uint8_t* buffer, int bytes_to_send) {{
@@ -459,6 +1715,7 @@ int _send_full_msg(int socket_fd, uint8_t* buffer, int bytes_to_send) {{
 		}}
 		bytes_sent += num_bytes;
 	}}
+	_capture_sent(socket_fd, buffer, bytes_sent);
 	return bytes_sent;
 }}
 
@@ -482,7 +1739,7 @@ struct_size = "sizeof(struct {msg_name})"
 
 decode_switch_case = """
 		case {msg_name_upper}_ID:
-			decoder = &decode_{msg_name};
+			decoder = &_decode_{msg_name};
 			body_size = sizeof(struct {msg_name});
 			break;"""
 
@@ -499,6 +1756,7 @@ bytes_needed_switch_case = """
 send_switch_cases = """
 		case {msg_name_upper}_ID:
 			encoder = &encode_{msg_name};
+			stream_sender = &_send_{msg_name}_streams;
 			break;"""
 
 struct_size_switch_case = """
@@ -509,4 +1767,1528 @@ struct_size_switch_case = """
 # Utilities
 
 arrow_operator = "{first}->{second}"
-dot_operator = "{first}.{second}"
\ No newline at end of file
+dot_operator = "{first}.{second}"
+
+dispatch_functions = """
+#define CONNECTION_BUFFER_SIZE 4096
+#define CONNECTION_ARENA_SIZE 4096
+
+// Estado de lectura de una conexión. Los bytes recibidos se acumulan
+// en buffer hasta completar un paquete, que se decodifica en decoded
+// tomando la memoria de los campos de largo variable de arena. Todo
+// se reutiliza entre mensajes.
+struct connection_state {{
+	uint8_t* buffer;
+	int size;
+	int start;
+	int end;
+	void* decoded;
+	struct arena arena;
+}};
+
+void init_dispatcher(struct msg_dispatcher* dispatcher,
+		struct msg_handlers handlers, void* shared_data) {{
+	dispatcher->handlers = handlers;
+	dispatcher->shared_data = shared_data;
+	dispatcher->connections = NULL;
+	dispatcher->connections_size = 0;
+}}
+
+static void _destroy_connection_state(struct connection_state* state) {{
+	free(state->buffer);
+	free(state->decoded);
+	destroy_arena(&state->arena);
+	free(state);
+}}
+
+void dispatch_remove_client(struct msg_dispatcher* dispatcher, int client_fd) {{
+	if(client_fd >= 0 && client_fd < dispatcher->connections_size
+			&& dispatcher->connections[client_fd] != NULL) {{
+		_destroy_connection_state(dispatcher->connections[client_fd]);
+		dispatcher->connections[client_fd] = NULL;
+	}}
+}}
+
+int dispatch_close_client(int client_fd, void* data) {{
+
+	// Handler on_close del servidor: libera el estado del cliente.
+
+	dispatch_remove_client((struct msg_dispatcher*) data, client_fd);
+	return 0;
+}}
+
+void destroy_dispatcher(struct msg_dispatcher* dispatcher) {{
+	for(int fd = 0; fd < dispatcher->connections_size; fd++) {{
+		dispatch_remove_client(dispatcher, fd);
+	}}
+	free(dispatcher->connections);
+	dispatcher->connections = NULL;
+	dispatcher->connections_size = 0;
+}}
+
+static struct connection_state* _new_connection_state() {{
+	struct connection_state* state = calloc(1, sizeof(struct connection_state));
+	if(state == NULL) {{
+		return NULL;
+	}}
+	state->size = CONNECTION_BUFFER_SIZE;
+	state->buffer = malloc(CONNECTION_BUFFER_SIZE);
+	state->decoded = malloc(get_max_msg_size());
+	if(init_arena(&state->arena, NULL, CONNECTION_ARENA_SIZE) < 0
+			|| state->buffer == NULL || state->decoded == NULL) {{
+		_destroy_connection_state(state);
+		return NULL;
+	}}
+	return state;
+}}
+
+int dispatch_new_client(int client_fd, void* data) {{
+
+	// Pone al cliente en modo no bloqueante y crea su estado de lectura.
+
+	struct msg_dispatcher* dispatcher = (struct msg_dispatcher*) data;
+	int flags = fcntl(client_fd, F_GETFL);
+	if(flags == -1 || fcntl(client_fd, F_SETFL, flags | O_NONBLOCK) == -1) {{
+		return CLOSE_CLIENT;
+	}}
+	if(client_fd >= dispatcher->connections_size) {{
+		int new_size = dispatcher->connections_size > 0 ? dispatcher->connections_size : 16;
+		while(new_size <= client_fd) {{
+			new_size *= 2;
+		}}
+		struct connection_state** new_connections = realloc(dispatcher->connections,
+			new_size * sizeof(struct connection_state*));
+		if(new_connections == NULL) {{
+			return CLOSE_CLIENT;
+		}}
+		for(int fd = dispatcher->connections_size; fd < new_size; fd++) {{
+			new_connections[fd] = NULL;
+		}}
+		dispatcher->connections = new_connections;
+		dispatcher->connections_size = new_size;
+	}}
+	dispatch_remove_client(dispatcher, client_fd);
+	if((dispatcher->connections[client_fd] = _new_connection_state()) == NULL) {{
+		return CLOSE_CLIENT;
+	}}
+	return 0;
+}}
+
+static int _reserve_connection_buffer(struct connection_state* state, int64_t needed) {{
+
+	// Mueve los datos sin procesar al principio del buffer y se asegura
+	// de que este tenga lugar para needed bytes.
+
+	if(state->start > 0) {{
+		memmove(state->buffer, state->buffer + state->start, state->end - state->start);
+		state->end -= state->start;
+		state->start = 0;
+	}}
+	if(needed <= state->size) {{
+		return 0;
+	}}
+	int64_t new_size = state->size;
+	while(new_size < needed) {{
+		new_size *= 2;
+	}}
+	if(new_size > INT32_MAX) {{
+		new_size = needed;
+	}}
+	uint8_t* new_buffer = realloc(state->buffer, new_size);
+	if(new_buffer == NULL) {{
+		return ALLOC_ERROR;
+	}}
+	state->buffer = new_buffer;
+	state->size = new_size;
+	return 0;
+}}
+
+static int _dispatch_frame(struct msg_dispatcher* dispatcher, int client_fd,
+		struct connection_state* state, uint8_t* data, int len) {{
+
+	// Decodifica un paquete en el estado de la conexión y llama al
+	// handler del mensaje. Si los campos no entran en la arena, la
+	// agranda y vuelve a decodificar.
+
+	int msg_id;
+	reset_arena(&state->arena);
+	while((msg_id = decode_bounded_in_arena(data, len, state->decoded, get_max_msg_size(), &state->arena)) == ALLOC_ERROR) {{
+		// Un mensaje válido no ocupa decodificado más de 16 veces su
+		// tamaño codificado
+		int new_size = state->arena.size * 2;
+		if(state->arena.size > 16 * (int64_t) len + CONNECTION_ARENA_SIZE) {{
+			return CLOSE_CLIENT;
+		}}
+		destroy_arena(&state->arena);
+		if(init_arena(&state->arena, NULL, new_size) < 0) {{
+			state->arena.buffer = NULL;
+			state->arena.size = 0;
+			return CLOSE_CLIENT;
+		}}
+	}}
+	if(msg_id < 0) {{
+		return CLOSE_CLIENT;
+	}}
+
+	switch(msg_id) {{{dispatch_switch_cases}
+	}}
+	return 0;
+}}
+
+int dispatch_can_read(int client_fd, void* data) {{
+
+	// Lee los datos disponibles del cliente y despacha todos los
+	// paquetes completos. Si el cliente cerró la conexión, envió datos
+	// inválidos o un handler retornó CLOSE_CLIENT, libera su estado y
+	// retorna CLOSE_CLIENT.
+
+	struct msg_dispatcher* dispatcher = (struct msg_dispatcher*) data;
+	struct connection_state* state = NULL;
+	if(client_fd < dispatcher->connections_size) {{
+		state = dispatcher->connections[client_fd];
+	}}
+	if(state == NULL) {{
+		return CLOSE_CLIENT;
+	}}
+
+	if(_reserve_connection_buffer(state, state->end - state->start + 1) < 0) {{
+		dispatch_remove_client(dispatcher, client_fd);
+		return CLOSE_CLIENT;
+	}}
+	ssize_t num_bytes = recv(client_fd, state->buffer + state->end, state->size - state->end, 0);
+	if(num_bytes == -1 && (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR)) {{
+		return 0;
+	}} else if(num_bytes < 1) {{
+		dispatch_remove_client(dispatcher, client_fd);
+		return CLOSE_CLIENT;
+	}}
+	state->end += num_bytes;
+
+	while(state->end - state->start >= FRAME_HEADER_SIZE) {{
+		uint8_t* frame = state->buffer + state->start;
+		int64_t frame_len = _get_frame_len(frame);
+		if(frame_len == 0 || frame_len > MAX_ENCODED_SIZE) {{
+			dispatch_remove_client(dispatcher, client_fd);
+			return CLOSE_CLIENT;
+		}}
+		if(state->end - state->start < FRAME_HEADER_SIZE + frame_len) {{
+			// Paquete incompleto, se espera a recibir el resto
+			if(_reserve_connection_buffer(state, FRAME_HEADER_SIZE + frame_len) < 0) {{
+				dispatch_remove_client(dispatcher, client_fd);
+				return CLOSE_CLIENT;
+			}}
+			break;
+		}}
+		state->start += FRAME_HEADER_SIZE + frame_len;
+		// Además de la longitud, leer el encabezado actualiza el id de
+		// correlación del thread con el del paquete (con
+		// --correlation-ids), para que las respuestas lo lleven
+		frame_len = _read_frame_header(frame);
+		_capture_received(client_fd, frame, FRAME_HEADER_SIZE + frame_len);
+		int ret = _dispatch_frame(dispatcher, client_fd, state, frame + FRAME_HEADER_SIZE, frame_len);
+		if(ret == CLOSE_CLIENT) {{
+			dispatch_remove_client(dispatcher, client_fd);
+			return CLOSE_CLIENT;
+		}} else if(ret == STOP_SERVER) {{
+			return STOP_SERVER;
+		}}
+	}}
+	return 0;
+}}
+"""
+
+dispatch_switch_case = """
+		case {msg_name_upper}_ID:
+			if(dispatcher->handlers.on_{msg_name} == NULL) {{
+				return 0;
+			}}
+			return dispatcher->handlers.on_{msg_name}(client_fd,
+				(const struct {msg_name}*) state->decoded, dispatcher->shared_data);"""
+
+trailing_data_dispatch_switch_case = """
+		case {msg_name_upper}_ID:
+			// Los datos de los campos stream y blob van a continuación del
+			// paquete y no pueden recibirse con el dispatcher
+			return CLOSE_CLIENT;"""
+
+relay_functions = """
+static int _frame_has_trailing_data(uint8_t msg_id) {{
+	switch(msg_id) {{{trailing_data_cases}
+		default:
+			return 0;
+	}}
+}}
+
+int recv_frame_route(int socket_fd, struct frame_route* route) {{
+
+	// Recibe solo el encabezado y el id del próximo paquete de
+	// socket_fd, sin decodificarlo. El resto del paquete queda en el
+	// socket para reenviarlo con relay_frame() o descartarlo con
+	// discard_frame(). Retorna el id del mensaje.
+
+	int error;
+	route->header_size = FRAME_HEADER_SIZE + 1;
+	if((error = recv_n_bytes(socket_fd, route->header, route->header_size)) < 0) {{
+		return error;
+	}}
+	route->frame_len = _get_frame_len(route->header);
+	if(route->frame_len == 0) {{
+		return BAD_DATA;
+	}} else if(route->frame_len > MAX_ENCODED_SIZE) {{
+		return MESSAGE_TOO_BIG;
+	}}
+	route->msg_id = route->header[FRAME_HEADER_SIZE];
+	return route->msg_id;
+}}
+
+int relay_frame(int to_fd, int from_fd, const struct frame_route* route) {{
+
+	// Reenvía a to_fd el paquete de from_fd cuyo encabezado se recibió
+	// con recv_frame_route(): envía el encabezado sin modificarlo y
+	// mueve el resto del paquete de un socket al otro con relay_bytes().
+	// Los mensajes con campos stream o blob no pueden reenviarse, ya que
+	// sus datos van a continuación del paquete. Retorna la cantidad de
+	// bytes reenviados.
+
+	if(_frame_has_trailing_data(route->msg_id)) {{
+		return BAD_DATA;
+	}}
+	int bytes_sent = 0;
+	while(bytes_sent < route->header_size) {{
+		int num_bytes = send(to_fd, route->header + bytes_sent,
+			route->header_size - bytes_sent, MSG_MORE | MSG_NOSIGNAL);
+		if(num_bytes == -1) {{
+			return SOCKET_ERROR;
+		}}
+		bytes_sent += num_bytes;
+	}}
+	int64_t body_len = route->frame_len - 1;
+	int64_t relayed = relay_bytes(from_fd, to_fd, body_len);
+	if(relayed == -1) {{
+		return SOCKET_ERROR;
+	}} else if(relayed < body_len) {{
+		return CONN_CLOSED;
+	}}
+	return route->header_size + body_len;
+}}
+
+int discard_frame(int socket_fd, const struct frame_route* route) {{
+
+	// Descarta el resto del paquete de socket_fd cuyo encabezado se
+	// recibió con recv_frame_route().
+
+	if(_frame_has_trailing_data(route->msg_id)) {{
+		return BAD_DATA;
+	}}
+	uint8_t buffer[4096];
+	int64_t pending = route->frame_len - 1;
+	while(pending > 0) {{
+		int chunk = pending < (int64_t) sizeof(buffer) ? pending : (int64_t) sizeof(buffer);
+		int error;
+		if((error = recv_n_bytes(socket_fd, buffer, chunk)) < 0) {{
+			return error;
+		}}
+		pending -= chunk;
+	}}
+	return 0;
+}}
+"""
+
+relay_trailing_data_case = """
+		case {msg_name_upper}_ID:"""
+
+relay_trailing_data_return = """
+			return 1;"""
+
+correlation_functions = """
+static __thread uint32_t _thread_correlation_id;
+
+void set_correlation_id(uint32_t correlation_id) {
+	_thread_correlation_id = correlation_id;
+}
+
+uint32_t get_correlation_id() {
+	return _thread_correlation_id;
+}
+
+// Pedido en curso de un multiplexor. Vive en el stack del thread que
+// lo hizo y está en la lista de pendientes mientras espera respuesta.
+struct pending_request {
+	uint32_t id;
+	void* response;
+	int max_size;
+	int result;
+	int done;
+	pthread_cond_t cond;
+	struct pending_request* next;
+};
+
+static void _remove_pending_request(struct msg_multiplexer* multiplexer,
+		struct pending_request* request) {
+	for(struct pending_request** p = &multiplexer->pending; *p != NULL; p = &(*p)->next) {
+		if(*p == request) {
+			*p = request->next;
+			return;
+		}
+	}
+}
+
+static void _fail_pending_requests(struct msg_multiplexer* multiplexer, int error) {
+	pthread_mutex_lock(&multiplexer->lock);
+	multiplexer->error = error;
+	for(struct pending_request* p = multiplexer->pending; p != NULL; p = p->next) {
+		p->result = error;
+		p->done = 1;
+		pthread_cond_signal(&p->cond);
+	}
+	multiplexer->pending = NULL;
+	pthread_mutex_unlock(&multiplexer->lock);
+}
+
+static void* _run_multiplexer_receiver(void* data) {
+
+	// Recibe las respuestas de la conexión y las decodifica en el buffer
+	// del pedido con su mismo id. Las respuestas a pedidos que ya no
+	// esperan se descartan. Si la conexión falla, todos los pedidos
+	// pendientes y futuros fallan con el mismo error.
+
+	struct msg_multiplexer* multiplexer = (struct msg_multiplexer*) data;
+	uint8_t header[FRAME_HEADER_SIZE];
+	uint8_t* body = NULL;
+	int64_t body_size = 0;
+	int error;
+	while(1) {
+		if((error = recv_n_bytes(multiplexer->socket_fd, header, FRAME_HEADER_SIZE)) < 0) {
+			break;
+		}
+		int64_t len = _get_frame_len(header);
+		uint32_t id = _get_32(header + FRAME_LEN_SIZE);
+		if(len == 0 || len > MAX_ENCODED_SIZE) {
+			error = BAD_DATA;
+			break;
+		}
+		if(len > body_size) {
+			uint8_t* new_body = realloc(body, len);
+			if(new_body == NULL) {
+				error = ALLOC_ERROR;
+				break;
+			}
+			body = new_body;
+			body_size = len;
+		}
+		if((error = recv_n_bytes(multiplexer->socket_fd, body, len)) < 0) {
+			break;
+		}
+		pthread_mutex_lock(&multiplexer->lock);
+		for(struct pending_request* p = multiplexer->pending; p != NULL; p = p->next) {
+			if(p->id == id) {
+				p->result = decode_bounded(body, len, p->response, p->max_size);
+				p->done = 1;
+				_remove_pending_request(multiplexer, p);
+				pthread_cond_signal(&p->cond);
+				break;
+			}
+		}
+		pthread_mutex_unlock(&multiplexer->lock);
+	}
+	free(body);
+	_fail_pending_requests(multiplexer, error);
+	return NULL;
+}
+
+int init_multiplexer(struct msg_multiplexer* multiplexer, int socket_fd) {
+
+	// Inicializa el multiplexor sobre una conexión ya establecida e
+	// inicia su thread receptor. A partir de aquí solo el multiplexor
+	// debe leer de la conexión.
+
+	multiplexer->socket_fd = socket_fd;
+	multiplexer->pending = NULL;
+	multiplexer->next_id = 1;
+	multiplexer->error = 0;
+	pthread_mutex_init(&multiplexer->send_lock, NULL);
+	pthread_mutex_init(&multiplexer->lock, NULL);
+	if(pthread_create(&multiplexer->receiver, NULL, &_run_multiplexer_receiver, multiplexer) != 0) {
+		pthread_mutex_destroy(&multiplexer->send_lock);
+		pthread_mutex_destroy(&multiplexer->lock);
+		return SOCKET_ERROR;
+	}
+	return 0;
+}
+
+void destroy_multiplexer(struct msg_multiplexer* multiplexer) {
+
+	// Cierra la lectura y escritura de la conexión (sin cerrar el
+	// file descriptor), con lo que los pedidos pendientes fallan, y
+	// espera a que finalice el thread receptor.
+
+	shutdown(multiplexer->socket_fd, SHUT_RDWR);
+	pthread_join(multiplexer->receiver, NULL);
+	pthread_mutex_destroy(&multiplexer->send_lock);
+	pthread_mutex_destroy(&multiplexer->lock);
+}
+
+int multiplexer_request(struct msg_multiplexer* multiplexer, void* request,
+		void* response, int max_size, int timeout_ms) {
+
+	// Envía el mensaje request y espera su respuesta, que se decodifica
+	// en response como con recv_msg(). Si no llega en timeout_ms
+	// milisegundos retorna TIMED_OUT; con un timeout negativo espera
+	// indefinidamente. Puede llamarse desde varios threads a la vez.
+
+	if(max_size < get_max_msg_size()) {
+		return BUFFER_TOO_SMALL;
+	}
+
+	struct pending_request pending;
+	pending.response = response;
+	pending.max_size = max_size;
+	pending.done = 0;
+	pthread_condattr_t attr;
+	pthread_condattr_init(&attr);
+	pthread_condattr_setclock(&attr, CLOCK_MONOTONIC);
+	pthread_cond_init(&pending.cond, &attr);
+	pthread_condattr_destroy(&attr);
+
+	// El pedido se registra antes de enviarse para no perder una
+	// respuesta que llegue enseguida
+	pthread_mutex_lock(&multiplexer->lock);
+	int error = multiplexer->error;
+	if(error == 0) {
+		pending.id = multiplexer->next_id++;
+		if(multiplexer->next_id == 0) {
+			multiplexer->next_id = 1;
+		}
+		pending.next = multiplexer->pending;
+		multiplexer->pending = &pending;
+	}
+	pthread_mutex_unlock(&multiplexer->lock);
+	if(error < 0) {
+		pthread_cond_destroy(&pending.cond);
+		return error;
+	}
+
+	pthread_mutex_lock(&multiplexer->send_lock);
+	uint32_t previous_id = get_correlation_id();
+	set_correlation_id(pending.id);
+	int sent = send_msg(multiplexer->socket_fd, request);
+	set_correlation_id(previous_id);
+	pthread_mutex_unlock(&multiplexer->send_lock);
+
+	struct timespec deadline;
+	clock_gettime(CLOCK_MONOTONIC, &deadline);
+	deadline.tv_sec += timeout_ms / 1000;
+	deadline.tv_nsec += (long) (timeout_ms % 1000) * 1000000;
+	if(deadline.tv_nsec >= 1000000000) {
+		deadline.tv_sec++;
+		deadline.tv_nsec -= 1000000000;
+	}
+
+	pthread_mutex_lock(&multiplexer->lock);
+	if(sent < 0 && !pending.done) {
+		_remove_pending_request(multiplexer, &pending);
+		pending.result = sent;
+		pending.done = 1;
+	}
+	while(!pending.done) {
+		if(timeout_ms < 0) {
+			pthread_cond_wait(&pending.cond, &multiplexer->lock);
+		} else if(pthread_cond_timedwait(&pending.cond, &multiplexer->lock, &deadline) == ETIMEDOUT
+				&& !pending.done) {
+			_remove_pending_request(multiplexer, &pending);
+			pending.result = TIMED_OUT;
+			pending.done = 1;
+		}
+	}
+	pthread_mutex_unlock(&multiplexer->lock);
+	pthread_cond_destroy(&pending.cond);
+	return pending.result;
+}
+"""
+
+# Con la opción --shared-memory, el protocolo define un canal de memoria
+# compartida: un ring buffer de un único productor y un único consumidor
+# en un memfd, en el que los paquetes se empaquetan y decodifican sin
+# copias intermedias.
+
+shm_includes = """
+#include <sys/eventfd.h>
+#include <sys/stat.h>
+"""
+
+shm_functions = """
+#define SHM_RECORD_ALIGN 8
+#define SHM_MIN_CAPACITY 4096
+#define SHM_SPIN_ITERATIONS 1024
+
+// Región compartida de un canal. head es la cantidad de bytes escritos
+// por el productor y tail la de bytes consumidos por el consumidor, cada
+// uno en su propia línea de cache. Cada paquete ocupa un registro
+// contiguo de data alineado a SHM_RECORD_ALIGN bytes: si no entra antes
+// del final del ring, el resto se marca con un encabezado de longitud 0
+// y el paquete va al principio. consumer_waiting indica que el
+// consumidor está por dormir en el eventfd y hay que despertarlo.
+struct shm_ring {
+	_Alignas(64) uint64_t head;
+	_Alignas(64) uint64_t tail;
+	_Alignas(64) uint32_t consumer_waiting;
+	uint32_t closed;
+	_Alignas(64) uint8_t data[];
+};
+
+static uint64_t _shm_record_size(uint64_t frame_size) {
+	return (frame_size + SHM_RECORD_ALIGN - 1) & ~(uint64_t) (SHM_RECORD_ALIGN - 1);
+}
+
+static void _wake_shm_consumer(struct shm_channel* channel) {
+	uint64_t wake = 1;
+	while(write(channel->eventfd, &wake, sizeof wake) == -1 && errno == EINTR);
+}
+
+int open_shm_channel(struct shm_channel* channel, int memfd, int eventfd) {
+
+	// Mapea el canal del memfd y el eventfd dados, creados con
+	// create_shm_channel() por este u otro proceso. La capacidad se
+	// deduce del tamaño del memfd.
+
+	struct stat memfd_stat;
+	if(fstat(memfd, &memfd_stat) == -1) {
+		return SOCKET_ERROR;
+	}
+	uint64_t capacity = memfd_stat.st_size - sizeof(struct shm_ring);
+	if(memfd_stat.st_size <= (off_t) sizeof(struct shm_ring)
+			|| capacity > UINT32_MAX || (capacity & (capacity - 1)) != 0) {
+		return BAD_DATA;
+	}
+	void* map = mmap(NULL, memfd_stat.st_size, PROT_READ | PROT_WRITE, MAP_SHARED, memfd, 0);
+	if(map == MAP_FAILED) {
+		return SOCKET_ERROR;
+	}
+	channel->ring = (struct shm_ring*) map;
+	channel->data = channel->ring->data;
+	channel->capacity = capacity;
+	channel->pending_head = 0;
+	channel->map_size = memfd_stat.st_size;
+	channel->memfd = memfd;
+	channel->eventfd = eventfd;
+	return 0;
+}
+
+int create_shm_channel(struct shm_channel* channel, uint32_t capacity) {
+
+	// Crea un canal con un ring de al menos capacity bytes (redondeado
+	// a una potencia de 2). Retorna SOCKET_ERROR, con errno seteada, si
+	// no pudo crearlo.
+
+	uint64_t size = SHM_MIN_CAPACITY;
+	while(size < capacity) {
+		size *= 2;
+	}
+	if(size > UINT32_MAX) {
+		return MESSAGE_TOO_BIG;
+	}
+	int memfd, efd, error;
+	if((memfd = memfd_create("shm_channel", MFD_CLOEXEC)) == -1) {
+		return SOCKET_ERROR;
+	}
+	if(ftruncate(memfd, sizeof(struct shm_ring) + size) == -1
+			|| (efd = eventfd(0, EFD_CLOEXEC)) == -1) {
+		close(memfd);
+		return SOCKET_ERROR;
+	}
+	if((error = open_shm_channel(channel, memfd, efd)) < 0) {
+		close(memfd);
+		close(efd);
+	}
+	return error;
+}
+
+void close_shm_channel(struct shm_channel* channel) {
+
+	// Cierra el canal de este lado y le avisa al otro: el consumidor
+	// recibe CONN_CLOSED luego de los paquetes pendientes y el
+	// productor al intentar enviar.
+
+	__atomic_store_n(&channel->ring->closed, 1, __ATOMIC_RELEASE);
+	_wake_shm_consumer(channel);
+	munmap(channel->ring, channel->map_size);
+	close(channel->memfd);
+	close(channel->eventfd);
+}
+
+int send_shm_channel(int socket_fd, struct shm_channel* channel) {
+
+	// Envía los file descriptors del canal por un socket unix, para que
+	// otro proceso lo abra con recv_shm_channel().
+
+	int fds[2] = { channel->memfd, channel->eventfd };
+	char control[CMSG_SPACE(sizeof fds)];
+	uint8_t byte = 0;
+	struct iovec iov = { &byte, 1 };
+	struct msghdr msg;
+	memset(&msg, 0, sizeof msg);
+	memset(control, 0, sizeof control);
+	msg.msg_iov = &iov;
+	msg.msg_iovlen = 1;
+	msg.msg_control = control;
+	msg.msg_controllen = sizeof control;
+	struct cmsghdr* cmsg = CMSG_FIRSTHDR(&msg);
+	cmsg->cmsg_level = SOL_SOCKET;
+	cmsg->cmsg_type = SCM_RIGHTS;
+	cmsg->cmsg_len = CMSG_LEN(sizeof fds);
+	memcpy(CMSG_DATA(cmsg), fds, sizeof fds);
+	if(sendmsg(socket_fd, &msg, 0) == -1) {
+		return SOCKET_ERROR;
+	}
+	return 0;
+}
+
+int recv_shm_channel(int socket_fd, struct shm_channel* channel) {
+
+	// Recibe por un socket unix los file descriptors de un canal
+	// enviado con send_shm_channel() y lo abre.
+
+	int fds[2];
+	char control[CMSG_SPACE(sizeof fds)];
+	uint8_t byte;
+	struct iovec iov = { &byte, 1 };
+	struct msghdr msg;
+	memset(&msg, 0, sizeof msg);
+	msg.msg_iov = &iov;
+	msg.msg_iovlen = 1;
+	msg.msg_control = control;
+	msg.msg_controllen = sizeof control;
+	ssize_t num_bytes = recvmsg(socket_fd, &msg, MSG_CMSG_CLOEXEC);
+	if(num_bytes == 0) {
+		return CONN_CLOSED;
+	} else if(num_bytes == -1) {
+		return SOCKET_ERROR;
+	}
+	struct cmsghdr* cmsg = CMSG_FIRSTHDR(&msg);
+	if(cmsg == NULL || cmsg->cmsg_level != SOL_SOCKET || cmsg->cmsg_type != SCM_RIGHTS
+			|| cmsg->cmsg_len != CMSG_LEN(sizeof fds)) {
+		return BAD_DATA;
+	}
+	memcpy(fds, CMSG_DATA(cmsg), sizeof fds);
+	int error;
+	if((error = open_shm_channel(channel, fds[0], fds[1])) < 0) {
+		close(fds[0]);
+		close(fds[1]);
+	}
+	return error;
+}
+
+static int _reserve_shm_frame(struct shm_channel* channel, uint64_t frame_size, uint8_t** frame) {
+
+	// Reserva en el ring un registro contiguo para un paquete de
+	// frame_size bytes y lo retorna en frame. El paquete queda visible
+	// para el consumidor al llamar a _commit_shm_frame(). Retorna
+	// RING_FULL si el consumidor todavía no liberó suficiente espacio.
+
+	struct shm_ring* ring = channel->ring;
+	if(__atomic_load_n(&ring->closed, __ATOMIC_ACQUIRE)) {
+		return CONN_CLOSED;
+	}
+	uint64_t record_size = _shm_record_size(frame_size);
+	if(record_size > channel->capacity) {
+		return MESSAGE_TOO_BIG;
+	}
+	uint64_t head = __atomic_load_n(&ring->head, __ATOMIC_RELAXED);
+	uint64_t tail = __atomic_load_n(&ring->tail, __ATOMIC_ACQUIRE);
+	uint64_t offset = head & (channel->capacity - 1);
+	uint64_t contiguous = channel->capacity - offset;
+	uint64_t needed = record_size <= contiguous ? record_size : contiguous + record_size;
+	if(channel->capacity - (head - tail) < needed) {
+		return RING_FULL;
+	}
+	if(record_size > contiguous) {
+		_put_frame_len(channel->data + offset, 0);
+		head += contiguous;
+		offset = 0;
+	}
+	channel->pending_head = head + record_size;
+	*frame = channel->data + offset;
+	return 0;
+}
+
+static void _commit_shm_frame(struct shm_channel* channel) {
+
+	// Publica el paquete reservado y, si el consumidor está durmiendo,
+	// lo despierta. La barrera evita que el productor lea
+	// consumer_waiting antes de publicar, lo que podría dejar al
+	// consumidor dormido con un paquete pendiente.
+
+	__atomic_store_n(&channel->ring->head, channel->pending_head, __ATOMIC_RELEASE);
+	__atomic_thread_fence(__ATOMIC_SEQ_CST);
+	if(__atomic_load_n(&channel->ring->consumer_waiting, __ATOMIC_RELAXED)) {
+		_wake_shm_consumer(channel);
+	}
+}
+
+static int _wait_shm_data(struct shm_channel* channel, uint64_t tail, uint64_t* head) {
+
+	// Espera a que el ring tenga datos sin consumir y retorna en head
+	// hasta dónde. Primero consulta activamente SHM_SPIN_ITERATIONS
+	// veces y luego duerme en el eventfd hasta que el productor lo
+	// despierte.
+
+	struct shm_ring* ring = channel->ring;
+	for(int i = 0; i < SHM_SPIN_ITERATIONS; i++) {
+		if((*head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE)) != tail) {
+			return 0;
+		}
+	}
+	int error = 0;
+	while(1) {
+		__atomic_store_n(&ring->consumer_waiting, 1, __ATOMIC_RELAXED);
+		__atomic_thread_fence(__ATOMIC_SEQ_CST);
+		if((*head = __atomic_load_n(&ring->head, __ATOMIC_ACQUIRE)) != tail) {
+			break;
+		}
+		if(__atomic_load_n(&ring->closed, __ATOMIC_ACQUIRE)) {
+			error = CONN_CLOSED;
+			break;
+		}
+		uint64_t count;
+		if(read(channel->eventfd, &count, sizeof count) == -1 && errno != EINTR) {
+			error = SOCKET_ERROR;
+			break;
+		}
+	}
+	__atomic_store_n(&ring->consumer_waiting, 0, __ATOMIC_RELAXED);
+	return error;
+}
+
+int shm_recv_msg(struct shm_channel* channel, void* buffer, int max_size) {
+	return shm_recv_msg_in_arena(channel, buffer, max_size, NULL);
+}
+
+int shm_recv_msg_in_arena(struct shm_channel* channel, void* buffer, int max_size, struct arena* arena) {
+
+	// Igual a recv_msg_in_arena(), pero recibe el próximo paquete del
+	// canal. El paquete se decodifica directamente desde el ring y
+	// recién después se libera su espacio.
+
+	if(max_size < get_max_msg_size()) {
+		return BUFFER_TOO_SMALL;
+	}
+	struct shm_ring* ring = channel->ring;
+	uint64_t tail = __atomic_load_n(&ring->tail, __ATOMIC_RELAXED);
+	while(1) {
+		uint64_t head;
+		int error;
+		if((error = _wait_shm_data(channel, tail, &head)) < 0) {
+			return error;
+		}
+		uint64_t offset = tail & (channel->capacity - 1);
+		uint8_t* frame = channel->data + offset;
+		uint64_t frame_len = _get_frame_len(frame);
+		if(frame_len == 0) {
+			// Marca de fin del ring, el paquete está al principio
+			tail += channel->capacity - offset;
+			__atomic_store_n(&ring->tail, tail, __ATOMIC_RELEASE);
+			continue;
+		}
+		uint64_t record_size = _shm_record_size(FRAME_HEADER_SIZE + frame_len);
+		if(frame_len > MAX_ENCODED_SIZE || record_size > channel->capacity - offset
+				|| record_size > head - tail) {
+			return BAD_DATA;
+		}
+		// Además de la longitud, leer el encabezado actualiza el id de
+		// correlación del thread con el del paquete (con
+		// --correlation-ids)
+		frame_len = _read_frame_header(frame);
+		int ret = decode_bounded_in_arena(frame + FRAME_HEADER_SIZE, frame_len, buffer, max_size, arena);
+		__atomic_store_n(&ring->tail, tail + record_size, __ATOMIC_RELEASE);
+		return ret;
+	}
+}
+"""
+
+shm_send_msg_function = """
+int shm_send_msg(struct shm_channel* channel, void* buffer) {{
+
+	// Igual a send_msg(), pero codifica el mensaje directamente en el
+	// ring del canal. Retorna RING_FULL si no hay espacio.
+
+	uint8_t* byte_data = (uint8_t*) buffer;
+	int msg_id = byte_data[0];
+	encoder_t encoder;
+
+	switch(msg_id) {{{shm_send_switch_cases}
+		default:
+			return UNKNOWN_ID;
+	}}
+
+	int packed_bytes, encoded_bytes, error;
+	uint8_t* frame;
+	if((packed_bytes = bytes_needed_to_pack(buffer)) < 0) {{
+		return packed_bytes;
+	}}
+	if((error = _reserve_shm_frame(channel, packed_bytes, &frame)) < 0) {{
+		return error;
+	}}
+	if((encoded_bytes = encoder(buffer, frame + FRAME_HEADER_SIZE, packed_bytes - FRAME_HEADER_SIZE)) < 0) {{
+		return encoded_bytes;
+	}}
+	_put_frame_header(frame, encoded_bytes);
+	_commit_shm_frame(channel);
+	return packed_bytes;
+}}
+"""
+
+shm_send_switch_case = """
+		case {msg_name_upper}_ID:
+			encoder = &encode_{msg_name};
+			break;"""
+
+# Los mensajes con campos stream o blob no pueden enviarse por un canal
+# de memoria compartida, ya que sus datos van a continuación del paquete.
+
+trailing_data_shm_send_switch_case = """
+		case {msg_name_upper}_ID:
+			return BAD_DATA;"""
+
+# Decodificación de paquetes ya recibidos, por ejemplo leídos de un
+# archivo. Se genera con la opción --python, ya que la usa el módulo.
+
+frame_decoding_definitions = """
+int get_frame_size(void*, int);
+int decode_frame_in_arena(void*, void*, int, struct arena*);
+"""
+
+frame_decoding_functions = """
+int get_frame_size(void* data, int size) {
+
+	// Retorna el tamaño (encabezado incluido) del paquete que empieza
+	// en data, o 0 si los size bytes no alcanzan para leer su
+	// encabezado. El paquete está completo si el tamaño no supera size.
+
+	if(size < FRAME_HEADER_SIZE) {
+		return 0;
+	}
+	uint32_t frame_len = _get_frame_len((uint8_t*) data);
+	if(frame_len == 0) {
+		return BAD_DATA;
+	} else if(frame_len > MAX_ENCODED_SIZE) {
+		return MESSAGE_TOO_BIG;
+	}
+	return frame_len + FRAME_HEADER_SIZE;
+}
+
+int decode_frame_in_arena(void* frame, void* buff, int max_size, struct arena* arena) {
+
+	// Igual a decode_in_arena(), pero recibe el paquete completo,
+	// con su encabezado, y no lee más allá de la longitud que este
+	// indica. El paquete debe estar completo (ver get_frame_size()).
+
+	uint32_t frame_len = _get_frame_len((uint8_t*) frame);
+	if(frame_len > MAX_ENCODED_SIZE) {
+		return MESSAGE_TOO_BIG;
+	}
+	return decode_bounded_in_arena((uint8_t*) frame + FRAME_HEADER_SIZE, frame_len, buff, max_size, arena);
+}
+"""
+
+# Módulo de Python (opción --python). Envuelve las funciones generadas
+# para codificar mensajes y decodificar muchos paquetes en una llamada.
+
+python_module_start = """#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <limits.h>
+#include "{header_name}"
+
+// Paquetes que se decodifican sin el GIL antes de convertirlos en
+// objetos de Python, y memoria para sus campos de largo variable.
+#define BATCH_SIZE 256
+#define BATCH_ARENA_SIZE (1 << 20)
+
+// Error de decode_frames() al encontrar un mensaje con campos stream o
+// blob, cuyos datos no forman parte del paquete.
+#define HAS_TRAILING_DATA (UNKNOWN_ID - 1)
+
+// Tipo de Python de los mensajes decodificados: una tupla con nombres
+// de campos, como las de collections.namedtuple().
+struct message_type {{
+	PyStructSequence_Desc description;
+	PyTypeObject* type;
+	PyObject** keys;
+}};
+
+static PyObject* _protocol_error;
+
+static const char* _error_name(int error) {{
+	switch(error) {{
+		case UNKNOWN_ID:
+			return "UNKNOWN_ID";
+		case BAD_DATA:
+			return "BAD_DATA";
+		case ALLOC_ERROR:
+			return "ALLOC_ERROR";
+		case BUFFER_TOO_SMALL:
+			return "BUFFER_TOO_SMALL";
+		case PTR_FIELD_TOO_LONG:
+			return "PTR_FIELD_TOO_LONG";
+		case MESSAGE_TOO_BIG:
+			return "MESSAGE_TOO_BIG";
+		case HAS_TRAILING_DATA:
+			return "HAS_TRAILING_DATA";
+		default:
+			return "UNKNOWN_ERROR";
+	}}
+}}
+
+static void _set_codec_error(int error, Py_ssize_t offset) {{
+
+	// Lanza la excepción que corresponde al error error de las
+	// funciones generadas. Si offset no es negativo, es la posición
+	// del paquete que lo produjo.
+
+	if(error == ALLOC_ERROR) {{
+		PyErr_NoMemory();
+	}} else if(offset >= 0) {{
+		PyErr_Format(_protocol_error, "%s at offset %zd", _error_name(error), offset);
+	}} else {{
+		PyErr_SetString(_protocol_error, _error_name(error));
+	}}
+}}
+
+static inline PyObject* _int_object(const void* values, Py_ssize_t i, int bits, int is_signed) {{
+	switch(bits) {{
+		case 8:
+			return is_signed ? PyLong_FromLong(((const int8_t*) values)[i])
+				: PyLong_FromUnsignedLong(((const uint8_t*) values)[i]);
+		case 16:
+			return is_signed ? PyLong_FromLong(((const int16_t*) values)[i])
+				: PyLong_FromUnsignedLong(((const uint16_t*) values)[i]);
+		case 32:
+			return is_signed ? PyLong_FromLong(((const int32_t*) values)[i])
+				: PyLong_FromUnsignedLong(((const uint32_t*) values)[i]);
+		default:
+			return is_signed ? PyLong_FromLongLong(((const int64_t*) values)[i])
+				: PyLong_FromUnsignedLongLong(((const uint64_t*) values)[i]);
+	}}
+}}
+
+static inline PyObject* _int_tuple(const void* values, Py_ssize_t count, int bits, int is_signed) {{
+	PyObject* tuple = PyTuple_New(count);
+	if(tuple == NULL) {{
+		return NULL;
+	}}
+	for(Py_ssize_t i = 0; i < count; i++) {{
+		PyObject* item = _int_object(values, i, bits, is_signed);
+		if(item == NULL) {{
+			Py_DECREF(tuple);
+			return NULL;
+		}}
+		PyTuple_SET_ITEM(tuple, i, item);
+	}}
+	return tuple;
+}}
+
+static inline PyObject* _string_object(const char* data, Py_ssize_t len) {{
+	return PyUnicode_DecodeUTF8(data, len, "surrogateescape");
+}}
+
+static inline PyObject* _build_message(struct message_type* message_type, PyObject** values, int as_dict) {{
+
+	// Crea el objeto de un mensaje a partir de los valores de sus
+	// campos, cuyas referencias toma: una instancia de su tipo o, si
+	// as_dict es verdadero, un diccionario.
+
+	int count = message_type->description.n_in_sequence;
+	int complete = 1;
+	for(int i = 0; i < count; i++) {{
+		complete = complete && values[i] != NULL;
+	}}
+	PyObject* message = NULL;
+	if(complete && !as_dict && (message = PyStructSequence_New(message_type->type)) != NULL) {{
+		for(int i = 0; i < count; i++) {{
+			PyStructSequence_SET_ITEM(message, i, values[i]);
+		}}
+		return message;
+	}}
+	if(complete && as_dict && (message = PyDict_New()) != NULL) {{
+		for(int i = 0; message != NULL && i < count; i++) {{
+			if(PyDict_SetItem(message, message_type->keys[i], values[i]) < 0) {{
+				Py_CLEAR(message);
+			}}
+		}}
+	}}
+	for(int i = 0; i < count; i++) {{
+		Py_XDECREF(values[i]);
+	}}
+	return message;
+}}
+
+static inline int _store_int(PyObject* obj, void* values, Py_ssize_t i, int bits, int is_signed) {{
+
+	// Guarda el entero obj como el elemento i de values, verificando
+	// que entre en el tipo del campo. Retorna -1 en caso de error.
+
+	if(is_signed) {{
+		long long value = PyLong_AsLongLong(obj);
+		if(value == -1 && PyErr_Occurred()) {{
+			return -1;
+		}}
+		if(bits < 64 && (value < -(1LL << (bits - 1)) || value >= (1LL << (bits - 1)))) {{
+			PyErr_Format(PyExc_OverflowError, "%lld does not fit in int%d_t", value, bits);
+			return -1;
+		}}
+		switch(bits) {{
+			case 8: ((int8_t*) values)[i] = value; break;
+			case 16: ((int16_t*) values)[i] = value; break;
+			case 32: ((int32_t*) values)[i] = value; break;
+			default: ((int64_t*) values)[i] = value;
+		}}
+	}} else {{
+		unsigned long long value = PyLong_AsUnsignedLongLong(obj);
+		if(value == (unsigned long long) -1 && PyErr_Occurred()) {{
+			return -1;
+		}}
+		if(bits < 64 && value >= (1ULL << bits)) {{
+			PyErr_Format(PyExc_OverflowError, "%llu does not fit in uint%d_t", value, bits);
+			return -1;
+		}}
+		switch(bits) {{
+			case 8: ((uint8_t*) values)[i] = value; break;
+			case 16: ((uint16_t*) values)[i] = value; break;
+			case 32: ((uint32_t*) values)[i] = value; break;
+			default: ((uint64_t*) values)[i] = value;
+		}}
+	}}
+	return 0;
+}}
+
+static inline int _store_ints(PyObject* sequence, void* values, int bits, int is_signed) {{
+	Py_ssize_t count = PySequence_Fast_GET_SIZE(sequence);
+	PyObject** items = PySequence_Fast_ITEMS(sequence);
+	for(Py_ssize_t i = 0; i < count; i++) {{
+		if(_store_int(items[i], values, i, bits, is_signed) < 0) {{
+			return -1;
+		}}
+	}}
+	return 0;
+}}
+
+static inline int _parse_int_array(PyObject* obj, void* values, Py_ssize_t length, int bits, int is_signed) {{
+
+	// Guarda en values los length enteros de la secuencia obj.
+
+	PyObject* sequence = PySequence_Fast(obj, "expected a sequence of integers");
+	if(sequence == NULL) {{
+		return -1;
+	}}
+	int ret = -1;
+	if(PySequence_Fast_GET_SIZE(sequence) != length) {{
+		PyErr_Format(PyExc_ValueError, "expected %zd integers", length);
+	}} else {{
+		ret = _store_ints(sequence, values, bits, is_signed);
+	}}
+	Py_DECREF(sequence);
+	return ret;
+}}
+
+static inline int _parse_int_pointer(PyObject* obj, void** values, Py_ssize_t* length,
+		Py_ssize_t max_length, int bits, int is_signed, PyObject** owner) {{
+
+	// Apunta values a los enteros de la secuencia obj. Los bytes se
+	// usan sin copiarlos; el resto se convierte en un buffer que queda
+	// en owner, para liberarlo luego de empaquetar el mensaje.
+
+	if(bits == 8 && !is_signed && PyBytes_Check(obj)) {{
+		*values = PyBytes_AS_STRING(obj);
+		*length = PyBytes_GET_SIZE(obj);
+	}} else {{
+		PyObject* sequence = PySequence_Fast(obj, "expected a sequence of integers");
+		if(sequence == NULL) {{
+			return -1;
+		}}
+		*length = PySequence_Fast_GET_SIZE(sequence);
+		*owner = PyBytes_FromStringAndSize(NULL, *length * (bits / 8));
+		int ret = *owner == NULL ? -1
+			: _store_ints(sequence, PyBytes_AS_STRING(*owner), bits, is_signed);
+		Py_DECREF(sequence);
+		if(ret < 0) {{
+			return -1;
+		}}
+		*values = PyBytes_AS_STRING(*owner);
+	}}
+	if(*length > max_length) {{
+		PyErr_Format(PyExc_OverflowError, "at most %zd elements can be packed", max_length);
+		return -1;
+	}}
+	return 0;
+}}
+
+static inline int _parse_string(PyObject* obj, char** string, Py_ssize_t* length,
+		Py_ssize_t max_length, PyObject** owner) {{
+
+	// Apunta string a los bytes de obj, que puede ser un str (que se
+	// codifica en UTF-8 y queda en owner) o un bytes.
+
+	if(PyUnicode_Check(obj)) {{
+		if((*owner = PyUnicode_AsEncodedString(obj, "utf-8", "surrogateescape")) == NULL) {{
+			return -1;
+		}}
+		obj = *owner;
+	}} else if(!PyBytes_Check(obj)) {{
+		PyErr_SetString(PyExc_TypeError, "expected str or bytes");
+		return -1;
+	}}
+	*string = PyBytes_AS_STRING(obj);
+	*length = PyBytes_GET_SIZE(obj);
+	if(*length > max_length) {{
+		PyErr_Format(PyExc_OverflowError, "at most %zd bytes can be packed", max_length);
+		return -1;
+	}}
+	return 0;
+}}
+
+static inline int _parse_char_array(PyObject* obj, char* array, Py_ssize_t length) {{
+	PyObject* owner = NULL;
+	char* string;
+	Py_ssize_t string_length;
+	int ret = _parse_string(obj, &string, &string_length, length, &owner);
+	if(ret == 0) {{
+		memcpy(array, string, string_length);
+	}}
+	Py_XDECREF(owner);
+	return ret;
+}}
+
+static inline PyObject* _release_objects(PyObject** objects, int count) {{
+	for(int i = 0; i < count; i++) {{
+		Py_XDECREF(objects[i]);
+	}}
+	return NULL;
+}}
+"""
+
+python_message_functions = """
+static PyStructSequence_Field _{msg_name}_fields[] = {{
+	{{"id", NULL}},{field_entries}
+	{{NULL, NULL}}
+}};
+
+static PyObject* _{msg_name}_keys[{value_count}];
+
+static struct message_type _{msg_name}_type = {{
+	{{"{module_name}.{msg_name}", NULL, _{msg_name}_fields, {value_count}}},
+	NULL, _{msg_name}_keys
+}};
+
+static PyObject* _{msg_name}_to_python(struct {msg_name}* msg, int as_dict) {{
+	PyObject* values[{value_count}];
+	values[0] = PyLong_FromLong(msg->id);{field_values}
+	return _build_message(&_{msg_name}_type, values, as_dict);
+}}
+
+static const char _pack_{msg_name}_doc[] = "pack_{msg_name}({arguments})\\n--\\n\\n"
+	"Pack a {msg_name} message into a frame.";
+
+static PyObject* _pack_{msg_name}(PyObject* self, PyObject* const* args, Py_ssize_t nargs) {{
+	if(nargs != {arg_count}) {{
+		PyErr_Format(PyExc_TypeError, "pack_{msg_name}() takes {arg_count} arguments (%zd given)", nargs);
+		return NULL;
+	}}
+	struct {msg_name} msg;
+	memset(&msg, 0, sizeof msg);
+	msg.id = {msg_name_upper}_ID;
+	PyObject* owned[{owned_count}] = {{NULL}};{parse_fields}
+
+	int size = bytes_needed_to_pack(&msg);
+	PyObject* frame = NULL;
+	if(size < 0) {{
+		_set_codec_error(size, -1);
+	}} else if((frame = PyBytes_FromStringAndSize(NULL, size)) != NULL) {{
+		int packed = pack_{msg_name}({pack_arguments}(uint8_t*) PyBytes_AS_STRING(frame), size);
+		if(packed < 0) {{
+			_set_codec_error(packed, -1);
+			Py_CLEAR(frame);
+		}}
+	}}
+	_release_objects(owned, {owned_count});
+	return frame;
+}}
+"""
+
+python_field_entry = """
+	{{"{field_name}", NULL}},"""
+
+python_field_value = """
+	values[{index}] = {value};"""
+
+python_int_value = "_int_object(&msg->{field_name}, 0, {bits}, {is_signed})"
+python_int_array_value = "_int_tuple(msg->{field_name}, {length}, {bits}, {is_signed})"
+python_bytes_array_value = "PyBytes_FromStringAndSize((char*) msg->{field_name}, {length})"
+python_char_array_value = "_string_object(msg->{field_name}, strnlen(msg->{field_name}, {length}))"
+python_string_value = "_string_object(msg->{field_name}, strlen(msg->{field_name}))"
+python_sized_string_value = "_string_object(msg->{field_name}, msg->{field_name}_len)"
+python_int_pointer_value = "_int_tuple(msg->{field_name}, msg->{field_name}_len, {bits}, {is_signed})"
+python_bytes_pointer_value = "PyBytes_FromStringAndSize((char*) msg->{field_name}, msg->{field_name}_len)"
+
+python_parse_int_field = """
+	if(_store_int(args[{index}], &msg.{field_name}, 0, {bits}, {is_signed}) < 0) {{
+		return _release_objects(owned, {owned_count});
+	}}"""
+python_parse_int_array_field = """
+	if(_parse_int_array(args[{index}], msg.{field_name}, {length}, {bits}, {is_signed}) < 0) {{
+		return _release_objects(owned, {owned_count});
+	}}"""
+python_parse_char_array_field = """
+	if(_parse_char_array(args[{index}], msg.{field_name}, {length}) < 0) {{
+		return _release_objects(owned, {owned_count});
+	}}"""
+python_parse_string_field = """
+	Py_ssize_t {field_name}_len;
+	if(_parse_string(args[{index}], &msg.{field_name}, &{field_name}_len,
+			PY_SSIZE_T_MAX, &owned[{index}]) < 0) {{
+		return _release_objects(owned, {owned_count});
+	}}
+	// Sin --sized-strings, el string termina en el primer byte nulo
+	if(memchr(msg.{field_name}, 0, {field_name}_len) != NULL) {{
+		PyErr_SetString(PyExc_ValueError, "{field_name} contains a null byte");
+		return _release_objects(owned, {owned_count});
+	}}"""
+python_parse_sized_string_field = """
+	Py_ssize_t {field_name}_len;
+	if(_parse_string(args[{index}], &msg.{field_name}, &{field_name}_len,
+			UINT32_MAX, &owned[{index}]) < 0) {{
+		return _release_objects(owned, {owned_count});
+	}}
+	msg.{field_name}_len = {field_name}_len;"""
+python_parse_pointer_field = """
+	Py_ssize_t {field_name}_len;
+	if(_parse_int_pointer(args[{index}], (void**) &msg.{field_name}, &{field_name}_len,
+			(field_len_t) -1, {bits}, {is_signed}, &owned[{index}]) < 0) {{
+		return _release_objects(owned, {owned_count});
+	}}
+	msg.{field_name}_len = {field_name}_len;"""
+
+python_module_end = """
+static int _is_batch_decodable(int msg_id) {{
+	switch(msg_id) {{{trailing_data_cases}
+		default:
+			return 1;
+	}}
+}}
+
+static PyObject* _message_to_python(void* msg, int msg_id, int as_dict) {{
+	switch(msg_id) {{{to_python_cases}
+		default:
+			_set_codec_error(UNKNOWN_ID, -1);
+			return NULL;
+	}}
+}}
+
+// Lote de paquetes decodificados sin el GIL. Los mensajes están en
+// messages, de a msg_size bytes, y sus campos de largo variable en la
+// arena, salvo que heap_allocated indique que el único mensaje del
+// lote no entraba en ella y se decodificó con malloc.
+struct decode_batch {{
+	uint8_t* messages;
+	int msg_size;
+	int msg_ids[BATCH_SIZE];
+	int count;
+	int heap_allocated;
+	struct arena arena;
+}};
+
+static int _decode_batch(struct decode_batch* batch, uint8_t* data, Py_ssize_t size, Py_ssize_t* consumed) {{
+
+	// Decodifica hasta BATCH_SIZE paquetes completos de data. No
+	// utiliza la API de Python, por lo que se ejecuta sin el GIL.
+	// Retorna el error del primer paquete que no pudo decodificarse.
+
+	reset_arena(&batch->arena);
+	batch->count = 0;
+	batch->heap_allocated = 0;
+	*consumed = 0;
+	while(batch->count < BATCH_SIZE) {{
+		Py_ssize_t remaining = size - *consumed;
+		int available = remaining > INT_MAX ? INT_MAX : (int) remaining;
+		uint8_t* frame = data + *consumed;
+		int frame_size = get_frame_size(frame, available);
+		if(frame_size < 0) {{
+			return frame_size;
+		}} else if(frame_size == 0 || frame_size > available) {{
+			// El último paquete está incompleto
+			return 0;
+		}}
+		uint8_t* msg = batch->messages + (size_t) batch->count * batch->msg_size;
+		int msg_id = decode_frame_in_arena(frame, msg, batch->msg_size, &batch->arena);
+		if(msg_id == ALLOC_ERROR) {{
+			if(batch->count > 0) {{
+				// La arena se llenó, el paquete va en el próximo lote
+				return 0;
+			}}
+			msg_id = decode_frame_in_arena(frame, msg, batch->msg_size, NULL);
+			batch->heap_allocated = msg_id >= 0;
+		}}
+		if(msg_id < 0) {{
+			return msg_id;
+		}}
+		if(!_is_batch_decodable(msg_id)) {{
+			if(batch->heap_allocated) {{
+				destroy(msg);
+				batch->heap_allocated = 0;
+			}}
+			return HAS_TRAILING_DATA;
+		}}
+		batch->msg_ids[batch->count++] = msg_id;
+		*consumed += frame_size;
+		if(batch->heap_allocated) {{
+			return 0;
+		}}
+	}}
+	return 0;
+}}
+
+static int _append_batch(PyObject* messages, struct decode_batch* batch, int as_dict) {{
+
+	// Agrega a la lista messages los mensajes del lote convertidos en
+	// objetos de Python. Retorna -1 en caso de error.
+
+	int ret = 0;
+	for(int i = 0; i < batch->count && ret == 0; i++) {{
+		PyObject* message = _message_to_python(
+			batch->messages + (size_t) i * batch->msg_size, batch->msg_ids[i], as_dict);
+		if(message == NULL || PyList_Append(messages, message) < 0) {{
+			ret = -1;
+		}}
+		Py_XDECREF(message);
+	}}
+	if(batch->heap_allocated) {{
+		destroy(batch->messages);
+	}}
+	return ret;
+}}
+
+static PyObject* _decode_frames(PyObject* self, PyObject* args, PyObject* kwargs) {{
+	static char* keywords[] = {{"buffer", "as_dict", NULL}};
+	Py_buffer buffer;
+	int as_dict = 0;
+	if(!PyArg_ParseTupleAndKeywords(args, kwargs, "y*|p:decode_frames", keywords, &buffer, &as_dict)) {{
+		return NULL;
+	}}
+
+	struct decode_batch batch;
+	batch.msg_size = (get_max_msg_size() + 7) / 8 * 8;
+	batch.messages = PyMem_RawMalloc((size_t) BATCH_SIZE * batch.msg_size);
+	PyObject* messages = PyList_New(0);
+	if(batch.messages == NULL || messages == NULL ||
+			init_arena(&batch.arena, NULL, BATCH_ARENA_SIZE) < 0) {{
+		PyMem_RawFree(batch.messages);
+		Py_XDECREF(messages);
+		PyBuffer_Release(&buffer);
+		return PyErr_NoMemory();
+	}}
+
+	// Los paquetes se decodifican por lotes: sin el GIL se decodifica
+	// cada lote y con el GIL se convierten sus mensajes
+	Py_ssize_t offset = 0;
+	do {{
+		Py_ssize_t consumed;
+		int error;
+		Py_BEGIN_ALLOW_THREADS
+		error = _decode_batch(&batch, (uint8_t*) buffer.buf + offset, buffer.len - offset, &consumed);
+		Py_END_ALLOW_THREADS
+		if(_append_batch(messages, &batch, as_dict) < 0) {{
+			Py_CLEAR(messages);
+		}} else if(error < 0) {{
+			_set_codec_error(error, offset + consumed);
+			Py_CLEAR(messages);
+		}}
+		offset += consumed;
+	}} while(messages != NULL && batch.count > 0);
+
+	destroy_arena(&batch.arena);
+	PyMem_RawFree(batch.messages);
+	PyBuffer_Release(&buffer);
+	if(messages == NULL) {{
+		return NULL;
+	}}
+	return Py_BuildValue("(Nn)", messages, offset);
+}}
+
+static struct message_type* _message_types[] = {{{message_types}
+	NULL
+}};
+
+static int _init_message_types(PyObject* module) {{
+	for(int i = 0; _message_types[i] != NULL; i++) {{
+		struct message_type* message_type = _message_types[i];
+		PyStructSequence_Desc* description = &message_type->description;
+		if(message_type->type == NULL &&
+				(message_type->type = PyStructSequence_NewType(description)) == NULL) {{
+			return -1;
+		}}
+		for(int j = 0; j < description->n_in_sequence; j++) {{
+			if(message_type->keys[j] == NULL &&
+					(message_type->keys[j] = PyUnicode_InternFromString(description->fields[j].name)) == NULL) {{
+				return -1;
+			}}
+		}}
+		const char* type_name = strrchr(description->name, '.') + 1;
+		Py_INCREF(message_type->type);
+		if(PyModule_AddObject(module, type_name, (PyObject*) message_type->type) < 0) {{
+			Py_DECREF(message_type->type);
+			return -1;
+		}}
+	}}
+	return 0;
+}}
+
+static PyMethodDef _module_methods[] = {{
+	{{"decode_frames", (PyCFunction)(void(*)(void)) _decode_frames, METH_VARARGS | METH_KEYWORDS,
+		"decode_frames(buffer, as_dict=False)\\n--\\n\\n"
+		"Decode every complete frame in a bytes-like object. Returns a tuple\\n"
+		"(messages, consumed) with the decoded messages and the number of bytes\\n"
+		"they took; an incomplete frame at the end of the buffer is left undecoded."}},{pack_methods}
+	{{NULL, NULL, 0, NULL}}
+}};
+
+static struct PyModuleDef _module_definition = {{
+	PyModuleDef_HEAD_INIT, "{module_name}", "Codec for the {module_name} protocol.", -1, _module_methods
+}};
+
+PyMODINIT_FUNC PyInit_{module_name}(void) {{
+	PyObject* module = PyModule_Create(&_module_definition);
+	if(module == NULL) {{
+		return NULL;
+	}}
+	if(_protocol_error == NULL &&
+			(_protocol_error = PyErr_NewException("{module_name}.ProtocolError", PyExc_ValueError, NULL)) == NULL) {{
+		Py_DECREF(module);
+		return NULL;
+	}}
+	Py_INCREF(_protocol_error);
+	if(PyModule_AddObject(module, "ProtocolError", _protocol_error) < 0 ||
+			_init_message_types(module) < 0{add_message_ids}) {{
+		Py_DECREF(module);
+		return NULL;
+	}}
+	return module;
+}}
+"""
+
+python_trailing_data_case = """
+		case {msg_name_upper}_ID:"""
+
+python_trailing_data_return = """
+			return 0;"""
+
+python_to_python_case = """
+		case {msg_name_upper}_ID:
+			return _{msg_name}_to_python((struct {msg_name}*) msg, as_dict);"""
+
+python_message_type = """
+	&_{msg_name}_type,"""
+
+python_pack_method = """
+	{{"pack_{msg_name}", (PyCFunction)(void(*)(void)) _pack_{msg_name}, METH_FASTCALL,
+		_pack_{msg_name}_doc}},"""
+
+python_add_message_id = """ ||
+			PyModule_AddIntConstant(module, "{msg_name_upper}_ID", {msg_name_upper}_ID) < 0"""
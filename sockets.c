@@ -1,17 +1,56 @@
+#ifndef _GNU_SOURCE
+#define _GNU_SOURCE
+#endif
+
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
 #include <errno.h>
 #include <unistd.h>
+#include <stdint.h>
+#include <stddef.h>
+#include <time.h>
+#include <fcntl.h>
+#include <poll.h>
 #include <sys/socket.h>
+#include <sys/stat.h>
+#include <sys/un.h>
 #include <netdb.h>
 #include <sys/epoll.h>
+#include <sys/ioctl.h>
 #include <pthread.h>
+#include <sched.h>
+
+#if defined(__has_include)
+#if __has_include(<linux/io_uring.h>)
+#define HAS_IO_URING
+#include <sys/mman.h>
+#include <sys/syscall.h>
+#include <linux/io_uring.h>
+#ifdef IORING_RECV_MULTISHOT
+#define HAS_URING_BUFFERS
+#endif
+#endif
+#endif
 
 #include "sockets.h"
 
 #define MAX_EPOLL_EVENTS 10
 #define EPOLL_TIMEOUT 1000
+#define TIMER_WHEEL_SLOTS 256
+#define TIMER_TICK 10
+#define ACCEPT_RATE_WINDOW 1000
+#define URING_ENTRIES 256
+#define URING_ACCEPT_DATA (1ULL << 63)
+#define URING_IGNORE_DATA (1ULL << 62)
+#define URING_SEND_DATA (1ULL << 61)
+#define URING_GENERATION_MASK 0x0FFFFFFF
+#define URING_BUFFERS 128
+#define URING_BUFFER_GROUP 0
+#define URING_DRAIN_TIMEOUT 1000
+#define DATA_BUFFER_SIZE 16384
+#define RELAY_CHUNK_SIZE 65536
+#define RELAY_BUFFER_SIZE 16384
 
 int get_local_addrinfo(const char* port, struct addrinfo* hints, struct addrinfo** server_info) {
 
@@ -165,6 +204,233 @@ int create_socket_client(const char* host, const char* port) {
 	return socket_fd;
 }
 
+int get_unix_address(const char* path, struct sockaddr_un* addr, socklen_t* addr_len) {
+
+	// Recibe un path y completa la dirección de un socket unix asociado
+	// a él. Si el path empieza con '@', la dirección pertenece al
+	// namespace abstracto: no crea ningún archivo y el resto del path
+	// es el nombre. Retorna -1 si el path es demasiado largo.
+
+	size_t path_len = strlen(path);
+	memset(addr, 0, sizeof *addr);
+	addr->sun_family = AF_UNIX;
+	if(path_len == 0 || path_len >= sizeof addr->sun_path) {
+		fprintf(stderr, "Invalid unix socket path: %s\n", path);
+		return -1;
+	}
+	memcpy(addr->sun_path, path, path_len);
+	if(path[0] == '@') {
+		// En el namespace abstracto el nombre empieza con un byte nulo
+		// y no termina en uno, por lo que se pasa su largo exacto
+		addr->sun_path[0] = '\0';
+		*addr_len = offsetof(struct sockaddr_un, sun_path) + path_len;
+	} else {
+		*addr_len = sizeof *addr;
+	}
+	return 0;
+}
+
+int create_unix_socket_server(const char* path, int backlog) {
+
+	// Recibe un path y un backlog. Crea y devuelve el file descriptor
+	// de un socket unix que escucha en ese path con dicho backlog. Si
+	// en el path quedó el socket de un servidor anterior, lo reemplaza.
+	// Retorna -1 en caso de error.
+
+	int socket_fd;
+	struct sockaddr_un addr;
+	socklen_t addr_len;
+	struct stat path_stat;
+
+	if(get_unix_address(path, &addr, &addr_len) == -1) {
+		return -1;
+	}
+	if(path[0] != '@' && stat(path, &path_stat) == 0 && S_ISSOCK(path_stat.st_mode)) {
+		unlink(path);
+	}
+
+	if((socket_fd = socket(AF_UNIX, SOCK_STREAM, 0)) == -1) {
+		fprintf(stderr, "Error at socket(). Errno: %d\n", errno);
+		return -1;
+	}
+
+	if(bind(socket_fd, (struct sockaddr*) &addr, addr_len) == -1) {
+		close(socket_fd);
+		fprintf(stderr, "Error at bind(). Errno: %d\n", errno);
+		return -1;
+	}
+
+	if(listen(socket_fd, backlog) == -1) {
+		close(socket_fd);
+		fprintf(stderr, "Error at listen(). Errno: %d\n", errno);
+		return -1;
+	}
+
+	return socket_fd;
+}
+
+int create_unix_socket_client(const char* path) {
+
+	// Recibe un path. Retorna un socket unix conectado al servidor
+	// que escucha en él o -1 en caso de error.
+
+	int socket_fd;
+	struct sockaddr_un addr;
+	socklen_t addr_len;
+
+	if(get_unix_address(path, &addr, &addr_len) == -1) {
+		return -1;
+	}
+
+	if((socket_fd = socket(AF_UNIX, SOCK_STREAM, 0)) == -1) {
+		fprintf(stderr, "Error at socket(). Errno: %d\n", errno);
+		return -1;
+	}
+
+	if(connect(socket_fd, (struct sockaddr*) &addr, addr_len) == -1) {
+		close(socket_fd);
+		fprintf(stderr, "Error at connect(). Errno: %d\n", errno);
+		return -1;
+	}
+
+	return socket_fd;
+}
+
+int wait_fd(int fd, short events) {
+
+	// Espera a que el file descriptor fd esté listo para los eventos
+	// events. Permite usar las funciones de reenvío con sockets no
+	// bloqueantes. Retorna -1 en caso de error.
+
+	struct pollfd poll_fd = { .fd = fd, .events = events };
+	while(poll(&poll_fd, 1, -1) == -1) {
+		if(errno != EINTR) {
+			fprintf(stderr, "Error at poll(). Errno: %d\n", errno);
+			return -1;
+		}
+	}
+	return 0;
+}
+
+int send_all(int socket_fd, const uint8_t* buffer, size_t len, int flags) {
+
+	// Envía los len bytes de buffer por socket_fd. Retorna -1 en
+	// caso de error.
+
+	size_t sent = 0;
+	while(sent < len) {
+		ssize_t ret = send(socket_fd, buffer + sent, len - sent, flags | MSG_NOSIGNAL);
+		if(ret == -1) {
+			if(errno == EINTR) continue;
+			if((errno == EAGAIN || errno == EWOULDBLOCK) && wait_fd(socket_fd, POLLOUT) == 0) continue;
+			return -1;
+		}
+		sent += ret;
+	}
+	return 0;
+}
+
+int64_t copy_bytes(int from_fd, int to_fd, int64_t len) {
+
+	// Reenvía len bytes de from_fd a to_fd copiándolos en un buffer.
+	// Retorna la cantidad de bytes reenviados, menor a len si from_fd
+	// se cerró, o -1 en caso de error.
+
+	uint8_t buffer[RELAY_BUFFER_SIZE];
+	int64_t relayed = 0;
+
+	while(relayed < len) {
+		size_t chunk = len - relayed < RELAY_BUFFER_SIZE ? len - relayed : RELAY_BUFFER_SIZE;
+		ssize_t ret = read(from_fd, buffer, chunk);
+		if(ret == 0) break;
+		if(ret == -1) {
+			if(errno == EINTR) continue;
+			if((errno == EAGAIN || errno == EWOULDBLOCK) && wait_fd(from_fd, POLLIN) == 0) continue;
+			return -1;
+		}
+		int flags = relayed + ret < len ? MSG_MORE : 0;
+		if(send_all(to_fd, buffer, ret, flags) == -1) return -1;
+		relayed += ret;
+	}
+
+	return relayed;
+}
+
+static __thread int relay_pipe[2] = { -1, -1 };
+
+void release_thread_relay_pipe() {
+
+	// Cierra el pipe que utiliza relay_bytes() en el thread actual.
+	// Debe llamarse antes de que finalice un thread que haya usado
+	// relay_bytes(); si se vuelve a usar, el pipe se crea de nuevo.
+
+	if(relay_pipe[0] == -1) return;
+	close(relay_pipe[0]);
+	close(relay_pipe[1]);
+	relay_pipe[0] = relay_pipe[1] = -1;
+}
+
+int64_t drain_relay_pipe(int to_fd, int64_t len) {
+
+	// Envía a to_fd, copiándolos en un buffer, los len bytes que
+	// quedaron en el pipe del thread. Se usa cuando to_fd no admite
+	// splice(). Retorna -1 en caso de error.
+
+	int64_t drained = copy_bytes(relay_pipe[0], to_fd, len);
+	return drained == len ? 0 : -1;
+}
+
+int64_t relay_bytes(int from_fd, int to_fd, int64_t len) {
+
+	// Reenvía len bytes de from_fd a to_fd sin copiarlos a memoria de
+	// usuario: los mueve con splice() a través de un pipe propio del
+	// thread. Si alguno de los file descriptors no admite splice(), los
+	// copia con un buffer. Retorna la cantidad de bytes reenviados,
+	// menor a len si from_fd se cerró, o -1 en caso de error.
+
+	if(relay_pipe[0] == -1 && pipe2(relay_pipe, O_CLOEXEC) == -1) {
+		return copy_bytes(from_fd, to_fd, len);
+	}
+
+	int64_t relayed = 0;
+	while(relayed < len) {
+		size_t chunk = len - relayed < RELAY_CHUNK_SIZE ? len - relayed : RELAY_CHUNK_SIZE;
+		ssize_t in = splice(from_fd, NULL, relay_pipe[1], NULL, chunk, SPLICE_F_MOVE);
+		if(in == 0) break;
+		if(in == -1) {
+			if(errno == EINTR) continue;
+			if((errno == EAGAIN || errno == EWOULDBLOCK) && wait_fd(from_fd, POLLIN) == 0) continue;
+			if(errno == EINVAL && relayed == 0) return copy_bytes(from_fd, to_fd, len);
+			fprintf(stderr, "Error at splice(). Errno: %d\n", errno);
+			release_thread_relay_pipe();
+			return -1;
+		}
+
+		// Se vacía el pipe antes de volver a leer de from_fd, para que
+		// nunca queden datos de un reenvío en él
+		unsigned int flags = SPLICE_F_MOVE | (relayed + in < len ? SPLICE_F_MORE : 0);
+		ssize_t pending = in;
+		while(pending > 0) {
+			ssize_t out = splice(relay_pipe[0], NULL, to_fd, NULL, pending, flags);
+			if(out == -1) {
+				if(errno == EINTR) continue;
+				if((errno == EAGAIN || errno == EWOULDBLOCK) && wait_fd(to_fd, POLLOUT) == 0) continue;
+				if(errno == EINVAL && drain_relay_pipe(to_fd, pending) == 0) {
+					int64_t copied = copy_bytes(from_fd, to_fd, len - relayed - in);
+					return copied == -1 ? -1 : relayed + in + copied;
+				}
+				fprintf(stderr, "Error at splice(). Errno: %d\n", errno);
+				release_thread_relay_pipe();
+				return -1;
+			}
+			pending -= out;
+		}
+		relayed += in;
+	}
+
+	return relayed;
+}
+
 int run_handler(handler_t handler, int socket_fd, void* shared_data) {
 
 	// Toma un handler_t y sus parámetros. Si el handler no es nulo,
@@ -190,6 +456,15 @@ void init_server_input(struct server_input* input,
 	input->server_fd = server_fd;
 	input->handlers = handlers;
 	input->shared_data = shared_data;
+	input->idle_timeout = 0;
+	input->max_clients = 0;
+	input->max_accept_rate = 0;
+	input->reject_when_full = 0;
+	input->backend = EPOLL_BACKEND;
+	input->cpu = -1;
+	input->busy_poll = 0;
+	input->spin_time = 0;
+	input->timers = NULL;
 }
 
 int thread_should_stop(struct server_input* input) {
@@ -209,14 +484,57 @@ void stop_server(struct server_input* input) {
 	pthread_mutex_unlock(&input->lock);
 }
 
+struct uring_loop;
+
+struct client_output {
+
+	// Datos encolados con server_send() para un cliente. Con io_uring,
+	// el kernel lee sending mientras se envía, por lo que no puede
+	// moverse: los datos nuevos se acumulan en pending y pasan a
+	// sending cuando este termina de enviarse. queued indica que el
+	// cliente está en la lista de los que tienen datos por enviar y
+	// closing, que su conexión se cierra al terminar de enviarlos.
+
+	uint8_t* pending;
+	int pending_size;
+	int pending_capacity;
+	uint8_t* sending;
+	int sending_size;
+	int sending_capacity;
+	int sent;
+	int in_flight;
+	int queued;
+	int closing;
+};
+
+struct send_queue {
+
+	// Datos encolados para los clientes del servidor, indexados por
+	// file descriptor. queued lista los clientes con datos por enviar
+	// al final de la iteración del servidor. ring es el ring con el que
+	// se envían con el backend io_uring, NULL con epoll.
+
+	struct client_output* outputs;
+	int outputs_size;
+	int* queued;
+	int queued_count;
+	int queued_capacity;
+	struct uring_loop* ring;
+	int sends_in_flight;
+};
+
 struct clients_storage {
 
 	// Estructura para almacenar dinámicamente los clientes
-	// del servidor.
+	// del servidor. ring es el ring en el que se observan los
+	// clientes con el backend io_uring, NULL con epoll. queue son los
+	// datos encolados para los clientes.
 
 	int* clients_buff;
 	int num_clients;
 	int max_clients;
+	struct uring_loop* ring;
+	struct send_queue* queue;
 };
 
 struct clients_storage init_clients_storage() {
@@ -227,6 +545,8 @@ struct clients_storage init_clients_storage() {
 	clients.clients_buff = malloc((sizeof(int)) * 2);
 	clients.num_clients = 0;
 	clients.max_clients = 2;
+	clients.ring = NULL;
+	clients.queue = NULL;
 	return clients;
 }
 
@@ -236,7 +556,7 @@ int add_client(struct clients_storage* clients, int client) {
 	// De ser necesario, aumenta el tamaño del buffer de la estructura.
 
 	if(!(clients->num_clients < clients->max_clients)) {
-		int* new_buf = realloc(clients->clients_buff, clients->max_clients * 2);
+		int* new_buf = realloc(clients->clients_buff, sizeof(int) * clients->max_clients * 2);
 		if (new_buf == NULL) {
 			fprintf(stderr, "Couldn't allocate memory for clients.\n");
 			return -1;
@@ -264,173 +584,1825 @@ void remove_client(struct clients_storage* clients, int client) {
 	}
 }
 
-void clear_clients(struct clients_storage cliets) {
+void clear_clients(struct clients_storage cliets, struct server_input* input) {
 
-	// Recibe una estructura clients_storage. Cierra todas sus conexiones
-	// y libera el buffer de clientes.
+	// Recibe una estructura clients_storage y el input del servidor.
+	// Ejecuta el handler on_close de cada cliente, cierra todas sus
+	// conexiones y libera el buffer de clientes.
 
+	pthread_mutex_lock(&input->lock);
 	for(int i = 0; i < cliets.num_clients; i++) {
+		run_handler(input->handlers.on_close, cliets.clients_buff[i], input->shared_data);
 		close(cliets.clients_buff[i]);
 	}
+	pthread_mutex_unlock(&input->lock);
 	free(cliets.clients_buff);
 }
 
-int add_epoll_fd(int epoll_fd, int socket_fd) {
+static __thread struct send_queue* thread_send_queue = NULL;
 
-	// Recibe un file descriptor asociado a una instancia de epoll y 
-	// otro file descriptor asociado a un socket. Registra el socket
-	// en la instancia de epoll. Retorna 0 en caso de exito, -1 en
-	// caso contrario.
+void init_send_queue(struct send_queue* queue, struct uring_loop* ring) {
+	memset(queue, 0, sizeof *queue);
+	queue->ring = ring;
+}
 
-	struct epoll_event event;
-	event.events = EPOLLIN;
-	event.data.fd = socket_fd;
-	if(epoll_ctl(epoll_fd, EPOLL_CTL_ADD, socket_fd, &event) == -1) {
-		fprintf(stderr, "Couldn't add file descriptor to epoll. Errno: %d\n", errno);
-		return -1;
+void release_client_output(struct client_output* output) {
+
+	// Descarta los datos encolados de un cliente y libera sus buffers.
+	// No debe tener un envío en curso. Se conserva si está en la lista
+	// de clientes con datos por enviar, ya que no se lo quita de ella.
+
+	int queued = output->queued;
+	free(output->pending);
+	free(output->sending);
+	memset(output, 0, sizeof *output);
+	output->queued = queued;
+}
+
+void destroy_send_queue(struct send_queue* queue) {
+
+	// Cierra las conexiones que esperaban terminar de enviar sus datos
+	// y libera los datos encolados. Los buffers de los envíos que
+	// siguen en curso no se liberan, ya que el kernel todavía puede
+	// leerlos.
+
+	for(int fd = 0; fd < queue->outputs_size; fd++) {
+		struct client_output* output = &queue->outputs[fd];
+		if(output->closing) {
+			close(fd);
+		}
+		if(output->in_flight) {
+			output->sending = NULL;
+		}
+		release_client_output(output);
 	}
-	return 0;
+	free(queue->outputs);
+	free(queue->queued);
 }
 
-void accept_new_client(int server_fd, int epoll_fd, 
-		struct clients_storage* clients, struct server_input* input) {
+struct client_output* get_client_output(struct send_queue* queue, int client_fd) {
 
-	// Acepta a un nuevo cliente. Recibe el file descriptor del servidor,
-	// el de la instancia de epoll, un puntero a la estructura de clientes
-	// y un puntero a la estructura input del servidor.
-	// Acepta la conexión y ejecuta el handler correspondiente de estar
-	// definido. Luego:
-	//				- Si el handler le indico retornando CLOSE_CLIENT,
-	// cierra la conexión del cliente.
-	//				- Si el handler retorna STOP_SERVER, se finalizará
-	// el thread del servidor.
-	//				- Si el handler retorna otra cosa, intenta
-	// agregar el cliente tanto a los clientes como al registro de
-	// epoll. En caso de error, cierra la conexión. 
+	// Retorna los datos encolados del cliente client_fd, agrandando la
+	// tabla de clientes de ser necesario. Retorna NULL en caso de error.
 
-	struct sockaddr_storage client_addr;
-	socklen_t sin_size = sizeof client_addr;
-	int new_client, ret;
+	if(client_fd >= queue->outputs_size) {
+		int new_size = queue->outputs_size > 0 ? queue->outputs_size : 16;
+		while(new_size <= client_fd) {
+			new_size *= 2;
+		}
+		struct client_output* new_outputs = realloc(queue->outputs,
+			new_size * sizeof(struct client_output));
+		if(new_outputs == NULL) {
+			fprintf(stderr, "Couldn't allocate memory for client output.\n");
+			return NULL;
+		}
+		memset(new_outputs + queue->outputs_size, 0,
+			(new_size - queue->outputs_size) * sizeof(struct client_output));
+		queue->outputs = new_outputs;
+		queue->outputs_size = new_size;
+	}
+	return &queue->outputs[client_fd];
+}
 
-	if((new_client = accept(server_fd, (struct sockaddr*) &client_addr, &sin_size)) == -1) {
-		fprintf(stderr, "Error accepting client. Errno: %d\n", errno);
-		return;
+int queue_client_output(struct send_queue* queue, int client_fd) {
+
+	// Agrega al cliente a la lista de los que tienen datos por enviar,
+	// si todavía no está en ella. Retorna -1 en caso de error.
+
+	struct client_output* output = &queue->outputs[client_fd];
+	if(output->queued) {
+		return 0;
+	}
+	if(queue->queued_count == queue->queued_capacity) {
+		int new_capacity = queue->queued_capacity > 0 ? queue->queued_capacity * 2 : 16;
+		int* new_queued = realloc(queue->queued, new_capacity * sizeof(int));
+		if(new_queued == NULL) {
+			fprintf(stderr, "Couldn't allocate memory for client output.\n");
+			return -1;
+		}
+		queue->queued = new_queued;
+		queue->queued_capacity = new_capacity;
 	}
+	queue->queued[queue->queued_count++] = client_fd;
+	output->queued = 1;
+	return 0;
+}
 
-	pthread_mutex_lock(&input->lock);
-	ret = run_handler(input->handlers.on_new_client, new_client, input->shared_data);
-	pthread_mutex_unlock(&input->lock);
+int server_send(int client_fd, const void* data, int size) {
 
-	switch(ret) {
-		case CLOSE_CLIENT:
-			close(new_client);
-			break;
-		case STOP_SERVER:
-			close(new_client);
-			stop_server(input);
-			break;
-		default:
-			// Si hay algun error al intentar agregar el cliente
-			// a la lista de clientes o al registrar el file 
-			// descriptor a epoll, cerramos la conexión.
-			if(add_client(clients, new_client) == -1) {
-				close(new_client);
-				return;
-			}
-			if(add_epoll_fd(epoll_fd, new_client) == -1) {
-				close(new_client);
-				remove_client(clients, new_client);
-				return;
-			}
+	// Encola size bytes de data para enviarlos al cliente client_fd al
+	// final de la iteración actual del servidor, junto con el resto de
+	// los datos encolados para él. Debe llamarse desde un handler o un
+	// timer; desde otro thread, envía los datos directamente. Retorna
+	// size o -1 en caso de error.
+
+	struct send_queue* queue = thread_send_queue;
+	if(queue == NULL) {
+		return send_all(client_fd, data, size, 0) == -1 ? -1 : size;
+	}
+	struct client_output* output = get_client_output(queue, client_fd);
+	if(output == NULL || output->closing || size < 0) {
+		return -1;
+	}
+	if((int64_t) output->pending_size + size > output->pending_capacity) {
+		int64_t new_capacity = output->pending_capacity > 0 ? output->pending_capacity : DATA_BUFFER_SIZE;
+		while(new_capacity < (int64_t) output->pending_size + size) {
+			new_capacity *= 2;
+		}
+		if(new_capacity > INT32_MAX) {
+			return -1;
+		}
+		uint8_t* new_pending = realloc(output->pending, new_capacity);
+		if(new_pending == NULL) {
+			fprintf(stderr, "Couldn't allocate memory for client output.\n");
+			return -1;
+		}
+		output->pending = new_pending;
+		output->pending_capacity = new_capacity;
+	}
+	if(queue_client_output(queue, client_fd) == -1) {
+		return -1;
 	}
+	memcpy(output->pending + output->pending_size, data, size);
+	output->pending_size += size;
+	return size;
 }
 
-void handle_data_from_client(int client_fd, 
-		struct clients_storage* cliets, struct server_input* input) {
+struct server_timer {
+
+	// Timer del servidor. Los timers de un mismo slot de la rueda
+	// forman una lista doblemente enlazada, por lo que se agregan y
+	// remueven en O(1). prev apunta al puntero que apunta al timer,
+	// o es NULL si el timer no está en ninguna lista. client_fd es el
+	// cliente cuyo timeout controla el timer, o -1 para los timers
+	// creados con add_server_timer().
+
+	int64_t expires;
+	int client_fd;
+	timer_callback_t callback;
+	void* data;
+	struct server_timer* next;
+	struct server_timer** prev;
+};
 
-	// Se ejecuta cuando un file descriptor está listo para leer.
-	// Recibe dicho file descriptor, los clientes y el input del
-	// servidor. Ejecuta el handler correspondiente de existir y;
-	// si este lo indica retornando CLOSE_CLIENT, cierra la conexión
-	// y remueve al cliente de los registros; si retorna STOP_SERVER,
-	// se finalizará el thread del servidor.
+struct timer_wheel {
 
-	pthread_mutex_lock(&input->lock);
-	int ret = run_handler(input->handlers.on_can_read, client_fd, input->shared_data);
-	pthread_mutex_unlock(&input->lock);
+	// Rueda de timers de TIMER_WHEEL_SLOTS slots de TIMER_TICK
+	// milisegundos. Cada timer va en el slot de su tick de vencimiento
+	// módulo la cantidad de slots; los que vencen en una vuelta
+	// posterior se saltean hasta que llega su tick. Los timers de los
+	// clientes se reservan una única vez por file descriptor.
 
-	switch(ret) {
-		case CLOSE_CLIENT:
-			remove_client(cliets, client_fd);
-			// Cerrar el file descriptor lo remueve automáticamente
-			// de los descriptors registrados de epoll, no es necesario
-			// removerlos a mano.
-			close(client_fd);
-			break;
-		case STOP_SERVER:
-			stop_server(input);
-			break;
+	struct server_timer* slots[TIMER_WHEEL_SLOTS];
+	int64_t current_tick;
+	struct server_timer** client_timers;
+	int client_timers_size;
+};
+
+int64_t get_current_ms() {
+	struct timespec now;
+	clock_gettime(CLOCK_MONOTONIC, &now);
+	return (int64_t) now.tv_sec * 1000 + now.tv_nsec / 1000000;
+}
+
+int64_t get_current_us() {
+	struct timespec now;
+	clock_gettime(CLOCK_MONOTONIC, &now);
+	return (int64_t) now.tv_sec * 1000000 + now.tv_nsec / 1000;
+}
+
+int64_t get_spin_end(int64_t start, int timeout, int spin_time) {
+
+	// Retorna hasta cuándo (en microsegundos) consultar eventos sin
+	// bloquear: spin_time microsegundos desde start, sin superar el
+	// timeout de la espera.
+
+	int64_t spin = spin_time;
+	if((int64_t) timeout * 1000 < spin) {
+		spin = (int64_t) timeout * 1000;
 	}
+	return start + spin;
 }
 
-void* run_server(void * data) {
+int get_remaining_timeout(int64_t start, int timeout) {
 
-	// Corre un servidor. Debe ejecutarse en un thread nuevo, recibiendo
-	// como parámetro un puntero a una estructura server_input.
-	// Utiliza epoll para multiplexar la entrada. Maneja los nuevos clientes
-	// y aquellos listos para la lectura manteniendo un registro de ellos
-	// y llamando a los handlers correspondientes provistos por medio del
-	// server_input.
+	// Retorna cuántos milisegundos quedan de una espera de timeout
+	// milisegundos que empezó en start (en microsegundos).
 
-	// Cuando el servidor es señalizado que tiene que finalizar a través
-	// de su server_input; cierra todas las conexiones, al igual que el
-	// file descriptor asociado a la instancia de epoll, y retorna. 
+	int64_t remaining = (int64_t) timeout * 1000 - (get_current_us() - start);
+	return remaining > 0 ? (remaining + 999) / 1000 : 0;
+}
 
-	struct server_input* input = (struct server_input*) data;
+void init_timer_wheel(struct timer_wheel* wheel) {
+	memset(wheel->slots, 0, sizeof wheel->slots);
+	wheel->current_tick = get_current_ms() / TIMER_TICK;
+	wheel->client_timers = NULL;
+	wheel->client_timers_size = 0;
+}
 
-	pthread_mutex_lock(&input->lock);
-	int server_fd = input->server_fd;;
-	pthread_mutex_unlock(&input->lock);
+void push_timer(struct server_timer** list, struct server_timer* timer) {
 
-	struct epoll_event events[MAX_EPOLL_EVENTS];
-	struct clients_storage cliets = init_clients_storage();
-	int epoll_event_count, epoll_fd = epoll_create1(0);
+	// Agrega el timer al principio de la lista list.
 
-	if(epoll_fd == -1) {
-		fprintf(stderr, "Couldn't get epoll file descriptor. Errno: %d\n", errno);
+	timer->next = *list;
+	timer->prev = list;
+	if(*list != NULL) {
+		(*list)->prev = &timer->next;
 	}
+	*list = timer;
+}
 
-	if(add_epoll_fd(epoll_fd, server_fd) == -1) {
-		close(epoll_fd);
-		return NULL;
+void unlink_timer(struct server_timer* timer) {
+
+	// Remueve el timer de la lista en la que se encuentre, si está
+	// en alguna.
+
+	if(timer->prev == NULL) {
+		return;
+	}
+	*timer->prev = timer->next;
+	if(timer->next != NULL) {
+		timer->next->prev = timer->prev;
 	}
+	timer->next = NULL;
+	timer->prev = NULL;
+}
 
-	while(!thread_should_stop(input)) {
-		epoll_event_count = epoll_wait(epoll_fd, events, 
-			MAX_EPOLL_EVENTS, EPOLL_TIMEOUT);
-		for(int i = 0; i < epoll_event_count; i++) { 
-			int socket_fd = events[i].data.fd;
-			if(socket_fd == server_fd) {
-				accept_new_client(server_fd, epoll_fd, &cliets, input);
-			} else {
-				handle_data_from_client(socket_fd, &cliets, input);
-			}
+void schedule_timer(struct timer_wheel* wheel, struct server_timer* timer, int timeout) {
+
+	// Agrega el timer a la rueda para que venza dentro de timeout
+	// milisegundos, redondeados hacia arriba a un tick. Se usa la hora
+	// actual y no el tick de la rueda, que puede estar atrasado.
+
+	if(timeout < 0) {
+		timeout = 0;
+	}
+	unlink_timer(timer);
+	timer->expires = (get_current_ms() + timeout + TIMER_TICK - 1) / TIMER_TICK;
+	if(timer->expires <= wheel->current_tick) {
+		timer->expires = wheel->current_tick + 1;
+	}
+	push_timer(&wheel->slots[timer->expires % TIMER_WHEEL_SLOTS], timer);
+}
+
+int schedule_client_timer(struct timer_wheel* wheel, int client_fd, int timeout) {
+
+	// Programa (o reprograma) el timeout del cliente client_fd para
+	// dentro de timeout milisegundos. Retorna -1 en caso de error.
+
+	if(client_fd >= wheel->client_timers_size) {
+		int new_size = wheel->client_timers_size > 0 ? wheel->client_timers_size : 16;
+		while(new_size <= client_fd) {
+			new_size *= 2;
+		}
+		struct server_timer** new_timers = realloc(wheel->client_timers,
+			new_size * sizeof(struct server_timer*));
+		if(new_timers == NULL) {
+			fprintf(stderr, "Couldn't allocate memory for timers.\n");
+			return -1;
+		}
+		memset(new_timers + wheel->client_timers_size, 0,
+			(new_size - wheel->client_timers_size) * sizeof(struct server_timer*));
+		wheel->client_timers = new_timers;
+		wheel->client_timers_size = new_size;
+	}
+	struct server_timer* timer = wheel->client_timers[client_fd];
+	if(timer == NULL) {
+		if((timer = calloc(1, sizeof(struct server_timer))) == NULL) {
+			fprintf(stderr, "Couldn't allocate memory for timers.\n");
+			return -1;
 		}
+		timer->client_fd = client_fd;
+		wheel->client_timers[client_fd] = timer;
 	}
+	schedule_timer(wheel, timer, timeout);
+	return 0;
+}
 
-	clear_clients(cliets);
-	close(epoll_fd);
+void cancel_client_timer(struct timer_wheel* wheel, int client_fd) {
+	if(client_fd < wheel->client_timers_size && wheel->client_timers[client_fd] != NULL) {
+		unlink_timer(wheel->client_timers[client_fd]);
+	}
 }
 
-int start_server(pthread_t* thread, struct server_input* input) {
+int next_timer_timeout(struct timer_wheel* wheel) {
 
-	// Recibe un punteros a un pthread_t y a una estructura server_input.
-	// Iniacializa el thread para correr la función run_server con la entrada
-	// provista. Retorna -1 en caso de error, 0 en caso de éxito.
+	// Retorna la cantidad de milisegundos hasta el próximo slot de la
+	// rueda que tenga timers, o EPOLL_TIMEOUT si no hay ninguno antes.
 
-	int ret;
-	if((ret = pthread_create(thread, NULL, &run_server, input)) != 0) {
-		fprintf(stderr, "Couldn't start server thread, error at pthread_create(). Error code: %d\n", ret);
+	int64_t now = get_current_ms();
+	for(int64_t tick = wheel->current_tick + 1;
+			tick * TIMER_TICK - now < EPOLL_TIMEOUT; tick++) {
+		if(wheel->slots[tick % TIMER_WHEEL_SLOTS] != NULL) {
+			int64_t timeout = tick * TIMER_TICK - now;
+			return timeout > 0 ? timeout : 0;
+		}
+	}
+	return EPOLL_TIMEOUT;
+}
+
+void destroy_timer_wheel(struct timer_wheel* wheel) {
+
+	// Libera los timers pendientes y los de los clientes.
+
+	for(int i = 0; i < TIMER_WHEEL_SLOTS; i++) {
+		while(wheel->slots[i] != NULL) {
+			struct server_timer* timer = wheel->slots[i];
+			unlink_timer(timer);
+			if(timer->client_fd == -1) {
+				free(timer);
+			}
+		}
+	}
+	for(int fd = 0; fd < wheel->client_timers_size; fd++) {
+		free(wheel->client_timers[fd]);
+	}
+	free(wheel->client_timers);
+}
+
+struct server_timer* add_server_timer(struct server_input* input, int timeout,
+		timer_callback_t callback, void* data) {
+
+	// Programa la ejecución de callback(data) en el thread del servidor
+	// dentro de timeout milisegundos. Solo puede llamarse desde el
+	// thread del servidor, es decir, desde un handler o el callback de
+	// otro timer. Retorna el timer o NULL en caso de error.
+
+	if(input->timers == NULL) {
+		return NULL;
+	}
+	struct server_timer* timer = malloc(sizeof(struct server_timer));
+	if(timer == NULL) {
+		fprintf(stderr, "Couldn't allocate memory for timers.\n");
+		return NULL;
+	}
+	timer->client_fd = -1;
+	timer->callback = callback;
+	timer->data = data;
+	timer->prev = NULL;
+	schedule_timer(input->timers, timer, timeout);
+	return timer;
+}
+
+void cancel_server_timer(struct server_timer* timer) {
+
+	// Cancela un timer creado con add_server_timer() que todavía no se
+	// ejecutó. Al igual que este, solo puede llamarse desde el thread
+	// del servidor.
+
+	unlink_timer(timer);
+	free(timer);
+}
+
+int set_client_timeout(struct server_input* input, int client_fd, int timeout) {
+
+	// Reprograma el timeout del cliente para dentro de timeout
+	// milisegundos, por ejemplo, para limitar el tiempo en que debe
+	// terminar de llegar un mensaje. El timeout vuelve a ser
+	// idle_timeout la próxima vez que lleguen datos del cliente. Solo
+	// puede llamarse desde el thread del servidor.
+
+	if(input->timers == NULL) {
+		return -1;
+	}
+	return schedule_client_timer(input->timers, client_fd, timeout);
+}
+
+#ifdef HAS_IO_URING
+
+#ifndef IORING_ACCEPT_MULTISHOT
+#define IORING_ACCEPT_MULTISHOT (1U << 0)
+#endif
+
+struct uring_client {
+	uint32_t generation;
+	int armed;
+};
+
+struct uring_loop {
+
+	// Ring de io_uring del backend IO_URING_BACKEND, mapeado
+	// directamente con las syscalls del kernel. Los clientes se observan
+	// con polls de un solo uso que se vuelven a armar luego de cada
+	// evento, por lo que se comportan igual que con epoll: on_can_read
+	// se ejecuta mientras queden datos sin leer. Si el servidor define
+	// on_data (recv_data), en cambio, los datos se reciben con un recv
+	// multishot por cliente en los buffers de buffer_ring, sin syscalls
+	// por mensaje. El user_data de cada poll o recv lleva el file
+	// descriptor del cliente y su generación, que se incrementa al
+	// cerrar la conexión, para descartar los eventos de una conexión
+	// anterior con el mismo file descriptor. Las entradas, incluidos
+	// los envíos de server_send(), se acumulan en la cola de envío y se
+	// envían junto con la espera de eventos, en una única syscall por
+	// iteración.
+
+	int ring_fd;
+	unsigned entries;
+	unsigned sqe_tail;
+	unsigned* sq_head;
+	unsigned* sq_tail;
+	unsigned* sq_mask;
+	unsigned* sq_array;
+	struct io_uring_sqe* sqes;
+	unsigned* cq_head;
+	unsigned* cq_tail;
+	unsigned* cq_mask;
+	struct io_uring_cqe* cqes;
+	void* sq_ring;
+	size_t sq_ring_size;
+	void* cq_ring;
+	size_t cq_ring_size;
+	size_t sqes_size;
+	int accept_armed;
+	int accept_canceled;
+	int multishot_accept;
+	struct uring_client* clients;
+	int clients_size;
+	struct io_uring_buf_ring* buffer_ring;
+	uint8_t* buffers;
+	unsigned short buffer_tail;
+	int multishot_recv;
+	int recv_data;
+};
+
+void destroy_uring_loop(struct uring_loop* ring) {
+
+	// Cierra el ring, lo que cancela todas sus operaciones pendientes,
+	// y libera sus colas.
+
+	if(ring->sq_ring != NULL) {
+		munmap(ring->sq_ring, ring->sq_ring_size);
+	}
+	if(ring->cq_ring != NULL) {
+		munmap(ring->cq_ring, ring->cq_ring_size);
+	}
+	if(ring->sqes != NULL) {
+		munmap(ring->sqes, ring->sqes_size);
+	}
+	close(ring->ring_fd);
+	free(ring->clients);
+	// Los buffers se liberan recién al cerrar el ring, cuando el
+	// kernel ya no puede escribir en ellos
+	if(ring->buffer_ring != NULL) {
+		munmap(ring->buffer_ring, URING_BUFFERS * sizeof(struct io_uring_buf));
+	}
+	free(ring->buffers);
+}
+
+void* map_uring_queue(int ring_fd, size_t size, off_t offset) {
+	void* queue = mmap(NULL, size, PROT_READ | PROT_WRITE,
+		MAP_SHARED | MAP_POPULATE, ring_fd, offset);
+	return queue == MAP_FAILED ? NULL : queue;
+}
+
+int init_uring_loop(struct uring_loop* ring) {
+
+	// Crea el ring y mapea sus colas. Requiere que el kernel permita
+	// esperar eventos con timeout (IORING_FEAT_EXT_ARG) y que no
+	// descarte eventos si se llena la cola (IORING_FEAT_NODROP).
+	// Retorna -1 en caso de error o si io_uring no está disponible.
+
+	struct io_uring_params params;
+	memset(&params, 0, sizeof params);
+	memset(ring, 0, sizeof *ring);
+	if((ring->ring_fd = syscall(__NR_io_uring_setup, URING_ENTRIES, &params)) == -1) {
+		return -1;
+	}
+	if(!(params.features & IORING_FEAT_EXT_ARG) || !(params.features & IORING_FEAT_NODROP)) {
+		close(ring->ring_fd);
+		return -1;
+	}
+	ring->entries = params.sq_entries;
+	ring->multishot_accept = 1;
+	ring->sq_ring_size = params.sq_off.array + params.sq_entries * sizeof(unsigned);
+	ring->cq_ring_size = params.cq_off.cqes + params.cq_entries * sizeof(struct io_uring_cqe);
+	ring->sqes_size = params.sq_entries * sizeof(struct io_uring_sqe);
+	ring->sq_ring = map_uring_queue(ring->ring_fd, ring->sq_ring_size, IORING_OFF_SQ_RING);
+	ring->cq_ring = map_uring_queue(ring->ring_fd, ring->cq_ring_size, IORING_OFF_CQ_RING);
+	ring->sqes = map_uring_queue(ring->ring_fd, ring->sqes_size, IORING_OFF_SQES);
+	if(ring->sq_ring == NULL || ring->cq_ring == NULL || ring->sqes == NULL) {
+		destroy_uring_loop(ring);
+		return -1;
+	}
+	uint8_t* sq_ring = ring->sq_ring;
+	uint8_t* cq_ring = ring->cq_ring;
+	ring->sq_head = (unsigned*) (sq_ring + params.sq_off.head);
+	ring->sq_tail = (unsigned*) (sq_ring + params.sq_off.tail);
+	ring->sq_mask = (unsigned*) (sq_ring + params.sq_off.ring_mask);
+	ring->sq_array = (unsigned*) (sq_ring + params.sq_off.array);
+	ring->cq_head = (unsigned*) (cq_ring + params.cq_off.head);
+	ring->cq_tail = (unsigned*) (cq_ring + params.cq_off.tail);
+	ring->cq_mask = (unsigned*) (cq_ring + params.cq_off.ring_mask);
+	ring->cqes = (struct io_uring_cqe*) (cq_ring + params.cq_off.cqes);
+	ring->sqe_tail = *ring->sq_tail;
+	return 0;
+}
+
+int io_uring_available() {
+
+	// Retorna si puede crearse un ring para el backend io_uring.
+
+	struct uring_loop ring;
+	if(init_uring_loop(&ring) == -1) {
+		return 0;
+	}
+	destroy_uring_loop(&ring);
+	return 1;
+}
+
+int submit_uring(struct uring_loop* ring, int wait_timeout) {
+
+	// Envía las entradas pendientes de la cola de envío y, si
+	// wait_timeout no es negativo, espera hasta wait_timeout
+	// milisegundos a que se complete alguna operación. Retorna -1 en
+	// caso de error, incluido que venza el timeout (errno ETIME).
+
+	__atomic_store_n(ring->sq_tail, ring->sqe_tail, __ATOMIC_RELEASE);
+	unsigned to_submit = ring->sqe_tail - __atomic_load_n(ring->sq_head, __ATOMIC_ACQUIRE);
+	if(wait_timeout < 0) {
+		return syscall(__NR_io_uring_enter, ring->ring_fd, to_submit, 0, 0, NULL, 0);
+	}
+	struct __kernel_timespec timeout;
+	struct io_uring_getevents_arg arg;
+	timeout.tv_sec = wait_timeout / 1000;
+	timeout.tv_nsec = (wait_timeout % 1000) * 1000000;
+	memset(&arg, 0, sizeof arg);
+	arg.ts = (uint64_t) (uintptr_t) &timeout;
+	return syscall(__NR_io_uring_enter, ring->ring_fd, to_submit, 1,
+		IORING_ENTER_GETEVENTS | IORING_ENTER_EXT_ARG, &arg, sizeof arg);
+}
+
+int uring_has_completions(struct uring_loop* ring) {
+	return *ring->cq_head != __atomic_load_n(ring->cq_tail, __ATOMIC_ACQUIRE);
+}
+
+void wait_uring_events(struct uring_loop* ring, int timeout, int spin_time) {
+
+	// Envía las operaciones pendientes y espera hasta timeout
+	// milisegundos a que se complete alguna. Si spin_time es mayor a
+	// 0, primero consulta el ring sin bloquear durante hasta spin_time
+	// microsegundos, y solo luego se bloquea.
+
+	if(spin_time > 0 && timeout > 0) {
+		int64_t start = get_current_us();
+		int64_t spin_end = get_spin_end(start, timeout, spin_time);
+		do {
+			submit_uring(ring, 0);
+			if(uring_has_completions(ring)) {
+				return;
+			}
+		} while(get_current_us() < spin_end);
+		timeout = get_remaining_timeout(start, timeout);
+	}
+	submit_uring(ring, timeout);
+}
+
+struct io_uring_sqe* get_uring_sqe(struct uring_loop* ring, uint8_t opcode, int fd, uint64_t user_data) {
+
+	// Retorna una entrada nueva de la cola de envío para la operación
+	// opcode sobre fd, o NULL si la cola sigue llena luego de enviar
+	// las entradas pendientes.
+
+	if(ring->sqe_tail - __atomic_load_n(ring->sq_head, __ATOMIC_ACQUIRE) >= ring->entries) {
+		submit_uring(ring, -1);
+		if(ring->sqe_tail - __atomic_load_n(ring->sq_head, __ATOMIC_ACQUIRE) >= ring->entries) {
+			fprintf(stderr, "io_uring submission queue is full.\n");
+			return NULL;
+		}
+	}
+	unsigned index = ring->sqe_tail & *ring->sq_mask;
+	struct io_uring_sqe* sqe = &ring->sqes[index];
+	memset(sqe, 0, sizeof *sqe);
+	sqe->opcode = opcode;
+	sqe->fd = fd;
+	sqe->user_data = user_data;
+	ring->sq_array[index] = index;
+	ring->sqe_tail++;
+	return sqe;
+}
+
+uint64_t uring_poll_data(struct uring_loop* ring, int client_fd) {
+	return ((uint64_t) ring->clients[client_fd].generation << 32) | (uint32_t) client_fd;
+}
+
+int arm_uring_poll(struct uring_loop* ring, int client_fd) {
+
+	// Espera a que el cliente tenga datos para leer o cierre la
+	// conexión. Retorna -1 en caso de error.
+
+	struct io_uring_sqe* sqe = get_uring_sqe(ring, IORING_OP_POLL_ADD,
+		client_fd, uring_poll_data(ring, client_fd));
+	if(sqe == NULL) {
+		return -1;
+	}
+	// Las máscaras de poll tienen los mismos valores que las de epoll
+	sqe->poll32_events = EPOLLIN | EPOLLRDHUP;
+	ring->clients[client_fd].armed = 1;
+	return 0;
+}
+
+#ifdef HAS_URING_BUFFERS
+
+void recycle_uring_buffer(struct uring_loop* ring, int buffer_id) {
+
+	// Devuelve un buffer al ring de buffers provistos para que el
+	// kernel vuelva a usarlo.
+
+	struct io_uring_buf* buffer = &ring->buffer_ring->bufs[ring->buffer_tail & (URING_BUFFERS - 1)];
+	buffer->addr = (uint64_t) (uintptr_t) (ring->buffers + (size_t) buffer_id * DATA_BUFFER_SIZE);
+	buffer->len = DATA_BUFFER_SIZE;
+	buffer->bid = buffer_id;
+	ring->buffer_tail++;
+	__atomic_store_n(&ring->buffer_ring->tail, ring->buffer_tail, __ATOMIC_RELEASE);
+}
+
+int init_uring_buffers(struct uring_loop* ring) {
+
+	// Registra el ring de buffers provistos, del que el kernel toma un
+	// buffer para cada recv de los clientes. Requiere Linux 5.19 o
+	// posterior. Retorna -1 si no puede registrarse.
+
+	size_t ring_size = URING_BUFFERS * sizeof(struct io_uring_buf);
+	void* buffer_ring = mmap(NULL, ring_size, PROT_READ | PROT_WRITE,
+		MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+	if(buffer_ring == MAP_FAILED) {
+		return -1;
+	}
+	uint8_t* buffers = malloc((size_t) URING_BUFFERS * DATA_BUFFER_SIZE);
+	struct io_uring_buf_reg reg;
+	memset(&reg, 0, sizeof reg);
+	reg.ring_addr = (uint64_t) (uintptr_t) buffer_ring;
+	reg.ring_entries = URING_BUFFERS;
+	reg.bgid = URING_BUFFER_GROUP;
+	if(buffers == NULL || syscall(__NR_io_uring_register, ring->ring_fd,
+			IORING_REGISTER_PBUF_RING, &reg, 1) == -1) {
+		munmap(buffer_ring, ring_size);
+		free(buffers);
+		return -1;
+	}
+	ring->buffer_ring = buffer_ring;
+	ring->buffers = buffers;
+	ring->multishot_recv = 1;
+	for(int buffer_id = 0; buffer_id < URING_BUFFERS; buffer_id++) {
+		recycle_uring_buffer(ring, buffer_id);
+	}
+	return 0;
+}
+
+int arm_uring_recv(struct uring_loop* ring, int client_fd) {
+
+	// Recibe los datos del cliente en un buffer provisto. Si el kernel
+	// lo soporta, el recv es multishot: sigue activo y recibe en un
+	// buffer nuevo cada vez que llegan datos, hasta que la conexión se
+	// cierre o se acaben los buffers. Retorna -1 en caso de error.
+
+	struct io_uring_sqe* sqe = get_uring_sqe(ring, IORING_OP_RECV,
+		client_fd, uring_poll_data(ring, client_fd));
+	if(sqe == NULL) {
+		return -1;
+	}
+	sqe->flags = IOSQE_BUFFER_SELECT;
+	sqe->buf_group = URING_BUFFER_GROUP;
+	if(ring->multishot_recv) {
+		sqe->ioprio = IORING_RECV_MULTISHOT;
+	}
+	ring->clients[client_fd].armed = 1;
+	return 0;
+}
+
+#else
+
+int init_uring_buffers(struct uring_loop* ring) {
+	return -1;
+}
+
+int arm_uring_recv(struct uring_loop* ring, int client_fd) {
+	return -1;
+}
+
+#endif
+
+int arm_uring_client(struct uring_loop* ring, int client_fd) {
+	return ring->recv_data ? arm_uring_recv(ring, client_fd) : arm_uring_poll(ring, client_fd);
+}
+
+int arm_uring_send(struct uring_loop* ring, int client_fd, const uint8_t* data, int size) {
+
+	// Envía size bytes de data al cliente. data debe seguir siendo
+	// válido hasta que se complete el envío. Retorna -1 en caso de
+	// error.
+
+	struct io_uring_sqe* sqe = get_uring_sqe(ring, IORING_OP_SEND,
+		client_fd, URING_SEND_DATA | (uint32_t) client_fd);
+	if(sqe == NULL) {
+		return -1;
+	}
+	sqe->addr = (uint64_t) (uintptr_t) data;
+	sqe->len = size;
+	sqe->msg_flags = MSG_NOSIGNAL;
+	return 0;
+}
+
+int submit_uring_output(struct send_queue* queue, int client_fd) {
+
+	// Agrega a la cola del ring el envío de los datos encolados para
+	// el cliente, salvo que ya tenga uno en curso: en ese caso, el
+	// resto se envía cuando este se complete, de modo que los datos
+	// de un cliente se envían en orden. Retorna -1 en caso de error.
+
+	struct client_output* output = &queue->outputs[client_fd];
+	if(output->in_flight) {
+		return 0;
+	}
+	if(output->sent == output->sending_size && output->pending_size > 0) {
+		uint8_t* sending = output->sending;
+		int sending_capacity = output->sending_capacity;
+		output->sending = output->pending;
+		output->sending_capacity = output->pending_capacity;
+		output->sending_size = output->pending_size;
+		output->sent = 0;
+		output->pending = sending;
+		output->pending_capacity = sending_capacity;
+		output->pending_size = 0;
+	}
+	if(output->sent == output->sending_size) {
+		return 0;
+	}
+	if(arm_uring_send(queue->ring, client_fd, output->sending + output->sent,
+			output->sending_size - output->sent) == -1) {
+		return -1;
+	}
+	output->in_flight = 1;
+	queue->sends_in_flight++;
+	return 0;
+}
+
+void cancel_uring_sends(struct uring_loop* ring, struct send_queue* queue) {
+	for(int fd = 0; fd < queue->outputs_size; fd++) {
+		if(queue->outputs[fd].in_flight) {
+			struct io_uring_sqe* sqe = get_uring_sqe(ring, IORING_OP_ASYNC_CANCEL,
+				-1, URING_IGNORE_DATA);
+			if(sqe != NULL) {
+				sqe->addr = URING_SEND_DATA | (uint32_t) fd;
+			}
+		}
+	}
+}
+
+void drain_uring_sends(struct uring_loop* ring, struct send_queue* queue) {
+
+	// Al finalizar el servidor, espera hasta URING_DRAIN_TIMEOUT
+	// milisegundos a que se completen los envíos en curso, ya que hasta
+	// entonces el kernel puede seguir leyendo sus buffers. Los que no
+	// se completan a tiempo se cancelan, y se espera lo mismo a que
+	// terminen. El resto de los eventos se descarta.
+
+	int canceled = 0;
+	int64_t deadline = get_current_ms() + URING_DRAIN_TIMEOUT;
+	while(queue->sends_in_flight > 0) {
+		int64_t remaining = deadline - get_current_ms();
+		if(remaining <= 0) {
+			if(canceled) {
+				break;
+			}
+			cancel_uring_sends(ring, queue);
+			canceled = 1;
+			deadline = get_current_ms() + URING_DRAIN_TIMEOUT;
+			continue;
+		}
+		submit_uring(ring, remaining);
+		unsigned head = *ring->cq_head;
+		while(head != __atomic_load_n(ring->cq_tail, __ATOMIC_ACQUIRE)) {
+			struct io_uring_cqe* cqe = &ring->cqes[head & *ring->cq_mask];
+			if(cqe->user_data != URING_ACCEPT_DATA && cqe->user_data != URING_IGNORE_DATA
+					&& (cqe->user_data & URING_SEND_DATA)) {
+				queue->outputs[(uint32_t) cqe->user_data].in_flight = 0;
+				queue->sends_in_flight--;
+			}
+			head++;
+		}
+		__atomic_store_n(ring->cq_head, head, __ATOMIC_RELEASE);
+	}
+}
+
+int watch_uring_client(struct uring_loop* ring, int client_fd) {
+
+	// Empieza a observar a un cliente nuevo. Retorna -1 en caso de
+	// error.
+
+	if(client_fd >= ring->clients_size) {
+		int new_size = ring->clients_size > 0 ? ring->clients_size : 16;
+		while(new_size <= client_fd) {
+			new_size *= 2;
+		}
+		struct uring_client* new_clients = realloc(ring->clients,
+			new_size * sizeof(struct uring_client));
+		if(new_clients == NULL) {
+			fprintf(stderr, "Couldn't allocate memory for clients.\n");
+			return -1;
+		}
+		memset(new_clients + ring->clients_size, 0,
+			(new_size - ring->clients_size) * sizeof(struct uring_client));
+		ring->clients = new_clients;
+		ring->clients_size = new_size;
+	}
+	return arm_uring_client(ring, client_fd);
+}
+
+void unwatch_uring_client(struct uring_loop* ring, int client_fd) {
+
+	// Deja de observar a un cliente cuya conexión va a cerrarse. Si
+	// tiene un poll o un recv armado lo cancela, ya que mientras tanto
+	// el kernel mantiene abierto el socket aunque se cierre su file
+	// descriptor. La generación se limita a 28 bits para que el
+	// user_data no se confunda con el de un envío.
+
+	if(client_fd >= ring->clients_size) {
+		return;
+	}
+	struct uring_client* client = &ring->clients[client_fd];
+	if(client->armed) {
+		struct io_uring_sqe* sqe = get_uring_sqe(ring, IORING_OP_ASYNC_CANCEL,
+			-1, URING_IGNORE_DATA);
+		if(sqe != NULL) {
+			sqe->addr = uring_poll_data(ring, client_fd);
+		}
+		client->armed = 0;
+	}
+	client->generation = (client->generation + 1) & URING_GENERATION_MASK;
+}
+
+void arm_uring_accept(struct uring_loop* ring, int server_fd, int multishot) {
+
+	// Acepta conexiones en el socket servidor. Si multishot es distinto
+	// de 0 y el kernel lo soporta, una única operación acepta todas las
+	// conexiones hasta que se cancele; si no, acepta una sola.
+
+	struct io_uring_sqe* sqe = get_uring_sqe(ring, IORING_OP_ACCEPT,
+		server_fd, URING_ACCEPT_DATA);
+	if(sqe == NULL) {
+		return;
+	}
+	if(multishot && ring->multishot_accept) {
+		sqe->ioprio = IORING_ACCEPT_MULTISHOT;
+	}
+	ring->accept_armed = 1;
+	ring->accept_canceled = 0;
+}
+
+void cancel_uring_accept(struct uring_loop* ring) {
+	if(!ring->accept_armed || ring->accept_canceled) {
+		return;
+	}
+	struct io_uring_sqe* sqe = get_uring_sqe(ring, IORING_OP_ASYNC_CANCEL,
+		-1, URING_IGNORE_DATA);
+	if(sqe != NULL) {
+		sqe->addr = URING_ACCEPT_DATA;
+		ring->accept_canceled = 1;
+	}
+}
+
+#else
+
+int io_uring_available() {
+	return 0;
+}
+
+int submit_uring_output(struct send_queue* queue, int client_fd) {
+	return -1;
+}
+
+int watch_uring_client(struct uring_loop* ring, int client_fd) {
+	return -1;
+}
+
+void unwatch_uring_client(struct uring_loop* ring, int client_fd) {
+}
+
+void cancel_uring_accept(struct uring_loop* ring) {
+}
+
+#endif
+
+int settle_client_output(struct send_queue* queue, int client_fd) {
+
+	// Resuelve los datos encolados para un cliente cuya conexión va a
+	// cerrarse. Con epoll, los envía. Con io_uring, si quedan datos
+	// por enviar, marca la conexión para cerrarla cuando termine de
+	// enviarlos y retorna 1. En otro caso retorna 0 y la conexión
+	// puede cerrarse.
+
+	if(client_fd >= queue->outputs_size) {
+		return 0;
+	}
+	struct client_output* output = &queue->outputs[client_fd];
+	if(queue->ring == NULL) {
+		if(output->pending_size > 0) {
+			send_all(client_fd, output->pending, output->pending_size, 0);
+		}
+		release_client_output(output);
+		return 0;
+	}
+	if(output->in_flight || output->sent < output->sending_size || output->pending_size > 0) {
+		output->closing = 1;
+		queue_client_output(queue, client_fd);
+		return 1;
+	}
+	release_client_output(output);
+	return 0;
+}
+
+void close_client(int client_fd, struct clients_storage* clients,
+		struct server_input* input) {
+
+	// Ejecuta el handler on_close, cierra la conexión con el cliente y
+	// lo remueve de los registros. Cerrar el file descriptor lo remueve
+	// automáticamente de los descriptors registrados de epoll, no es
+	// necesario removerlo a mano. Con io_uring, en cambio, primero se
+	// deja de observar al cliente. Los datos encolados con
+	// server_send() se envían antes de cerrar el file descriptor.
+
+	pthread_mutex_lock(&input->lock);
+	run_handler(input->handlers.on_close, client_fd, input->shared_data);
+	pthread_mutex_unlock(&input->lock);
+	remove_client(clients, client_fd);
+	cancel_client_timer(input->timers, client_fd);
+	if(clients->ring != NULL) {
+		unwatch_uring_client(clients->ring, client_fd);
+	}
+	if(clients->queue != NULL && settle_client_output(clients->queue, client_fd)) {
+		return;
+	}
+	close(client_fd);
+}
+
+void flush_send_queue(struct clients_storage* clients, struct server_input* input) {
+
+	// Envía los datos encolados durante la iteración del servidor. Con
+	// epoll, con un send() por cliente; con io_uring, agregando un
+	// envío por cliente a la cola del ring, que se envía junto con la
+	// siguiente espera de eventos. Si un envío falla, cierra la
+	// conexión, y cierra las conexiones que ya no tienen datos por
+	// enviar y esperaban hacerlo.
+
+	struct send_queue* queue = clients->queue;
+	for(int i = 0; i < queue->queued_count; i++) {
+		int client_fd = queue->queued[i];
+		struct client_output* output = &queue->outputs[client_fd];
+		output->queued = 0;
+		if(queue->ring == NULL) {
+			int ret = 0;
+			if(output->pending_size > 0) {
+				ret = send_all(client_fd, output->pending, output->pending_size, 0);
+				output->pending_size = 0;
+			}
+			if(ret == -1) {
+				close_client(client_fd, clients, input);
+			}
+		} else if(submit_uring_output(queue, client_fd) == -1) {
+			int closing = output->closing;
+			release_client_output(output);
+			if(closing) {
+				close(client_fd);
+			} else {
+				close_client(client_fd, clients, input);
+			}
+		} else if(output->closing && !output->in_flight) {
+			release_client_output(output);
+			close(client_fd);
+		}
+	}
+	queue->queued_count = 0;
+}
+
+void reject_client(int client_fd, struct server_input* input) {
+
+	// Ejecuta el handler on_close y cierra la conexión con un cliente
+	// que on_new_client rechazó, y que por lo tanto no llegó a
+	// registrarse.
+
+	pthread_mutex_lock(&input->lock);
+	run_handler(input->handlers.on_close, client_fd, input->shared_data);
+	pthread_mutex_unlock(&input->lock);
+	close(client_fd);
+}
+
+void handle_client_timeout(int client_fd, struct clients_storage* clients,
+		struct server_input* input) {
+
+	// Se ejecuta cuando vence el timeout de un cliente. Ejecuta el
+	// handler on_timeout y, si retorna CLOSE_CLIENT o no está definido,
+	// cierra la conexión. En otro caso, si el handler no reprogramó el
+	// timeout, vuelve a programarlo dentro de idle_timeout milisegundos.
+
+	pthread_mutex_lock(&input->lock);
+	int ret = CLOSE_CLIENT;
+	if(input->handlers.on_timeout != NULL) {
+		ret = input->handlers.on_timeout(client_fd, input->shared_data);
+	}
+	int idle_timeout = input->idle_timeout;
+	pthread_mutex_unlock(&input->lock);
+
+	switch(ret) {
+		case CLOSE_CLIENT:
+			close_client(client_fd, clients, input);
+			break;
+		case STOP_SERVER:
+			stop_server(input);
+			break;
+		default:
+			if(input->timers->client_timers[client_fd]->prev == NULL && idle_timeout > 0) {
+				schedule_client_timer(input->timers, client_fd, idle_timeout);
+			}
+	}
+}
+
+void expire_timers(struct clients_storage* clients, struct server_input* input) {
+
+	// Avanza la rueda de timers hasta el tick actual, ejecutando los
+	// timers vencidos. Los callbacks se ejecutan con el lock del
+	// servidor tomado, al igual que los handlers.
+
+	struct timer_wheel* wheel = input->timers;
+	int64_t now = get_current_ms() / TIMER_TICK;
+	while(wheel->current_tick < now) {
+		wheel->current_tick++;
+		struct server_timer** slot = &wheel->slots[wheel->current_tick % TIMER_WHEEL_SLOTS];
+		// Los timers del slot que vencen en otra vuelta se apartan y
+		// se devuelven al slot al final
+		struct server_timer* later = NULL;
+		while(*slot != NULL) {
+			struct server_timer* timer = *slot;
+			unlink_timer(timer);
+			if(timer->expires > wheel->current_tick) {
+				push_timer(&later, timer);
+			} else if(timer->client_fd != -1) {
+				handle_client_timeout(timer->client_fd, clients, input);
+			} else {
+				pthread_mutex_lock(&input->lock);
+				timer->callback(timer->data);
+				pthread_mutex_unlock(&input->lock);
+				free(timer);
+			}
+		}
+		while(later != NULL) {
+			struct server_timer* timer = later;
+			unlink_timer(timer);
+			push_timer(slot, timer);
+		}
+	}
+}
+
+int add_epoll_fd(int epoll_fd, int socket_fd) {
+
+	// Recibe un file descriptor asociado a una instancia de epoll y 
+	// otro file descriptor asociado a un socket. Registra el socket
+	// en la instancia de epoll, tanto para lectura como para detectar
+	// que la otra parte cerró la conexión o que esta falló. Retorna 0
+	// en caso de exito, -1 en caso contrario.
+
+	struct epoll_event event;
+	event.events = EPOLLIN | EPOLLRDHUP | EPOLLHUP | EPOLLERR;
+	event.data.fd = socket_fd;
+	if(epoll_ctl(epoll_fd, EPOLL_CTL_ADD, socket_fd, &event) == -1) {
+		fprintf(stderr, "Couldn't add file descriptor to epoll. Errno: %d\n", errno);
+		return -1;
+	}
+	return 0;
+}
+
+struct listener_state {
+
+	// Estado del socket servidor en el loop del servidor. Permite
+	// limitar la cantidad de clientes y la tasa de aceptación dejando
+	// de escuchar nuevas conexiones (pausando la escucha) mientras se
+	// supere alguno de los límites. Las conexiones entrantes esperan
+	// mientras tanto en el backlog del socket. Con epoll, la escucha se
+	// pausa quitando al socket servidor de los eventos; con io_uring
+	// (ring distinto de NULL), cancelando la operación de accept.
+
+	int server_fd;
+	int epoll_fd;
+	struct uring_loop* ring;
+	int paused;
+	int64_t window_start;
+	int window_accepts;
+};
+
+void init_listener_state(struct listener_state* listener, int server_fd,
+		int epoll_fd, struct uring_loop* ring) {
+	listener->server_fd = server_fd;
+	listener->epoll_fd = epoll_fd;
+	listener->ring = ring;
+	listener->paused = 0;
+	listener->window_start = get_current_ms();
+	listener->window_accepts = 0;
+}
+
+int set_listener_paused(struct listener_state* listener, int paused) {
+
+	// Pausa o reanuda la escucha de nuevas conexiones. Retorna -1 en
+	// caso de error.
+
+	if(listener->paused == paused) {
+		return 0;
+	}
+	if(listener->ring != NULL) {
+		// El loop de io_uring vuelve a aceptar conexiones al reanudarse
+		if(paused) {
+			cancel_uring_accept(listener->ring);
+		}
+		listener->paused = paused;
+		return 0;
+	}
+	struct epoll_event event;
+	event.events = paused ? 0 : EPOLLIN;
+	event.data.fd = listener->server_fd;
+	if(epoll_ctl(listener->epoll_fd, EPOLL_CTL_MOD, listener->server_fd, &event) == -1) {
+		fprintf(stderr, "Couldn't modify server file descriptor in epoll. Errno: %d\n", errno);
+		return -1;
+	}
+	listener->paused = paused;
+	return 0;
+}
+
+int update_listener(struct listener_state* listener,
+		struct clients_storage* clients, struct server_input* input) {
+
+	// Pausa la escucha si se alcanzó max_clients (salvo que se rechacen
+	// las conexiones de más con reject_when_full) o si se aceptaron
+	// max_accept_rate clientes en la ventana actual, y la reanuda en
+	// caso contrario. Retorna los milisegundos hasta que termina la
+	// ventana si la escucha quedó pausada por la tasa, -1 si no.
+
+	pthread_mutex_lock(&input->lock);
+	int max_clients = input->max_clients;
+	int max_accept_rate = input->max_accept_rate;
+	int reject_when_full = input->reject_when_full;
+	pthread_mutex_unlock(&input->lock);
+
+	int64_t now = get_current_ms();
+	if(now - listener->window_start >= ACCEPT_RATE_WINDOW) {
+		listener->window_start = now;
+		listener->window_accepts = 0;
+	}
+	int rate_exceeded = max_accept_rate > 0 && listener->window_accepts >= max_accept_rate;
+	int full = max_clients > 0 && clients->num_clients >= max_clients && !reject_when_full;
+	set_listener_paused(listener, rate_exceeded || full);
+	return rate_exceeded ? listener->window_start + ACCEPT_RATE_WINDOW - now : -1;
+}
+
+int wait_epoll_events(int epoll_fd, struct epoll_event* events, int timeout, int spin_time) {
+
+	// Espera hasta timeout milisegundos eventos de epoll. Si spin_time
+	// es mayor a 0, primero consulta epoll sin bloquear durante hasta
+	// spin_time microsegundos, y solo luego se bloquea. Así el thread
+	// no se duerme (ni paga el costo de despertarse) mientras los
+	// eventos lleguen seguido.
+
+	if(spin_time > 0 && timeout > 0) {
+		int64_t start = get_current_us();
+		int64_t spin_end = get_spin_end(start, timeout, spin_time);
+		do {
+			int event_count = epoll_wait(epoll_fd, events, MAX_EPOLL_EVENTS, 0);
+			if(event_count != 0) {
+				return event_count;
+			}
+		} while(get_current_us() < spin_end);
+		timeout = get_remaining_timeout(start, timeout);
+	}
+	return epoll_wait(epoll_fd, events, MAX_EPOLL_EVENTS, timeout);
+}
+
+int next_loop_timeout(struct timer_wheel* timers, struct listener_state* listener,
+		struct clients_storage* clients, struct server_input* input) {
+
+	// Actualiza la escucha y retorna cuántos milisegundos esperar
+	// eventos: hasta que venza el próximo timer o, si la escucha está
+	// pausada por la tasa de aceptación, hasta que termine la ventana
+	// actual.
+
+	int timeout = next_timer_timeout(timers);
+	int listener_timeout = update_listener(listener, clients, input);
+	if(listener_timeout >= 0 && listener_timeout < timeout) {
+		timeout = listener_timeout;
+	}
+	return timeout;
+}
+
+void reset_client(int client_fd) {
+
+	// Cierra una conexión recién aceptada sin ejecutar ningún handler.
+	// SO_LINGER en 0 hace que el cierre envíe un RST, de modo que el
+	// cliente se entera enseguida y no queda ningún estado de la
+	// conexión en el servidor.
+
+	struct linger linger = { 1, 0 };
+	setsockopt(client_fd, SOL_SOCKET, SO_LINGER, &linger, sizeof linger);
+	close(client_fd);
+}
+
+int watch_client(struct listener_state* listener, int client_fd) {
+
+	// Registra al cliente en el backend del loop para recibir sus
+	// eventos. Retorna -1 en caso de error.
+
+	if(listener->ring != NULL) {
+		return watch_uring_client(listener->ring, client_fd);
+	}
+	return add_epoll_fd(listener->epoll_fd, client_fd);
+}
+
+void set_busy_poll(int client_fd, int busy_poll) {
+
+	// Activa SO_BUSY_POLL en el socket del cliente: al recibir, el
+	// kernel consulta activamente la placa de red durante hasta
+	// busy_poll microsegundos en lugar de esperar la interrupción.
+	// Superar el valor de net.core.busy_read requiere CAP_NET_ADMIN;
+	// si no puede activarse, el socket funciona igual que sin él.
+
+#ifdef SO_BUSY_POLL
+	setsockopt(client_fd, SOL_SOCKET, SO_BUSY_POLL, &busy_poll, sizeof busy_poll);
+#endif
+}
+
+void add_accepted_client(int new_client, struct listener_state* listener,
+		struct clients_storage* clients, struct server_input* input) {
+
+	// Recibe una conexión recién aceptada, el estado del socket
+	// servidor, un puntero a la estructura de clientes y un puntero a
+	// la estructura input del servidor. Si ya se alcanzó max_clients
+	// (por ejemplo, porque reject_when_full está activado), rechaza la
+	// conexión. Si no, ejecuta el handler correspondiente de estar
+	// definido. Luego:
+	//				- Si el handler le indico retornando CLOSE_CLIENT,
+	// cierra la conexión del cliente (ejecutando el handler on_close).
+	//				- Si el handler retorna STOP_SERVER, cierra la
+	// conexión de la misma forma y se finalizará el thread del
+	// servidor.
+	//				- Si el handler retorna otra cosa, intenta
+	// agregar el cliente tanto a los clientes como al backend del
+	// loop. En caso de error, cierra la conexión (ejecutando el
+	// handler on_close). 
+
+	pthread_mutex_lock(&input->lock);
+	int max_clients = input->max_clients;
+	pthread_mutex_unlock(&input->lock);
+	if(max_clients > 0 && clients->num_clients >= max_clients) {
+		reset_client(new_client);
+		return;
+	}
+	listener->window_accepts++;
+
+	pthread_mutex_lock(&input->lock);
+	int busy_poll = input->busy_poll;
+	pthread_mutex_unlock(&input->lock);
+	if(busy_poll > 0) {
+		set_busy_poll(new_client, busy_poll);
+	}
+
+	pthread_mutex_lock(&input->lock);
+	int ret = run_handler(input->handlers.on_new_client, new_client, input->shared_data);
+	int idle_timeout = input->idle_timeout;
+	pthread_mutex_unlock(&input->lock);
+
+	switch(ret) {
+		case CLOSE_CLIENT:
+			reject_client(new_client, input);
+			break;
+		case STOP_SERVER:
+			reject_client(new_client, input);
+			stop_server(input);
+			break;
+		default:
+			// Si hay algun error al intentar agregar el cliente
+			// a la lista de clientes o al registrarlo en el
+			// backend, cerramos la conexión.
+			if(add_client(clients, new_client) == -1
+					|| watch_client(listener, new_client) == -1) {
+				close_client(new_client, clients, input);
+				return;
+			}
+			if(idle_timeout > 0 && schedule_client_timer(input->timers, new_client, idle_timeout) == -1) {
+				close_client(new_client, clients, input);
+			}
+	}
+}
+
+void accept_new_client(struct listener_state* listener,
+		struct clients_storage* clients, struct server_input* input) {
+
+	// Acepta a un nuevo cliente cuando el socket servidor está listo
+	// (con epoll) y lo agrega con add_accepted_client().
+
+	struct sockaddr_storage client_addr;
+	socklen_t sin_size = sizeof client_addr;
+	int new_client;
+
+	if((new_client = accept(listener->server_fd, (struct sockaddr*) &client_addr, &sin_size)) == -1) {
+		fprintf(stderr, "Error accepting client. Errno: %d\n", errno);
+		return;
+	}
+	add_accepted_client(new_client, listener, clients, input);
+}
+
+int handle_data_from_client(int client_fd, 
+		struct clients_storage* cliets, struct server_input* input) {
+
+	// Se ejecuta cuando un file descriptor está listo para leer.
+	// Recibe dicho file descriptor, los clientes y el input del
+	// servidor. Ejecuta el handler correspondiente de existir y;
+	// si este lo indica retornando CLOSE_CLIENT, cierra la conexión
+	// y remueve al cliente de los registros; si retorna STOP_SERVER,
+	// se finalizará el thread del servidor. Retorna lo retornado por
+	// el handler.
+	// Antes de ejecutar el handler, reprograma el timeout del cliente
+	// de estar habilitado, para que el handler pueda cambiarlo.
+
+	pthread_mutex_lock(&input->lock);
+	if(input->idle_timeout > 0) {
+		schedule_client_timer(input->timers, client_fd, input->idle_timeout);
+	}
+	int ret = run_handler(input->handlers.on_can_read, client_fd, input->shared_data);
+	pthread_mutex_unlock(&input->lock);
+
+	switch(ret) {
+		case CLOSE_CLIENT:
+			close_client(client_fd, cliets, input);
+			break;
+		case STOP_SERVER:
+			stop_server(input);
+			break;
+	}
+	return ret;
+}
+
+int handle_client_data(int client_fd, const uint8_t* data, int size,
+		struct clients_storage* clients, struct server_input* input) {
+
+	// Se ejecuta al recibir datos de un cliente si el servidor define
+	// on_data, al igual que handle_data_from_client: reprograma el
+	// timeout del cliente, ejecuta on_data con los datos y maneja su
+	// retorno, que retorna.
+
+	pthread_mutex_lock(&input->lock);
+	if(input->idle_timeout > 0) {
+		schedule_client_timer(input->timers, client_fd, input->idle_timeout);
+	}
+	int ret = input->handlers.on_data(client_fd, data, size, input->shared_data);
+	pthread_mutex_unlock(&input->lock);
+
+	switch(ret) {
+		case CLOSE_CLIENT:
+			close_client(client_fd, clients, input);
+			break;
+		case STOP_SERVER:
+			stop_server(input);
+			break;
+	}
+	return ret;
+}
+
+int receive_client_data(int client_fd, struct clients_storage* clients,
+		struct server_input* input) {
+
+	// Lee los datos disponibles de un cliente y se los pasa a on_data
+	// con handle_client_data(). Si el cliente cerró la conexión o la
+	// lectura falla, cierra la conexión y retorna CLOSE_CLIENT; si no
+	// hay datos, retorna 0.
+
+	uint8_t buffer[DATA_BUFFER_SIZE];
+	ssize_t received = recv(client_fd, buffer, sizeof buffer, MSG_DONTWAIT);
+	if(received == -1 && (errno == EAGAIN || errno == EWOULDBLOCK || errno == EINTR)) {
+		return 0;
+	}
+	if(received <= 0) {
+		close_client(client_fd, clients, input);
+		return CLOSE_CLIENT;
+	}
+	return handle_client_data(client_fd, buffer, received, clients, input);
+}
+
+int handle_readable_client(int client_fd, struct clients_storage* clients,
+		struct server_input* input) {
+
+	// Maneja un cliente listo para leer: con receive_client_data() si
+	// el servidor define on_data, o con handle_data_from_client() si
+	// no. Retorna lo retornado por el handler.
+
+	pthread_mutex_lock(&input->lock);
+	int has_data_handler = input->handlers.on_data != NULL;
+	pthread_mutex_unlock(&input->lock);
+	if(has_data_handler) {
+		return receive_client_data(client_fd, clients, input);
+	}
+	return handle_data_from_client(client_fd, clients, input);
+}
+
+void handle_client_hangup(int client_fd, uint32_t events,
+		struct clients_storage* clients, struct server_input* input) {
+
+	// Se ejecuta cuando el cliente cerró la conexión o esta falló.
+	// Cierra la conexión sin ejecutar el handler on_can_read, salvo
+	// que hayan quedado datos sin leer (el cliente envió algo y luego
+	// cerró), en cuyo caso primero los maneja para que no se pierdan.
+	// Como no llegarán más eventos del cliente, el handler se ejecuta
+	// mientras queden datos y los vaya consumiendo.
+
+	int pending_bytes = 0, previous_pending = 0;
+	if((events & EPOLLIN) && !(events & EPOLLERR)) {
+		while(ioctl(client_fd, FIONREAD, &pending_bytes) == 0 && pending_bytes > 0
+				&& (previous_pending == 0 || pending_bytes < previous_pending)) {
+			int ret = handle_readable_client(client_fd, clients, input);
+			if(ret == CLOSE_CLIENT || ret == STOP_SERVER) {
+				return;
+			}
+			previous_pending = pending_bytes;
+		}
+	}
+	close_client(client_fd, clients, input);
+}
+
+void* run_server(void * data) {
+
+	// Corre un servidor. Debe ejecutarse en un thread nuevo, recibiendo
+	// como parámetro un puntero a una estructura server_input.
+	// Utiliza epoll para multiplexar la entrada. Maneja los nuevos clientes
+	// y aquellos listos para la lectura manteniendo un registro de ellos
+	// y llamando a los handlers correspondientes provistos por medio del
+	// server_input.
+
+	// Antes de cada espera, pausa o reanuda la escucha de nuevas
+	// conexiones según los límites de clientes y tasa de aceptación.
+
+	// Cuando el servidor es señalizado que tiene que finalizar a través
+	// de su server_input; cierra todas las conexiones, al igual que el
+	// file descriptor asociado a la instancia de epoll, y retorna. 
+
+	struct server_input* input = (struct server_input*) data;
+
+	pthread_mutex_lock(&input->lock);
+	int server_fd = input->server_fd;;
+	pthread_mutex_unlock(&input->lock);
+
+	struct epoll_event events[MAX_EPOLL_EVENTS];
+	struct clients_storage cliets = init_clients_storage();
+	struct timer_wheel timers;
+	struct listener_state listener;
+	struct send_queue queue;
+	int epoll_event_count, epoll_fd = epoll_create1(0);
+
+	init_send_queue(&queue, NULL);
+	cliets.queue = &queue;
+	init_timer_wheel(&timers);
+	pthread_mutex_lock(&input->lock);
+	input->timers = &timers;
+	pthread_mutex_unlock(&input->lock);
+
+	if(epoll_fd == -1) {
+		fprintf(stderr, "Couldn't get epoll file descriptor. Errno: %d\n", errno);
+	}
+
+	if(add_epoll_fd(epoll_fd, server_fd) == -1) {
+		close(epoll_fd);
+		input->timers = NULL;
+		destroy_timer_wheel(&timers);
+		return NULL;
+	}
+
+	init_listener_state(&listener, server_fd, epoll_fd, NULL);
+	thread_send_queue = &queue;
+
+	while(!thread_should_stop(input)) {
+		// El timeout de epoll_wait() se ajusta para despertar cuando
+		// venza el próximo timer o, si la escucha está pausada por la
+		// tasa de aceptación, cuando termine la ventana actual
+		int timeout = next_loop_timeout(&timers, &listener, &cliets, input);
+		pthread_mutex_lock(&input->lock);
+		int spin_time = input->spin_time;
+		pthread_mutex_unlock(&input->lock);
+		epoll_event_count = wait_epoll_events(epoll_fd, events, timeout, spin_time);
+		for(int i = 0; i < epoll_event_count; i++) { 
+			int socket_fd = events[i].data.fd;
+			if(socket_fd == server_fd) {
+				if(!listener.paused) {
+					accept_new_client(&listener, &cliets, input);
+				}
+			} else if(events[i].events & (EPOLLRDHUP | EPOLLHUP | EPOLLERR)) {
+				handle_client_hangup(socket_fd, events[i].events, &cliets, input);
+			} else {
+				handle_readable_client(socket_fd, &cliets, input);
+			}
+		}
+		expire_timers(&cliets, input);
+		flush_send_queue(&cliets, input);
+	}
+
+	clear_clients(cliets, input);
+	close(epoll_fd);
+	thread_send_queue = NULL;
+	destroy_send_queue(&queue);
+	pthread_mutex_lock(&input->lock);
+	input->timers = NULL;
+	pthread_mutex_unlock(&input->lock);
+	destroy_timer_wheel(&timers);
+	return NULL;
+}
+
+#ifdef HAS_IO_URING
+
+#ifdef HAS_URING_BUFFERS
+
+void handle_uring_recv(struct io_uring_cqe* cqe, int client_fd, int current,
+		struct clients_storage* clients, struct server_input* input) {
+
+	// Maneja un recv completado de un cliente, current indicando si
+	// es de su conexión actual: pasa los datos recibidos a on_data y
+	// devuelve el buffer al ring. Si el recv terminó (no tiene
+	// IORING_CQE_F_MORE) y el cliente sigue conectado, lo vuelve a
+	// armar. 0 bytes indican que el cliente cerró la conexión; se la
+	// cierra al igual que ante un error, salvo que se hayan acabado
+	// los buffers (ENOBUFS), que ya fueron devueltos al ring al manejar
+	// los eventos anteriores.
+
+	struct uring_loop* ring = clients->ring;
+	int buffer_id = cqe->flags >> IORING_CQE_BUFFER_SHIFT;
+	if(!current) {
+		if(cqe->flags & IORING_CQE_F_BUFFER) {
+			recycle_uring_buffer(ring, buffer_id);
+		}
+		return;
+	}
+	uint32_t generation = ring->clients[client_fd].generation;
+	if(!(cqe->flags & IORING_CQE_F_MORE)) {
+		ring->clients[client_fd].armed = 0;
+	}
+	if(cqe->res > 0 && (cqe->flags & IORING_CQE_F_BUFFER)) {
+		handle_client_data(client_fd, ring->buffers + (size_t) buffer_id * DATA_BUFFER_SIZE,
+			cqe->res, clients, input);
+		recycle_uring_buffer(ring, buffer_id);
+	} else if(cqe->res == -EINVAL && ring->multishot_recv) {
+		ring->multishot_recv = 0;
+	} else if(cqe->res != -ENOBUFS) {
+		close_client(client_fd, clients, input);
+		return;
+	}
+	if(ring->clients[client_fd].generation == generation && !ring->clients[client_fd].armed
+			&& arm_uring_recv(ring, client_fd) == -1) {
+		close_client(client_fd, clients, input);
+	}
+}
+
+#else
+
+void handle_uring_recv(struct io_uring_cqe* cqe, int client_fd, int current,
+		struct clients_storage* clients, struct server_input* input) {
+}
+
+#endif
+
+void handle_uring_send(struct io_uring_cqe* cqe, struct clients_storage* clients,
+		struct server_input* input) {
+
+	// Maneja un envío completado. Si quedan datos por enviar al
+	// cliente, lo vuelve a encolar para enviarlos al final de la
+	// iteración; si no, y la conexión esperaba terminar de enviarlos
+	// para cerrarse, la cierra. Si el envío falló, descarta los datos y
+	// cierra la conexión.
+
+	struct send_queue* queue = clients->queue;
+	int client_fd = (uint32_t) cqe->user_data;
+	struct client_output* output = &queue->outputs[client_fd];
+	output->in_flight = 0;
+	queue->sends_in_flight--;
+	if(cqe->res <= 0) {
+		int closing = output->closing;
+		release_client_output(output);
+		if(closing) {
+			close(client_fd);
+		} else {
+			close_client(client_fd, clients, input);
+		}
+		return;
+	}
+	output->sent += cqe->res;
+	if(output->sent == output->sending_size) {
+		output->sent = 0;
+		output->sending_size = 0;
+	}
+	if(output->sending_size > 0 || output->pending_size > 0) {
+		queue_client_output(queue, client_fd);
+	} else if(output->closing) {
+		release_client_output(output);
+		close(client_fd);
+	}
+}
+
+void handle_uring_completion(struct io_uring_cqe* cqe, struct listener_state* listener,
+		struct clients_storage* clients, struct server_input* input) {
+
+	// Maneja una operación completada del ring: una conexión aceptada,
+	// un envío, un recv o un poll de un cliente. Los eventos de poll
+	// tienen los mismos valores que los de epoll (POLLIN es EPOLLIN,
+	// POLLRDHUP es EPOLLRDHUP, etc.), por lo que se manejan igual que
+	// en run_server. Luego de manejar un poll, si el cliente sigue
+	// conectado, lo vuelve a armar.
+
+	struct uring_loop* ring = listener->ring;
+	if(cqe->user_data == URING_IGNORE_DATA) {
+		return;
+	}
+	if(cqe->user_data == URING_ACCEPT_DATA) {
+		if(!(cqe->flags & IORING_CQE_F_MORE)) {
+			// El accept finalizó: fue cancelado, falló o no es
+			// multishot. Si el kernel no soporta accept multishot,
+			// se acepta de a una conexión.
+			ring->accept_armed = 0;
+			if(cqe->res == -EINVAL && ring->multishot_accept) {
+				ring->multishot_accept = 0;
+			}
+		}
+		if(cqe->res >= 0) {
+			add_accepted_client(cqe->res, listener, clients, input);
+		}
+		return;
+	}
+
+	if(cqe->user_data & URING_SEND_DATA) {
+		handle_uring_send(cqe, clients, input);
+		return;
+	}
+
+	int client_fd = (uint32_t) cqe->user_data;
+	uint32_t generation = cqe->user_data >> 32;
+	int current = client_fd < ring->clients_size && ring->clients[client_fd].generation == generation;
+	if(ring->recv_data) {
+		handle_uring_recv(cqe, client_fd, current, clients, input);
+		return;
+	}
+	if(!current) {
+		// Evento de una conexión ya cerrada
+		return;
+	}
+	ring->clients[client_fd].armed = 0;
+	if(cqe->res < 0) {
+		close_client(client_fd, clients, input);
+		return;
+	}
+	if(cqe->res & (EPOLLRDHUP | EPOLLHUP | EPOLLERR)) {
+		handle_client_hangup(client_fd, cqe->res, clients, input);
+	} else {
+		handle_readable_client(client_fd, clients, input);
+	}
+	if(ring->clients[client_fd].generation == generation
+			&& arm_uring_poll(ring, client_fd) == -1) {
+		close_client(client_fd, clients, input);
+	}
+}
+
+void* run_server_uring(void* data) {
+
+	// Corre un servidor al igual que run_server, pero utilizando
+	// io_uring en lugar de epoll. Las conexiones se aceptan con una
+	// única operación de accept y cada iteración envía todas las
+	// operaciones nuevas, incluidos los datos encolados con
+	// server_send(), y espera eventos con una sola syscall. Si el
+	// servidor define on_data, los datos de los clientes se reciben
+	// en buffers provistos al kernel. Si no puede crearse el ring,
+	// corre run_server.
+
+	struct server_input* input = (struct server_input*) data;
+	struct uring_loop ring;
+	if(init_uring_loop(&ring) == -1) {
+		pthread_mutex_lock(&input->lock);
+		input->backend = EPOLL_BACKEND;
+		pthread_mutex_unlock(&input->lock);
+		return run_server(data);
+	}
+
+	pthread_mutex_lock(&input->lock);
+	int server_fd = input->server_fd;
+	pthread_mutex_unlock(&input->lock);
+
+	struct clients_storage cliets = init_clients_storage();
+	struct timer_wheel timers;
+	struct listener_state listener;
+	struct send_queue queue;
+
+	pthread_mutex_lock(&input->lock);
+	int has_data_handler = input->handlers.on_data != NULL;
+	pthread_mutex_unlock(&input->lock);
+	// Sin buffers provistos, on_data se ejecuta luego de un poll y un
+	// recv(), al igual que con epoll
+	ring.recv_data = has_data_handler && init_uring_buffers(&ring) == 0;
+	init_send_queue(&queue, &ring);
+	thread_send_queue = &queue;
+	cliets.ring = &ring;
+	cliets.queue = &queue;
+	init_listener_state(&listener, server_fd, -1, &ring);
+	init_timer_wheel(&timers);
+	pthread_mutex_lock(&input->lock);
+	input->timers = &timers;
+	pthread_mutex_unlock(&input->lock);
+
+	while(!thread_should_stop(input)) {
+		int timeout = next_loop_timeout(&timers, &listener, &cliets, input);
+		if(!listener.paused && !ring.accept_armed) {
+			// Un accept multishot acepta todo el backlog de una vez, por
+			// lo que con límites de clientes o de tasa se acepta de a una
+			// conexión, al igual que con epoll
+			pthread_mutex_lock(&input->lock);
+			int limited = input->max_clients > 0 || input->max_accept_rate > 0;
+			pthread_mutex_unlock(&input->lock);
+			arm_uring_accept(&ring, server_fd, !limited);
+		}
+		pthread_mutex_lock(&input->lock);
+		int spin_time = input->spin_time;
+		pthread_mutex_unlock(&input->lock);
+		wait_uring_events(&ring, timeout, spin_time);
+		unsigned head = *ring.cq_head;
+		while(head != __atomic_load_n(ring.cq_tail, __ATOMIC_ACQUIRE)) {
+			// Se copia el evento y se libera su lugar antes de
+			// manejarlo
+			struct io_uring_cqe cqe = ring.cqes[head & *ring.cq_mask];
+			head++;
+			__atomic_store_n(ring.cq_head, head, __ATOMIC_RELEASE);
+			handle_uring_completion(&cqe, &listener, &cliets, input);
+		}
+		expire_timers(&cliets, input);
+		flush_send_queue(&cliets, input);
+	}
+
+	// Cerrar el ring cancela los polls y recvs pendientes, lo que
+	// termina de cerrar las conexiones de los clientes. Antes se
+	// espera a que terminen los envíos en curso.
+	drain_uring_sends(&ring, &queue);
+	clear_clients(cliets, input);
+	thread_send_queue = NULL;
+	destroy_send_queue(&queue);
+	destroy_uring_loop(&ring);
+	pthread_mutex_lock(&input->lock);
+	input->timers = NULL;
+	pthread_mutex_unlock(&input->lock);
+	destroy_timer_wheel(&timers);
+	return NULL;
+}
+
+#endif
+
+int start_server(pthread_t* thread, struct server_input* input) {
+
+	// Recibe un punteros a un pthread_t y a una estructura server_input.
+	// Iniacializa el thread para correr la función run_server con la entrada
+	// provista, o run_server_uring si input->backend es IO_URING_BACKEND.
+	// Si io_uring no está disponible, utiliza epoll y asigna
+	// EPOLL_BACKEND a input->backend. Retorna -1 en caso de error, 0 en
+	// caso de éxito.
+
+	void* (*run)(void*) = &run_server;
+	pthread_mutex_lock(&input->lock);
+	if(input->backend == IO_URING_BACKEND && !io_uring_available()) {
+		input->backend = EPOLL_BACKEND;
+	}
+#ifdef HAS_IO_URING
+	if(input->backend == IO_URING_BACKEND) {
+		run = &run_server_uring;
+	}
+#endif
+	int cpu = input->cpu;
+	pthread_mutex_unlock(&input->lock);
+
+	// Si se indicó un CPU, el thread se crea ya fijado a él
+	pthread_attr_t attributes;
+	pthread_attr_init(&attributes);
+	if(cpu >= 0) {
+		cpu_set_t cpus;
+		CPU_ZERO(&cpus);
+		CPU_SET(cpu, &cpus);
+		pthread_attr_setaffinity_np(&attributes, sizeof cpus, &cpus);
+	}
+
+	int ret = pthread_create(thread, &attributes, run, input);
+	pthread_attr_destroy(&attributes);
+	if(ret != 0) {
+		fprintf(stderr, "Couldn't start server thread, error at pthread_create(). Error code: %d\n", ret);
+		return -1;
+	}
+	return 0;
+}
+
+int set_thread_cpu(pthread_t thread, int cpu) {
+
+	// Fija el thread al CPU cpu, de modo que el scheduler solo lo
+	// ejecute en él. Sirve para fijar los threads propios que trabajan
+	// junto al servidor. Retorna -1 en caso de error.
+
+	cpu_set_t cpus;
+	CPU_ZERO(&cpus);
+	CPU_SET(cpu, &cpus);
+	int ret;
+	if((ret = pthread_setaffinity_np(thread, sizeof cpus, &cpus)) != 0) {
+		fprintf(stderr, "Error at pthread_setaffinity_np(). Error code: %d\n", ret);
 		return -1;
 	}
 	return 0;
@@ -2,11 +2,21 @@
 #define SOCKETS_H_INCLUDED
 
 #include <pthread.h>
+#include <stdint.h>
 
 // Puntero a una función que se utilizará para manejar eventos
 // específicos que ocurran en un servidor.
 typedef int (*handler_t)(int, void*);
 
+// Puntero a una función que recibirá los datos leídos de un cliente
+// (ver on_data en handler_set). Recibe el file descriptor del cliente,
+// los datos, su cantidad de bytes y los datos compartidos del servidor.
+typedef int (*data_handler_t)(int, const uint8_t*, int, void*);
+
+// Puntero a una función que ejecutará un timer del servidor. Recibe
+// el dato asociado al timer.
+typedef void (*timer_callback_t)(void*);
+
 // Retornos de los handlers, los cuales serán interpretados por el
 // servidor.
 enum handler_return { CLOSE_CLIENT = 10, STOP_SERVER };
@@ -18,29 +28,80 @@ enum handler_return { CLOSE_CLIENT = 10, STOP_SERVER };
 // on_can_read será llamada cuando pueda leerse de un cliente. Recibirá
 // el file descriptor del cliente y los datos compartidos del servidor.
 // Deberá retornar CLOSE_CLIENT si el cliente cerró la conexión.
+// on_timeout será llamada cuando venza el timeout de un cliente (ver
+// idle_timeout en server_input). Si retorna CLOSE_CLIENT, o si es
+// NULL, se cierra la conexión.
+// on_close será llamada una única vez por cliente aceptado, antes de
+// cerrar su conexión, sin importar el motivo: que el cliente la haya
+// cerrado, que un handler (incluido on_new_client) haya retornado
+// CLOSE_CLIENT o STOP_SERVER o que el servidor finalice. Su retorno
+// se ignora.
+// on_data, de estar definida, reemplaza a on_can_read: el servidor lee
+// los datos del cliente y se los pasa, válidos solo durante la llamada.
+// Con io_uring, son los del buffer que el kernel llenó al recibir. Se
+// interpreta su retorno igual que el de on_can_read, pero no se llama
+// cuando el cliente cierra la conexión.
 struct handler_set {
 	handler_t on_new_client;
 	handler_t on_can_read;
+	handler_t on_timeout;
+	handler_t on_close;
+	data_handler_t on_data;
 };
 
+// Backends que puede utilizar el servidor para esperar eventos.
+enum server_backend { EPOLL_BACKEND, IO_URING_BACKEND };
+
+struct timer_wheel;
+struct server_timer;
+
 // Estructura de entrada para un servidor. Contiene un mutex,
 // el flag should_stop para señalizar al servidor que debe
 // finalizar, el file descriptor del servidor (resultado de
 // create_socket_server()), una estructura handler_set 
 // (que contiene los handlers asociados al servidor) y un void*
 // con cualquier información que quiera compartirse con los handlers.
+// idle_timeout es la cantidad de milisegundos que puede pasar un
+// cliente sin enviar datos antes de que venza su timeout, 0 para no
+// usar timeouts. max_clients es la cantidad máxima de clientes
+// conectados y max_accept_rate la de clientes aceptados por segundo,
+// 0 para no limitarlas: al alcanzarse, el servidor deja de aceptar
+// conexiones hasta volver a estar por debajo del límite. Si
+// reject_when_full es distinto de 0, en lugar de dejar esperando a las
+// conexiones que superan max_clients las acepta y cierra en el acto.
+// backend es el backend con el que start_server() correrá el servidor;
+// si es IO_URING_BACKEND pero io_uring no está disponible, se utiliza
+// EPOLL_BACKEND. cpu es el CPU al que start_server() fija el thread
+// del servidor, -1 para no fijarlo. busy_poll es la cantidad de
+// microsegundos de SO_BUSY_POLL de los clientes y spin_time la de
+// microsegundos que el servidor consulta eventos sin bloquear antes de
+// dormirse, 0 para no usarlos. timers es utilizado internamente por el
+// servidor.
 struct server_input {
 	pthread_mutex_t lock;
 	int should_stop;
 	int server_fd;
 	struct handler_set handlers;
 	void* shared_data;
+	int idle_timeout;
+	int max_clients;
+	int max_accept_rate;
+	int reject_when_full;
+	enum server_backend backend;
+	int cpu;
+	int busy_poll;
+	int spin_time;
+	struct timer_wheel* timers;
 };
 
 int create_socket_server(const char*, int);
 
 int create_socket_client(const char*, const char *);
 
+int create_unix_socket_server(const char*, int);
+
+int create_unix_socket_client(const char*);
+
 void init_server_input(struct server_input*, int, struct handler_set, void*);
 
 void stop_server(struct server_input*);
@@ -49,4 +110,18 @@ int start_server(pthread_t*, struct server_input*);
 
 void stop_server_and_join(pthread_t, struct server_input*);
 
+struct server_timer* add_server_timer(struct server_input*, int, timer_callback_t, void*);
+
+void cancel_server_timer(struct server_timer*);
+
+int set_client_timeout(struct server_input*, int, int);
+
+int server_send(int, const void*, int);
+
+int set_thread_cpu(pthread_t, int);
+
+int64_t relay_bytes(int, int, int64_t);
+
+void release_thread_relay_pipe();
+
 #endif
\ No newline at end of file
@@ -0,0 +1,366 @@
+// Reproduce contra un servidor el tráfico de un archivo de captura
+// generado por un protocolo con la opción --capture del generador.
+//
+// Uso: ./replay [-t threads] [-x velocidad] [-r] captura host puerto
+//
+// Compilación: gcc tools/replay.c sockets.c -I. -o replay -pthread
+
+#ifndef _GNU_SOURCE
+#define _GNU_SOURCE
+#endif
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <errno.h>
+#include <unistd.h>
+#include <stdint.h>
+#include <fcntl.h>
+#include <time.h>
+#include <poll.h>
+#include <endian.h>
+#include <pthread.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/socket.h>
+
+#include "sockets.h"
+
+#define CAPTURE_MAGIC "PRTCAP01"
+#define CAPTURE_MAGIC_SIZE 8
+#define CAPTURE_RECORD_HEADER_SIZE 17
+#define CAPTURE_SENT 0
+#define CAPTURE_RECEIVED 1
+#define DRAIN_BUFFER_SIZE 65536
+#define DRAIN_TIMEOUT 1000
+
+struct capture {
+	const uint8_t* data;
+	size_t size;
+	uint64_t first_timestamp;
+};
+
+struct capture_record {
+	uint64_t timestamp;
+	uint32_t len;
+	uint32_t connection;
+	uint8_t direction;
+	const uint8_t* data;
+};
+
+struct replay_options {
+	const char* host;
+	const char* port;
+	int threads;
+	double speed;
+	uint8_t direction;
+};
+
+// Cada conexión de la captura se reproduce en una conexión propia,
+// siempre desde el mismo thread, para respetar el orden de sus datos.
+struct replay_connection {
+	uint32_t id;
+	int socket_fd;
+};
+
+struct replay_thread {
+	pthread_t thread;
+	int index;
+	const struct capture* capture;
+	const struct replay_options* options;
+	int64_t start;
+	int64_t end;
+	struct replay_connection* connections;
+	int connections_count;
+	int connections_size;
+	uint64_t records;
+	uint64_t bytes_sent;
+	uint64_t bytes_received;
+	int error;
+};
+
+int64_t get_current_ns() {
+	struct timespec now;
+	clock_gettime(CLOCK_MONOTONIC, &now);
+	return (int64_t) now.tv_sec * 1000000000 + now.tv_nsec;
+}
+
+int read_record(const struct capture* capture, size_t* offset, struct capture_record* record) {
+
+	// Lee el registro que empieza en offset y avanza offset al
+	// siguiente. Retorna 0 al llegar al final de la captura o a un
+	// registro incompleto (por ejemplo, si la captura sigue abierta).
+
+	if(capture->size - *offset < CAPTURE_RECORD_HEADER_SIZE) {
+		return 0;
+	}
+	const uint8_t* header = capture->data + *offset;
+	uint64_t timestamp;
+	uint32_t len, connection;
+	memcpy(&timestamp, header, sizeof(timestamp));
+	memcpy(&len, header + 8, sizeof(len));
+	memcpy(&connection, header + 12, sizeof(connection));
+	record->timestamp = le64toh(timestamp);
+	record->len = le32toh(len);
+	record->connection = le32toh(connection);
+	record->direction = header[16];
+	record->data = header + CAPTURE_RECORD_HEADER_SIZE;
+	if(capture->size - *offset - CAPTURE_RECORD_HEADER_SIZE < record->len) {
+		return 0;
+	}
+	*offset += CAPTURE_RECORD_HEADER_SIZE + record->len;
+	return 1;
+}
+
+int map_capture(const char* path, struct capture* capture) {
+
+	// Mapea el archivo de captura path en memoria. Retorna -1 en caso
+	// de error.
+
+	int capture_fd = open(path, O_RDONLY | O_CLOEXEC);
+	if(capture_fd == -1) {
+		fprintf(stderr, "Error at open(). Errno: %d\n", errno);
+		return -1;
+	}
+	struct stat capture_stat;
+	if(fstat(capture_fd, &capture_stat) == -1 || capture_stat.st_size < CAPTURE_MAGIC_SIZE) {
+		fprintf(stderr, "%s no es un archivo de captura\n", path);
+		close(capture_fd);
+		return -1;
+	}
+	void* data = mmap(NULL, capture_stat.st_size, PROT_READ, MAP_PRIVATE, capture_fd, 0);
+	close(capture_fd);
+	if(data == MAP_FAILED) {
+		fprintf(stderr, "Error at mmap(). Errno: %d\n", errno);
+		return -1;
+	}
+	if(memcmp(data, CAPTURE_MAGIC, CAPTURE_MAGIC_SIZE) != 0) {
+		fprintf(stderr, "%s no es un archivo de captura\n", path);
+		munmap(data, capture_stat.st_size);
+		return -1;
+	}
+	madvise(data, capture_stat.st_size, MADV_SEQUENTIAL);
+
+	capture->data = data;
+	capture->size = capture_stat.st_size;
+	capture->first_timestamp = 0;
+	size_t offset = CAPTURE_MAGIC_SIZE;
+	struct capture_record record;
+	if(read_record(capture, &offset, &record)) {
+		capture->first_timestamp = record.timestamp;
+	}
+	return 0;
+}
+
+int drain_connection(struct replay_thread* thread, int socket_fd) {
+
+	// Descarta las respuestas del servidor disponibles en el socket,
+	// para que este nunca se bloquee enviándolas. Retorna -1 si el
+	// servidor cerró la conexión o en caso de error.
+
+	uint8_t buffer[DRAIN_BUFFER_SIZE];
+	while(1) {
+		ssize_t num_bytes = recv(socket_fd, buffer, DRAIN_BUFFER_SIZE, MSG_DONTWAIT);
+		if(num_bytes > 0) {
+			thread->bytes_received += num_bytes;
+		} else if(num_bytes == -1 && (errno == EAGAIN || errno == EWOULDBLOCK)) {
+			return 0;
+		} else if(num_bytes == -1 && errno == EINTR) {
+			continue;
+		} else {
+			return -1;
+		}
+	}
+}
+
+int send_record(struct replay_thread* thread, int socket_fd, const struct capture_record* record) {
+
+	// Envía los datos de un registro. Mientras el socket no admita más
+	// datos, descarta las respuestas del servidor.
+
+	uint32_t bytes_sent = 0;
+	while(bytes_sent < record->len) {
+		ssize_t num_bytes = send(socket_fd, record->data + bytes_sent,
+			record->len - bytes_sent, MSG_DONTWAIT | MSG_NOSIGNAL);
+		if(num_bytes == -1 && (errno == EAGAIN || errno == EWOULDBLOCK)) {
+			struct pollfd poll_fd = { .fd = socket_fd, .events = POLLIN | POLLOUT };
+			if(poll(&poll_fd, 1, -1) == -1 && errno != EINTR) {
+				return -1;
+			}
+			if((poll_fd.revents & POLLIN) && drain_connection(thread, socket_fd) == -1) {
+				return -1;
+			}
+			continue;
+		} else if(num_bytes == -1 && errno == EINTR) {
+			continue;
+		} else if(num_bytes == -1) {
+			return -1;
+		}
+		bytes_sent += num_bytes;
+	}
+	thread->bytes_sent += bytes_sent;
+	return 0;
+}
+
+int get_connection(struct replay_thread* thread, uint32_t id) {
+
+	// Retorna el socket con el que se reproduce la conexión id de la
+	// captura, conectándolo si es la primera vez que aparece.
+
+	for(int i = 0; i < thread->connections_count; i++) {
+		if(thread->connections[i].id == id) {
+			return thread->connections[i].socket_fd;
+		}
+	}
+	if(thread->connections_count == thread->connections_size) {
+		int new_size = thread->connections_size ? thread->connections_size * 2 : 16;
+		struct replay_connection* connections = realloc(thread->connections,
+			sizeof(struct replay_connection) * new_size);
+		if(connections == NULL) {
+			return -1;
+		}
+		thread->connections = connections;
+		thread->connections_size = new_size;
+	}
+	int socket_fd = create_socket_client(thread->options->host, thread->options->port);
+	if(socket_fd == -1) {
+		return -1;
+	}
+	thread->connections[thread->connections_count].id = id;
+	thread->connections[thread->connections_count].socket_fd = socket_fd;
+	thread->connections_count++;
+	return socket_fd;
+}
+
+void close_connections(struct replay_thread* thread) {
+
+	// Cierra el envío de cada conexión y espera a que el servidor la
+	// cierre, descartando sus últimas respuestas.
+
+	for(int i = 0; i < thread->connections_count; i++) {
+		int socket_fd = thread->connections[i].socket_fd;
+		shutdown(socket_fd, SHUT_WR);
+		struct pollfd poll_fd = { .fd = socket_fd, .events = POLLIN };
+		while(poll(&poll_fd, 1, DRAIN_TIMEOUT) > 0 && drain_connection(thread, socket_fd) == 0);
+		close(socket_fd);
+	}
+	free(thread->connections);
+}
+
+void* run_replay_thread(void* data) {
+
+	// Reproduce los registros de las conexiones de la captura que le
+	// corresponden al thread, respetando sus tiempos si speed es
+	// mayor a 0.
+
+	struct replay_thread* thread = (struct replay_thread*) data;
+	const struct replay_options* options = thread->options;
+	size_t offset = CAPTURE_MAGIC_SIZE;
+	struct capture_record record;
+
+	while(read_record(thread->capture, &offset, &record)) {
+		if(record.direction != options->direction ||
+				record.connection % options->threads != (uint32_t) thread->index) {
+			continue;
+		}
+		if(options->speed > 0 && record.timestamp > thread->capture->first_timestamp) {
+			int64_t target = thread->start +
+				(int64_t) ((record.timestamp - thread->capture->first_timestamp) / options->speed);
+			struct timespec wake = { target / 1000000000, target % 1000000000 };
+			while(clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &wake, NULL) == EINTR);
+		}
+		int socket_fd = get_connection(thread, record.connection);
+		if(socket_fd == -1 || send_record(thread, socket_fd, &record) == -1 ||
+				drain_connection(thread, socket_fd) == -1) {
+			thread->error = 1;
+			break;
+		}
+		thread->records++;
+	}
+	thread->end = get_current_ns();
+	close_connections(thread);
+	return NULL;
+}
+
+void print_usage() {
+	printf("Uso: ./replay [-t threads] [-x velocidad] [-r] captura host puerto\n"
+		"\t-t: cantidad de threads cliente (por defecto 1)\n"
+		"\t-x: velocidad respecto de la original (por defecto 1), 0 para\n"
+		"\t    enviar lo más rápido posible\n"
+		"\t-r: reproducir el tráfico recibido en lugar del enviado\n");
+}
+
+int main(int argc, char* argv[]) {
+
+	struct replay_options options = { .threads = 1, .speed = 1, .direction = CAPTURE_SENT };
+	int option;
+	while((option = getopt(argc, argv, "t:x:r")) != -1) {
+		switch(option) {
+			case 't':
+				options.threads = atoi(optarg);
+				break;
+			case 'x':
+				options.speed = atof(optarg);
+				break;
+			case 'r':
+				options.direction = CAPTURE_RECEIVED;
+				break;
+			default:
+				print_usage();
+				return -1;
+		}
+	}
+	if(argc - optind != 3 || options.threads < 1 || options.speed < 0) {
+		print_usage();
+		return -1;
+	}
+	options.host = argv[optind + 1];
+	options.port = argv[optind + 2];
+
+	struct capture capture;
+	if(map_capture(argv[optind], &capture) == -1) {
+		return -1;
+	}
+
+	struct replay_thread* threads = calloc(options.threads, sizeof(struct replay_thread));
+	if(threads == NULL) {
+		return -1;
+	}
+	int64_t start = get_current_ns();
+	for(int i = 0; i < options.threads; i++) {
+		threads[i].index = i;
+		threads[i].capture = &capture;
+		threads[i].options = &options;
+		threads[i].start = start;
+		pthread_create(&threads[i].thread, NULL, &run_replay_thread, &threads[i]);
+	}
+
+	uint64_t records = 0, bytes_sent = 0, bytes_received = 0;
+	int64_t end = start;
+	int errors = 0;
+	for(int i = 0; i < options.threads; i++) {
+		pthread_join(threads[i].thread, NULL);
+		records += threads[i].records;
+		bytes_sent += threads[i].bytes_sent;
+		bytes_received += threads[i].bytes_received;
+		errors += threads[i].error;
+		end = threads[i].end > end ? threads[i].end : end;
+	}
+
+	// El tiempo se mide hasta el último envío, sin contar la espera a
+	// que el servidor cierre las conexiones
+	double elapsed = (end - start) / 1e9;
+
+	printf("Registros enviados: %lu\n", records);
+	printf("Bytes enviados: %lu (recibidos: %lu)\n", bytes_sent, bytes_received);
+	printf("Tiempo: %.3f s\n", elapsed);
+	printf("Throughput: %.0f registros/s, %.2f MB/s\n",
+		records / elapsed, bytes_sent / elapsed / 1e6);
+	if(errors > 0) {
+		printf("Threads con errores: %d\n", errors);
+	}
+
+	free(threads);
+	munmap((void*) capture.data, capture.size);
+	return errors > 0 ? -1 : 0;
+}